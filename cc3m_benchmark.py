@@ -0,0 +1,588 @@
+import os
+import sys
+import json
+import time
+import filecmp
+import platform
+import tempfile
+import argparse
+
+import pandas as pd
+
+from cc3m_synthetic_data import (
+    SyntheticImageServer, closed_port, make_dataset_dir, make_download_entries, make_synthetic_captions,
+    make_synthetic_jpeg, make_synthetic_tsv, make_translated_entries, normalize_or_error
+)
+
+
+def bench_tsv_to_jsonl(work_dir, n_rows, chunksize=50000, n_workers=4):
+
+    from cc3m_tsv_to_jsonl import convert_to_jsonl, convert_to_jsonl_columnar
+
+    tsv_path = os.path.join(work_dir, 'captions.tsv')
+    make_synthetic_tsv(tsv_path, n_rows)
+
+    def read():
+        return pd.read_csv(tsv_path, sep='\t', iterator=True, chunksize=chunksize, header=None)
+
+    runs = [
+        ('row', lambda fn: convert_to_jsonl(read(), fn)),
+        ('columnar', lambda fn: convert_to_jsonl_columnar(read(), fn)),
+        (f'columnar_{n_workers}_workers', lambda fn: convert_to_jsonl_columnar(read(), fn, n_workers=n_workers)),
+    ]
+
+    results = {}
+    reference = None
+    for name, run in runs:
+        output_fn = os.path.join(work_dir, f'{name}.jsonl')
+        s = time.perf_counter()
+        run(output_fn)
+        elapsed = time.perf_counter() - s
+        if reference is None:
+            reference = output_fn
+        results[name] = {
+            'seconds': elapsed,
+            'rows_per_sec': n_rows / elapsed,
+            'identical': filecmp.cmp(reference, output_fn, shallow=False),
+        }
+
+    return results
+
+
+def bench_download(work_dir, n_entries, n_fetchers=32, n_decoders=4, **entry_kwargs):
+
+    from cc3m_image_downloader import DownloadEngine
+    from cc3m_download_metrics import DownloadMetrics
+
+    results = {}
+    with SyntheticImageServer() as server:
+
+        entries = make_download_entries(server, n_entries, **entry_kwargs)
+
+        target_dir = os.path.join(work_dir, 'images')
+        os.makedirs(target_dir, exist_ok=True)
+
+        counts = {}
+        metrics = DownloadMetrics()
+        s = time.perf_counter()
+        with DownloadEngine(target_dir, 'bench', n_fetchers=n_fetchers, n_decoders=n_decoders, metrics=metrics) as engine:
+            for result in engine.run(iter(entries)):
+                counts[result['status']] = counts.get(result['status'], 0) + 1
+        elapsed = time.perf_counter() - s
+
+        results['engine'] = {
+            'seconds': elapsed,
+            'entries_per_sec': n_entries / elapsed,
+            'counts': counts,
+            'n_requests': server.httpd.n_requests,
+            # p50/p95/p99 of each stage, in seconds
+            'stages': metrics.snapshot()['stages'],
+        }
+
+    return results
+
+
+def bench_hosts(work_dir, n_entries, n_fetchers=16, n_decoders=2, slow_delay=2.5, dead_delay=30):
+    """The download engine against a fast host, a slow one (slower than the default 2s timeout), one which never
+    answers and one refusing connections: with a fixed timeout, then with a `HostPolicy`."""
+
+    from cc3m_image_downloader import DownloadEngine
+    from cc3m_host_policy import HostPolicy
+
+    results = {}
+    with SyntheticImageServer() as fast, SyntheticImageServer(default_delay=slow_delay) as slow, \
+            SyntheticImageServer(default_delay=dead_delay) as dead:
+
+        refused_url = f'http://127.0.0.1:{closed_port()}'
+        hosts = {
+            'fast': fast.url, 'slow': slow.url, 'dead': dead.url,
+            'refused': lambda name, **params: f'{refused_url}/{name}',
+        }
+        kinds = list(hosts)
+        entries = [
+            {'image_id': idx, 'image_url': hosts[kinds[idx % len(kinds)]](f'{idx:08d}.jpg', w=640, h=480)}
+            for idx in range(n_entries)
+        ]
+
+        for name, host_policy in [('fixed_timeout', None), ('host_policy', HostPolicy())]:
+
+            target_dir = os.path.join(work_dir, name)
+            os.makedirs(target_dir, exist_ok=True)
+
+            counts = {kind: {} for kind in kinds}
+            s = time.perf_counter()
+            with DownloadEngine(
+                    target_dir, 'bench', n_fetchers=n_fetchers, n_decoders=n_decoders, host_policy=host_policy) as engine:
+                for result in engine.run(iter(entries)):
+                    host_counts = counts[kinds[result['image_id'] % len(kinds)]]
+                    host_counts[result['status']] = host_counts.get(result['status'], 0) + 1
+            elapsed = time.perf_counter() - s
+
+            results[name] = {
+                'seconds': elapsed,
+                'entries_per_sec': n_entries / elapsed,
+                'counts': counts,
+                'hosts': host_policy.stats() if host_policy is not None else None,
+            }
+
+    return results
+
+
+def _legacy_decode_and_save(content, f_path, tmp_path, max_size=512):
+    """The pre-draft-mode path: temp file round trip, full resolution decode, then LANCZOS resize (which is what
+    torchvision's `resize` does on PIL images)."""
+
+    from PIL import Image
+    from cc3m_image_downloader import target_size
+
+    with open(tmp_path, 'wb') as fp:
+        fp.write(content)
+    with Image.open(tmp_path).convert('RGB') as image:
+        img = image
+        if min(img.size) > max_size:
+            img = img.resize(target_size(img.size, max_size), resample=Image.LANCZOS)
+        img.save(f_path)
+    os.unlink(tmp_path)
+
+
+def bench_decode(work_dir, n_images, sizes=((3000, 2000), (4000, 3000), (1600, 1200))):
+
+    from cc3m_image_downloader import ImageOutput, decode_and_save, output_path
+
+    contents = [make_synthetic_jpeg(*sizes[idx % len(sizes)], seed=idx % len(sizes)) for idx in range(n_images)]
+    f_path = os.path.join(work_dir, 'out', 'out.jpg')
+    tmp_path = os.path.join(work_dir, 'tmp.jpg')
+
+    # a 512/384/256 pyramid, from one decode or from one decode per size
+    outputs = [ImageOutput.parse(x) for x in ('512', '384', '256:webp:80')]
+    for idx, output in enumerate(outputs):
+        os.makedirs(os.path.dirname(output_path(f_path, idx, output)), exist_ok=True)
+
+    def pyramid_redecode(content):
+        for idx, output in enumerate(outputs):
+            decode_and_save(content, output_path(f_path, idx, output), outputs=[output])
+
+    runs = [
+        ('legacy', lambda content: _legacy_decode_and_save(content, f_path, tmp_path)),
+        ('in_memory_draft', lambda content: decode_and_save(content, f_path)),
+        ('pyramid_redecode', pyramid_redecode),
+        ('pyramid', lambda content: decode_and_save(content, f_path, outputs=outputs)),
+    ]
+
+    results = {}
+    for name, run in runs:
+        s = time.perf_counter()
+        cpu_s = time.process_time()
+        for content in contents:
+            run(content)
+        elapsed = time.perf_counter() - s
+        results[name] = {
+            'seconds': elapsed,
+            'ms_per_image': 1000 * elapsed / n_images,
+            'cpu_ms_per_image': 1000 * (time.process_time() - cpu_s) / n_images,
+        }
+
+    return results
+
+
+def load_captions(jsonl_path, n_captions):
+
+    from cc3m_jsonl_io import iter_entries
+
+    captions = []
+    for entry in iter_entries(jsonl_path):
+        caption = entry['caption']
+        if isinstance(caption, str):
+            captions.append(caption)
+        if len(captions) >= n_captions:
+            break
+
+    return captions
+
+
+def bench_normalize(captions, batch_size=100):
+    """Golden-output check of `CaptionNormalizer` against `process_1_annotation`, then timing of both."""
+
+    from cc3m_text_normalization import process_1_annotation, CaptionNormalizer
+
+    normalizer = CaptionNormalizer()
+
+    mismatches = [
+        caption for caption in captions
+        if normalize_or_error(process_1_annotation, caption) != normalize_or_error(normalizer.normalize, caption)
+    ]
+    # the reference implementation fails on captions reduced to nothing, leave them out of the timing
+    captions = [x for x in captions if normalize_or_error(process_1_annotation, x) is not IndexError]
+    batches = [captions[idx:idx + batch_size] for idx in range(0, len(captions), batch_size)]
+
+    runs = [
+        ('process_1_annotation', lambda batch: [process_1_annotation(x) for x in batch]),
+        ('CaptionNormalizer', normalizer),
+    ]
+
+    results = {}
+    for name, run in runs:
+        s = time.perf_counter()
+        for batch in batches:
+            run(batch)
+        elapsed = time.perf_counter() - s
+        results[name] = {
+            'seconds': elapsed,
+            'captions_per_sec': len(captions) / elapsed,
+            'mismatches': len(mismatches),
+        }
+
+    return results
+
+
+def bench_translate(n_captions, langs=('fr', 'es', 'pt', 'it', 'ja', 'ko', 'zh-CN'), latency=0.02, failure_rate=0.01,
+                    worker_counts=(1, 16), pack_sizes=(1, 20), merge_rate=0.05, batch_size=100):
+    """`translate_batch` against `StubBackend` with injected latency and failures, for several numbers of requests
+    in flight, and with the captions translated one by one or packed `pack_size` per request (a fraction
+    `merge_rate` of the packed translations don't split back, and fall back to one request per caption). The
+    outputs are compared to the ones of the first run."""
+
+    import cc3m_processing
+    from cc3m_translation import StubBackend, TranslationEngine
+
+    captions = make_synthetic_captions(n_captions)
+
+    results = {}
+    reference = None
+    for n_workers in worker_counts:
+        for pack_size in pack_sizes:
+
+            backend = StubBackend(latency=latency, failure_rate=failure_rate, merge_rate=merge_rate)
+            engine = TranslationEngine(n_workers=n_workers, backoff=0.01)
+            cc3m_processing.translation_backend, cc3m_processing.translation_engine = backend, engine
+            cc3m_processing.translation_pack_size = pack_size
+
+            entries = [{'image_id': idx, 'id': idx, 'caption': x, 'image_url': ''} for idx, x in enumerate(captions)]
+            buf = []
+            s = time.perf_counter()
+            for idx in range(0, len(entries), batch_size):
+                cc3m_processing.translate_batch(entries[idx:idx + batch_size], langs=list(langs), buf=buf)
+            elapsed = time.perf_counter() - s
+            engine.close()
+
+            if reference is None:
+                reference = buf
+
+            name = f'{n_workers}_workers' + (f'_pack_{pack_size}' if pack_size > 1 else '')
+            results[name] = {
+                'seconds': elapsed,
+                'captions_per_sec': len(captions) / elapsed,
+                'n_requests': backend.n_requests,
+                'mismatches': sum(x != y for x, y in zip(buf, reference)),
+                **engine.stats(),
+            }
+
+    cc3m_processing.translation_pack_size = 1
+
+    return results
+
+
+def bench_jsonl_io(work_dir, n_entries):
+    """Writing and reading translated entries: a `json.dumps`/`json.loads` per line (as the scripts used to do)
+    against `cc3m_jsonl_io`, uncompressed and compressed."""
+
+    import json
+    import cc3m_jsonl_io
+
+    entries = make_translated_entries(n_entries)
+
+    def legacy_write(path):
+        with open(path, 'w', encoding='UTF-8') as fp:
+            for entry in entries:
+                fp.write(json.dumps(entry, ensure_ascii=False, indent=None) + '\n')
+
+    def legacy_read(path):
+        with open(path, 'r', encoding='UTF-8') as fp:
+            return sum(1 for line in fp if json.loads(line))
+
+    def write(path):
+        with cc3m_jsonl_io.JsonlWriter(path) as writer:
+            writer.write_many(entries)
+
+    def read(path):
+        return sum(len(batch) for batch in cc3m_jsonl_io.iter_batches(path))
+
+    runs = [
+        ('legacy', '.jsonl', legacy_write, legacy_read),
+        ('jsonl_io', '.jsonl', write, read),
+        ('jsonl_io_gz', '.jsonl.gz', write, read),
+    ]
+    if cc3m_jsonl_io.zstandard is not None:
+        runs.append(('jsonl_io_zst', '.jsonl.zst', write, read))
+
+    results = {}
+    reference = None
+    for name, suffix, write_fn, read_fn in runs:
+        path = os.path.join(work_dir, name + suffix)
+
+        s = time.perf_counter()
+        write_fn(path)
+        write_elapsed = time.perf_counter() - s
+
+        s = time.perf_counter()
+        n_read = read_fn(path)
+        read_elapsed = time.perf_counter() - s
+
+        if reference is None:
+            reference = path
+            n_bytes = os.path.getsize(path)
+        with cc3m_jsonl_io.open_file(path) as fp, open(reference, 'rb') as ref_fp:
+            identical = fp.read() == ref_fp.read()
+
+        results[name] = {
+            'write_mb_per_sec': n_bytes / write_elapsed / 1e6,
+            'read_mb_per_sec': n_bytes / read_elapsed / 1e6,
+            'read_entries_per_sec': n_read / read_elapsed,
+            'file_mb': os.path.getsize(path) / 1e6,
+            'identical': identical,
+        }
+
+    results['codec'] = 'orjson' if cc3m_jsonl_io.orjson is not None else 'json'
+
+    return results
+
+
+def bench_generate_examples(work_dir, n_entries, data_formats=('jsonl', 'parquet')):
+    """`ImageCaptionDataset._split_generators` and `_generate_examples` (without writing the Arrow files), for each
+    data format."""
+
+    import datasets
+
+    data_dir = os.path.join(work_dir, 'data')
+    make_dataset_dir(data_dir, n_entries)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image_caption_dataset.py')
+
+    results = {}
+    for data_format in data_formats:
+
+        builder = datasets.load_dataset_builder(
+            script, 'cc3m', data_dir=data_dir, cache_dir=os.path.join(work_dir, 'cache'), splits=['train'],
+            data_format=data_format, trust_remote_code=True
+        )
+
+        s = time.perf_counter()
+        split_generators = builder._split_generators(None)
+        split_elapsed = time.perf_counter() - s
+
+        n_examples = 0
+        s = time.perf_counter()
+        for split_generator in split_generators:
+            for _ in builder._generate_examples(**split_generator.gen_kwargs):
+                n_examples += 1
+        elapsed = time.perf_counter() - s
+
+        results[data_format] = {
+            'split_generators_seconds': split_elapsed,
+            'seconds': elapsed,
+            'examples_per_sec': n_examples / elapsed,
+            'n_examples': n_examples,
+        }
+
+    return results
+
+
+# the number of entries (rows, images, captions) each stage uses by default
+DEFAULT_SIZES = {
+    'tsv_to_jsonl': 200000,
+    'download': 1000,
+    'hosts': 200,
+    'decode': 60,
+    'normalize': 200000,
+    'translate': 2000,
+    'jsonl_io': 200000,
+    'generate_examples': 200000,
+}
+STAGES = list(DEFAULT_SIZES)
+
+
+def run_stage(stage, work_dir, n_rows, args):
+
+    if stage == 'tsv_to_jsonl':
+        return bench_tsv_to_jsonl(work_dir, n_rows, n_workers=args.n_workers)
+    if stage == 'download':
+        return bench_download(work_dir, n_rows, n_decoders=args.n_workers)
+    if stage == 'hosts':
+        return bench_hosts(work_dir, n_rows)
+    if stage == 'decode':
+        return bench_decode(work_dir, n_rows)
+    if stage == 'normalize':
+        captions = load_captions(args.input, n_rows) if args.input else make_synthetic_captions(n_rows)
+        return bench_normalize(captions)
+    if stage == 'translate':
+        return bench_translate(n_rows)
+    if stage == 'jsonl_io':
+        return bench_jsonl_io(work_dir, n_rows)
+    if stage == 'generate_examples':
+        return bench_generate_examples(work_dir, n_rows)
+
+    raise ValueError(f'unknown stage: {stage}')
+
+
+def print_results(stage, results):
+
+    if stage == 'tsv_to_jsonl':
+        for name, r in results.items():
+            print(f'{name:>24}: {r["rows_per_sec"]:>12.0f} rows/sec  identical={r["identical"]}')
+
+    elif stage == 'download':
+        for name, r in results.items():
+            print(f'{name:>24}: {r["entries_per_sec"]:>12.1f} entries/sec  {r["counts"]}')
+            for key, summary in r['stages'].items():
+                print(
+                    f'{key:>24}: p50 {1000 * summary["p50"]:>8.1f} ms  p95 {1000 * summary["p95"]:>8.1f} ms  '
+                    f'p99 {1000 * summary["p99"]:>8.1f} ms'
+                )
+
+    elif stage == 'hosts':
+        for name, r in results.items():
+            print(f'{name:>24}: {r["entries_per_sec"]:>12.1f} entries/sec  {r["seconds"]:.1f}s')
+            for kind, counts in r['counts'].items():
+                print(f'{kind:>24}: {counts}')
+            if r['hosts'] is not None:
+                print(f'{"":>24}  {r["hosts"]}')
+
+    elif stage == 'decode':
+        for name, r in results.items():
+            print(f'{name:>24}: {r["ms_per_image"]:>8.1f} ms/image  {r["cpu_ms_per_image"]:>8.1f} cpu ms/image')
+
+    elif stage == 'normalize':
+        for name, r in results.items():
+            print(f'{name:>24}: {r["captions_per_sec"]:>12.0f} captions/sec  mismatches={r["mismatches"]}')
+
+    elif stage == 'translate':
+        for name, r in results.items():
+            print(
+                f'{name:>24}: {r["captions_per_sec"]:>12.1f} captions/sec  requests={r["n_requests"]}  '
+                f'mismatches={r["mismatches"]}'
+            )
+
+    elif stage == 'jsonl_io':
+        codec = results['codec']
+        for name, r in results.items():
+            if name == 'codec':
+                continue
+            print(
+                f'{name:>24}: write {r["write_mb_per_sec"]:>8.1f} MB/s  read {r["read_mb_per_sec"]:>8.1f} MB/s  '
+                f'{r["file_mb"]:>8.1f} MB  identical={r["identical"]}  ({codec})'
+            )
+
+    elif stage == 'generate_examples':
+        for name, r in results.items():
+            print(
+                f'{name:>24}: {r["examples_per_sec"]:>12.0f} examples/sec  {r["n_examples"]} examples  '
+                f'split_generators {r["split_generators_seconds"]:.2f}s'
+            )
+
+
+def environment():
+
+    import numpy
+    import PIL
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pandas': pd.__version__,
+        'numpy': numpy.__version__,
+        'pillow': PIL.__version__,
+    }
+
+
+def _throughputs(results, path=()):
+    """`(path, value, higher_is_better)` for each throughput in the nested `results`."""
+
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _throughputs(value, path + (key,))
+        elif isinstance(value, (int, float)) and key.endswith('_per_sec'):
+            yield path + (key,), value, True
+        elif isinstance(value, (int, float)) and key.startswith('ms_per_'):
+            yield path + (key,), value, False
+
+
+def check_failures(results, path=()):
+    """The names of the runs of `results` whose outputs differ from the reference (`mismatches`, `identical`)."""
+
+    failures = []
+    for key, value in results.items():
+        if isinstance(value, dict):
+            failures.extend(check_failures(value, path + (key,)))
+        elif (key == 'mismatches' and value) or (key == 'identical' and value is False):
+            failures.append('.'.join(path + (key,)))
+
+    return failures
+
+
+def compare(baseline, results, tolerance=0.1):
+    """The throughputs of `results` that are more than `tolerance` worse than in `baseline` (both as written by
+    `--output_json`), as `(name, baseline value, value)`."""
+
+    baseline_values = {path: value for path, value, _ in _throughputs(baseline['results'])}
+
+    regressions = []
+    for path, value, higher_is_better in _throughputs(results['results']):
+        if path not in baseline_values or 'stages' in path:
+            # the download stage percentiles are latencies, reported but not compared
+            continue
+        ratio = value / baseline_values[path] if baseline_values[path] else 1.0
+        if (ratio < 1 - tolerance) if higher_is_better else (ratio > 1 + tolerance):
+            regressions.append(('.'.join(path), baseline_values[path], value))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--stage", help="", choices=STAGES + ['all'], default='tsv_to_jsonl')
+    parser.add_argument("--n_rows", help="default: see `DEFAULT_SIZES`", type=int, required=False)
+    parser.add_argument("--n_workers", help="", type=int, default=4)
+    parser.add_argument("--input", help="a CC3M jsonl file to take real captions from", required=False)
+    parser.add_argument("--output_json", help="write the results (and the environment) to this file", required=False)
+    parser.add_argument("--baseline", help="results of a previous run (`--output_json`) to compare to", required=False)
+    parser.add_argument("--tolerance", help="slowdown reported as a regression", type=float, default=0.1)
+
+    args = parser.parse_args()
+
+    stages = STAGES if args.stage == 'all' else [args.stage]
+
+    results = {}
+    for stage in stages:
+        n_rows = args.n_rows or DEFAULT_SIZES[stage]
+        if stage == 'decode':
+            n_rows = min(n_rows, 60)
+        elif stage == 'translate':
+            n_rows = min(n_rows, 2000)
+
+        print(f'{stage} ({n_rows})')
+        with tempfile.TemporaryDirectory() as work_dir:
+            results[stage] = run_stage(stage, work_dir, n_rows, args)
+        print_results(stage, results[stage])
+
+    results = {'time': time.time(), 'args': vars(args), 'environment': environment(), 'results': results}
+
+    if args.output_json:
+        with open(args.output_json, 'w', encoding='UTF-8') as fp:
+            json.dump(results, fp, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, encoding='UTF-8') as fp:
+            baseline = json.load(fp)
+        regressions = compare(baseline, results, tolerance=args.tolerance)
+        for name, baseline_value, value in regressions:
+            print(f'regression: {name} {baseline_value:.4g} -> {value:.4g}')
+        print(f'{len(regressions)} regressions (tolerance {args.tolerance:.0%})')
+
+    # an optimized path that doesn't give the same outputs is a failure, whatever its speed
+    failures = check_failures(results['results'])
+    for name in failures:
+        print(f'failure: {name}')
+
+    sys.exit(1 if failures or (args.baseline and regressions) else 0)
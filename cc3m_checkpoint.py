@@ -0,0 +1,110 @@
+import os
+import json
+import logging
+
+
+def _fsync_dir(dir_path):
+
+    fd = os.open(dir_path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _last_newline_end(path, size):
+    """The offset right after the last `\\n` in the first `size` bytes of `path` (0 if there is none)."""
+
+    block_size = 1 << 16
+    with open(path, 'rb') as fp:
+        end = size
+        while end > 0:
+            start = max(0, end - block_size)
+            fp.seek(start)
+            pos = fp.read(end - start).rfind(b'\n')
+            if pos != -1:
+                return start + pos + 1
+            end = start
+
+    return 0
+
+
+class CheckpointedJsonlWriter:
+    """Append-only jsonl output with crash-safe commits.
+
+    `append` writes the lines at the end of the file and fsyncs it, then records the new committed size in a small
+    commit marker (`<path>.commit`). The marker is written to a temporary file and atomically renamed over the old
+    one, so it always holds the size of a prefix of the file made of complete, durable lines.
+
+    When opening an existing file, anything past the committed size (a torn last line, or a batch whose commit was
+    interrupted) is truncated. A file without a marker (written before markers existed) is truncated after its last
+    complete line.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.marker_path = path + '.commit'
+
+        self.size = self._recover()
+        self._fp = open(path, 'ab')
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def _recover(self):
+
+        if not os.path.isfile(self.path):
+            self._write_marker(0)
+            return 0
+
+        file_size = os.path.getsize(self.path)
+
+        committed = None
+        if os.path.isfile(self.marker_path):
+            with open(self.marker_path, 'r', encoding='UTF-8') as fp:
+                committed = json.load(fp)['size']
+        if committed is None or committed > file_size:
+            if committed is not None:
+                logging.warning(f'{self.path} is shorter than its committed size {committed}')
+            committed = _last_newline_end(self.path, file_size)
+
+        if file_size > committed:
+            logging.info(f'truncating {self.path} from {file_size} to its committed size {committed}')
+            os.truncate(self.path, committed)
+        self._write_marker(committed)
+
+        return committed
+
+    def _write_marker(self, size):
+
+        tmp_path = self.marker_path + '.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as fp:
+            json.dump({'size': size}, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.marker_path)
+        _fsync_dir(os.path.dirname(self.marker_path))
+
+    def append(self, lines):
+        """Durably append `lines` (strings without the trailing newline)."""
+
+        if not lines:
+            return
+
+        data = ''.join(x + '\n' for x in lines).encode('UTF-8')
+        self._fp.write(data)
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+        self.size += len(data)
+        self._write_marker(self.size)
+
+    def close(self):
+
+        self._fp.close()
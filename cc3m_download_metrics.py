@@ -0,0 +1,230 @@
+import json
+import math
+import time
+import bisect
+import argparse
+import threading
+
+
+# the stages of an image download, timed by `DownloadEngine`
+STAGES = [
+    'connect',  # until the response headers are received: DNS, connect, TLS and the server's time to first byte
+    'transfer',  # reading the response body
+    'decode',  # opening the image and decoding it (in draft mode for JPEGs)
+    'resize',
+    'hash',  # perceptual hash (`cc3m_image_hash.py`)
+    'save',  # encoding and writing the image file, in a decode worker
+    'encode',  # encoding the image to JPEG bytes, in a decode worker
+    'store',  # writing the image on the consuming side: tar shard or file
+]
+
+# statuses which aren't a failure of a download
+NOT_FAILED = ('ok', 'duplicate', 'exists', 'skipped')
+
+# histogram buckets: `MIN_SECONDS * 2 ** (i / BUCKETS_PER_OCTAVE)`, so a percentile is within 10% of the exact one
+MIN_SECONDS = 1e-5
+BUCKETS_PER_OCTAVE = 8
+N_BUCKETS = BUCKETS_PER_OCTAVE * 24
+
+
+class Histogram:
+    """Log-scaled histogram of durations (in seconds): constant memory, and `add` is a bisect into fixed bounds."""
+
+    bounds = [MIN_SECONDS * 2 ** (i / BUCKETS_PER_OCTAVE) for i in range(N_BUCKETS)]
+
+    def __init__(self):
+
+        self.counts = [0] * (N_BUCKETS + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.n += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+
+        for idx, count in enumerate(other.counts):
+            self.counts[idx] += count
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """The upper bound of the bucket holding the `p`-th percentile (at most the largest value seen)."""
+
+        if self.n == 0:
+            return None
+
+        rank = max(math.ceil(self.n * p / 100), 1)
+        n_seen = 0
+        for idx, count in enumerate(self.counts):
+            n_seen += count
+            if n_seen >= rank:
+                break
+
+        return min(self.bounds[idx], self.max) if idx < N_BUCKETS else self.max
+
+    def summary(self):
+
+        if self.n == 0:
+            return {'count': 0}
+
+        return {
+            'count': self.n,
+            'mean': self.total / self.n,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class DownloadMetrics:
+    """Per-stage durations and result counts of a `DownloadEngine` run.
+
+    Fetch threads and the consuming side of `run` call `observe`, `add_bytes` and `count` (the decode workers send
+    their timings back with their results). Every `interval` seconds, `maybe_write` appends a snapshot (see
+    `snapshot`) as one JSON line to `path`, and `DownloadEngine.run` writes a last one when it ends.
+
+    Usage:
+
+        metrics = DownloadMetrics('cc3m_train_metrics.jsonl')
+        with DownloadEngine(target_dir, fn_prefix, metrics=metrics) as engine:
+            ...
+    """
+
+    def __init__(self, path=None, interval=10):
+
+        self.path = path
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.counts = {}
+        self.n_bytes = 0
+
+        self.start_time = time.time()
+        self._last_time = self.start_time
+        self._last_counts = {}
+        self._last_n_bytes = 0
+
+        # name -> function returning a dict of counters, added to the snapshots
+        self._counters = {}
+
+    def add_counters(self, name, fn):
+
+        self._counters[name] = fn
+
+    def observe(self, stage, seconds):
+
+        with self._lock:
+            self.stages[stage].add(seconds)
+
+    def observe_many(self, timings):
+        """Observe a dict `stage -> seconds`."""
+
+        with self._lock:
+            for stage, seconds in timings.items():
+                self.stages[stage].add(seconds)
+
+    def add_bytes(self, n_bytes):
+
+        with self._lock:
+            self.n_bytes += n_bytes
+
+    def count(self, status):
+
+        with self._lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+    def snapshot(self):
+        """Counts and stage percentiles since the start, and the throughput and failure rate since the last
+        snapshot."""
+
+        with self._lock:
+            now = time.time()
+            seconds = max(now - self._last_time, 1e-9)
+            interval_counts = {k: v - self._last_counts.get(k, 0) for k, v in self.counts.items()}
+            n_results = sum(interval_counts.values())
+            n_downloaded = sum(interval_counts.get(k, 0) for k in ('ok', 'duplicate'))
+            n_attempted = sum(v for k, v in interval_counts.items() if k not in ('exists', 'skipped'))
+            n_failed = sum(v for k, v in interval_counts.items() if k not in NOT_FAILED)
+
+            snapshot = {
+                'time': now,
+                'elapsed': now - self.start_time,
+                'n_results': sum(self.counts.values()),
+                'counts': dict(self.counts),
+                'n_bytes': self.n_bytes,
+                'interval': {
+                    'seconds': seconds,
+                    'results_per_sec': n_results / seconds,
+                    'downloads_per_sec': n_downloaded / seconds,
+                    'mb_per_sec': (self.n_bytes - self._last_n_bytes) / seconds / 1e6,
+                    'failure_rate': n_failed / n_attempted if n_attempted else 0.0,
+                },
+                'stages': {stage: histogram.summary() for stage, histogram in self.stages.items() if histogram.n},
+            }
+
+            self._last_time = now
+            self._last_counts = dict(self.counts)
+            self._last_n_bytes = self.n_bytes
+
+        for name, fn in self._counters.items():
+            snapshot[name] = fn()
+
+        return snapshot
+
+    def write(self):
+
+        snapshot = self.snapshot()
+        if self.path is not None:
+            with open(self.path, 'a', encoding='UTF-8') as fp:
+                fp.write(json.dumps(snapshot) + '\n')
+
+        return snapshot
+
+    def maybe_write(self):
+        """`write` if the last snapshot is more than `interval` seconds old."""
+
+        if time.time() - self._last_time >= self.interval:
+            return self.write()
+
+
+def print_snapshot(snapshot):
+
+    interval = snapshot['interval']
+    print(
+        f'{snapshot["elapsed"]:.0f}s: {snapshot["n_results"]} results {snapshot["counts"]}, '
+        f'{interval["downloads_per_sec"]:.1f} downloads/sec, {interval["mb_per_sec"]:.2f} MB/sec, '
+        f'{interval["failure_rate"]:.1%} failed'
+    )
+    print(f'{"stage":>10} {"count":>9} {"mean":>9} {"p50":>9} {"p95":>9} {"p99":>9} {"max":>9}  (ms)')
+    for stage, summary in snapshot['stages'].items():
+        values = ' '.join(f'{summary[k] * 1000:>9.1f}' for k in ('mean', 'p50', 'p95', 'p99', 'max'))
+        print(f'{stage:>10} {summary["count"]:>9} {values}')
+    if 'hosts' in snapshot:
+        print(f'hosts: {snapshot["hosts"]}')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--metrics_fn", help="metrics file written by `cc3m_image_downloader.py --metrics`", required=True)
+    parser.add_argument("--all", help="show every snapshot, not only the last one", action='store_true')
+
+    args = parser.parse_args()
+
+    with open(args.metrics_fn, encoding='UTF-8') as fp:
+        snapshots = [json.loads(line) for line in fp if line.strip()]
+
+    for snapshot in snapshots if args.all else snapshots[-1:]:
+        print_snapshot(snapshot)
+        print('-' * 120)
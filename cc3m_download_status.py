@@ -0,0 +1,169 @@
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+
+
+# download statuses
+OK = 'ok'
+HTTP_ERROR = 'http_error'
+TIMEOUT = 'timeout'
+CONNECTION_ERROR = 'connection_error'
+DECODE_ERROR = 'decode_error'
+ERROR = 'error'
+# a copy of an image already downloaded (see `cc3m_image_hash.py`), not stored
+DUPLICATE = 'duplicate'
+# not requested, the host failed too often recently (see `cc3m_host_policy.py`)
+CIRCUIT_OPEN = 'circuit_open'
+
+StatusRecord = namedtuple('StatusRecord', ['image_id', 'status', 'http_status', 'attempts', 'last_try', 'error'])
+
+
+class RetryPolicy:
+    """Decides whether an entry should be (re-)downloaded given its `StatusRecord` (or `None` if never tried).
+
+    Successful downloads, duplicates, images that can't be decoded and HTTP errors in `permanent_http_statuses` are
+    never retried. Other failures (timeouts, connection errors, 429/5xx, ...) are retried at most `max_attempts` times in
+    total, and not before `retry_after` seconds have passed since the last try.
+    """
+
+    def __init__(
+            self, max_attempts=3, retry_after=3600,
+            permanent_http_statuses=(400, 401, 403, 404, 405, 406, 410, 414, 451)):
+
+        self.max_attempts = max_attempts
+        self.retry_after = retry_after
+        self.permanent_http_statuses = set(permanent_http_statuses)
+
+    def is_permanent(self, record):
+
+        if record.status in (OK, DUPLICATE, DECODE_ERROR):
+            return True
+        if record.status == HTTP_ERROR and record.http_status in self.permanent_http_statuses:
+            return True
+
+        return record.attempts >= self.max_attempts
+
+    def should_download(self, record, now=None):
+
+        if record is None:
+            return True
+        if self.is_permanent(record):
+            return False
+
+        now = time.time() if now is None else now
+        return now - record.last_try >= self.retry_after
+
+
+class DownloadStatusStore:
+    """SQLite-backed download status, keyed by `image_id`.
+
+    Writes are buffered and committed every `commit_every` records (and on `flush`/`close`). The connection is
+    shared between threads and guarded by a lock, so the engine can look statuses up from its producer thread while
+    recording results from the consumer side.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS download_status (
+            image_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            http_status INTEGER,
+            attempts INTEGER NOT NULL,
+            last_try REAL NOT NULL,
+            error TEXT
+        )
+    """
+
+    _UPSERT = """
+        INSERT INTO download_status (image_id, status, http_status, attempts, last_try, error)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(image_id) DO UPDATE SET
+            status = excluded.status,
+            http_status = excluded.http_status,
+            attempts = download_status.attempts + excluded.attempts,
+            last_try = excluded.last_try,
+            error = excluded.error
+    """
+
+    # stay well below SQLite's limit on the number of host parameters
+    _LOOKUP_BATCH_SIZE = 500
+
+    def __init__(self, path, commit_every=1000):
+
+        self.path = path
+        self.commit_every = commit_every
+
+        self._lock = threading.Lock()
+        self._pending = []
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(self._SCHEMA)
+        self._conn.commit()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def lookup(self, image_ids):
+        """Returns a dict `image_id -> StatusRecord` for the ids that have a status."""
+
+        image_ids = list(image_ids)
+        records = {}
+
+        with self._lock:
+            self._flush()
+            for idx in range(0, len(image_ids), self._LOOKUP_BATCH_SIZE):
+                batch = image_ids[idx:idx + self._LOOKUP_BATCH_SIZE]
+                rows = self._conn.execute(
+                    'SELECT image_id, status, http_status, attempts, last_try, error FROM download_status '
+                    f'WHERE image_id IN ({",".join("?" * len(batch))})',
+                    batch
+                )
+                for row in rows:
+                    records[row[0]] = StatusRecord(*row)
+
+        return records
+
+    def get(self, image_id):
+
+        return self.lookup([image_id]).get(image_id)
+
+    def record(self, image_id, status, http_status=None, error=None, attempted=True, now=None):
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            self._pending.append((image_id, status, http_status, int(attempted), now, error))
+            if len(self._pending) >= self.commit_every:
+                self._flush()
+
+    def counts(self):
+        """Returns a dict `status -> number of entries`."""
+
+        with self._lock:
+            self._flush()
+            return dict(self._conn.execute('SELECT status, COUNT(*) FROM download_status GROUP BY status'))
+
+    def _flush(self):
+
+        if self._pending:
+            self._conn.executemany(self._UPSERT, self._pending)
+            self._conn.commit()
+            self._pending = []
+
+    def flush(self):
+
+        with self._lock:
+            self._flush()
+
+    def close(self):
+
+        with self._lock:
+            self._flush()
+            self._conn.close()
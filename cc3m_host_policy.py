@@ -0,0 +1,201 @@
+import time
+import random
+import threading
+from urllib.parse import urlsplit
+
+import cc3m_download_status as download_status
+
+
+# HTTP statuses worth retrying: the host is overloaded or failing, not the url
+TRANSIENT_HTTP_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def host_of(url):
+
+    return urlsplit(url).netloc.lower()
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, host, retry_in):
+
+        super().__init__(f'circuit open for {host}, retrying in {retry_in:.0f}s')
+        self.host = host
+
+
+class HostState:
+
+    def __init__(self, timeout):
+
+        # smoothed latency and its deviation, as for TCP's retransmission timeout (RFC 6298)
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = timeout
+
+        self.consecutive_failures = 0
+        self.open_until = None
+        self.trial_in_flight = False
+
+        self.n_requests = 0
+        self.n_ok = 0
+        self.n_failures = 0
+        self.n_retries = 0
+        self.n_fast_fails = 0
+        self.n_opened = 0
+
+
+class HostPolicy:
+    """Per-host timeouts, retries and circuit breaking for `DownloadEngine`.
+
+    - the timeout of a host is learned from its latencies (`srtt + 4 * rttvar`, within `[min_timeout, max_timeout]`),
+      starting at `timeout`, and doubled when a request times out, until a request succeeds again.
+    - timeouts, connection errors and `TRANSIENT_HTTP_STATUSES` are retried up to `max_retries` times, after a
+      random delay of up to `backoff * 2 ** attempt` seconds (full jitter).
+    - after `failure_threshold` of these failures in a row, the circuit of the host opens: its urls fail at once
+      (`CircuitOpenError`) for `cooldown` seconds. Then a single trial request is let through, which closes the
+      circuit if it succeeds and opens it again otherwise. Timeouts only count once the timeout of the host is
+      `max_timeout`, so that a slow host gets a longer timeout rather than an open circuit.
+
+    Other HTTP errors (404, ...) show the host is alive, they count as successes for the circuit.
+    """
+
+    def __init__(
+            self, timeout=2, min_timeout=1, max_timeout=10, max_retries=2, backoff=0.5, failure_threshold=5,
+            cooldown=300):
+
+        self.default_timeout = timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _state(self, host):
+
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = HostState(self.default_timeout)
+
+        return state
+
+    def before_request(self, host, now=None):
+        """The timeout to use for a request to `host`. Raises `CircuitOpenError` if its circuit is open."""
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            state = self._state(host)
+            if state.open_until is not None:
+                if now < state.open_until or state.trial_in_flight:
+                    state.n_fast_fails += 1
+                    raise CircuitOpenError(host, max(state.open_until - now, 0))
+                # half-open: this request is the trial
+                state.trial_in_flight = True
+            state.n_requests += 1
+
+            return state.timeout
+
+    def _sample(self, state, seconds):
+
+        if state.srtt is None:
+            state.srtt, state.rttvar = seconds, seconds / 2
+        else:
+            state.rttvar = 0.75 * state.rttvar + 0.25 * abs(state.srtt - seconds)
+            state.srtt = 0.875 * state.srtt + 0.125 * seconds
+        state.timeout = min(max(state.srtt + 4 * state.rttvar, self.min_timeout), self.max_timeout)
+
+    def _close(self, state):
+
+        state.consecutive_failures = 0
+        state.open_until = None
+        state.trial_in_flight = False
+
+    def on_success(self, host, seconds):
+
+        with self._lock:
+            state = self._state(host)
+            state.n_ok += 1
+            self._sample(state, seconds)
+            self._close(state)
+
+    def on_failure(self, host, status, http_status=None, seconds=None, timeout=None, now=None):
+        """Record a failed request to `host` (made with `timeout`), returns whether it is worth retrying."""
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            state = self._state(host)
+            state.n_failures += 1
+
+            if status == download_status.HTTP_ERROR and http_status not in TRANSIENT_HTTP_STATUSES:
+                # the host answered
+                if seconds is not None:
+                    self._sample(state, seconds)
+                self._close(state)
+                return False
+            if status not in (download_status.TIMEOUT, download_status.CONNECTION_ERROR, download_status.HTTP_ERROR):
+                # an invalid url, a redirect loop, ...
+                state.trial_in_flight = False
+                return False
+
+            if status == download_status.TIMEOUT and (timeout is None or timeout < self.max_timeout):
+                # the requests in flight with the same timeout don't double it again
+                if timeout is None or timeout >= state.timeout:
+                    state.timeout = min(2 * (timeout or state.timeout), self.max_timeout)
+                if not state.trial_in_flight:
+                    return True
+            state.consecutive_failures += 1
+            if state.trial_in_flight or state.consecutive_failures >= self.failure_threshold:
+                if state.open_until is None or state.trial_in_flight:
+                    state.n_opened += 1
+                state.open_until = now + self.cooldown
+                state.trial_in_flight = False
+                return False
+
+            return True
+
+    def retry_delay(self, host, attempt):
+        """The delay before retry number `attempt` (from 0) of a request to `host`."""
+
+        with self._lock:
+            self._state(host).n_retries += 1
+
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def stats(self, now=None):
+        """Counters summed over the hosts."""
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            states = list(self._hosts.values())
+
+            return {
+                'n_hosts': len(states),
+                'n_requests': sum(x.n_requests for x in states),
+                'n_ok': sum(x.n_ok for x in states),
+                'n_failures': sum(x.n_failures for x in states),
+                'n_retries': sum(x.n_retries for x in states),
+                'n_fast_fails': sum(x.n_fast_fails for x in states),
+                'n_circuits_opened': sum(x.n_opened for x in states),
+                'n_open_circuits': sum(1 for x in states if x.open_until is not None and now < x.open_until),
+            }
+
+    def host_stats(self, n_hosts=10):
+        """The counters and timeout of the `n_hosts` hosts with the most failures and fast fails."""
+
+        with self._lock:
+            hosts = sorted(self._hosts.items(), key=lambda x: x[1].n_failures + x[1].n_fast_fails, reverse=True)
+
+            return {
+                host: {
+                    'timeout': state.timeout, 'srtt': state.srtt, 'n_requests': state.n_requests, 'n_ok': state.n_ok,
+                    'n_failures': state.n_failures, 'n_retries': state.n_retries,
+                    'n_fast_fails': state.n_fast_fails, 'n_opened': state.n_opened,
+                }
+                for host, state in hosts[:n_hosts]
+            }
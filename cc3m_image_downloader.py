@@ -1,21 +1,32 @@
 import sys
 import os
+import io
+import time
+import queue
+import itertools
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from datetime import datetime
 from urllib.request import urlopen
 import requests
+from urllib3.exceptions import ReadTimeoutError
 from PIL import Image
-from torchvision.transforms import functional as TF
-from multiprocessing import Pool
 import logging
 import json
-import shutil
-from pathlib import Path
+import argparse
+
+import cc3m_download_status as download_status
+from cc3m_tar_shards import TarShardWriter
+from cc3m_image_index import write_image_manifest
+from cc3m_image_hash import ImageHashIndex, dhash
+from cc3m_download_metrics import DownloadMetrics
+from cc3m_host_policy import CircuitOpenError, HostPolicy, host_of
+from cc3m_jsonl_io import COMPRESSED_SUFFIXES, dumps, iter_entries
 
 # Setup
-tmp_dir = './tmp/'
 log_fn = 'cc3m_image_download.log'
-if not os.path.isdir(tmp_dir):
-    os.makedirs(tmp_dir, exist_ok=True)
 
 logging.basicConfig(filename=os.path.join(log_fn), filemode='w', level=logging.INFO)
 requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
@@ -23,15 +34,128 @@ requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.
 MAX_IMAGE_SIZE = 512
 
 
+def target_size(size, max_size=MAX_IMAGE_SIZE):
+    """The size of an image of `size` once its shorter side is resized to `max_size` (same as torchvision's
+    `resize` with an int `size`)."""
+
+    w, h = size
+    if w <= h:
+        return max_size, int(max_size * h / w)
+
+    return int(max_size * w / h), max_size
+
+
+class ImageOutput(namedtuple('ImageOutput', ['size', 'format', 'quality', 'progressive'])):
+    """An image written for each download: its shorter side capped at `size`, encoded as `format` (`JPEG` or
+    `WEBP`) with `quality` (PIL's default if `None`)."""
+
+    extensions = {'JPEG': 'jpg', 'WEBP': 'webp'}
+
+    @classmethod
+    def parse(cls, spec):
+        """`<size>[:<format>[:<quality>[:progressive]]]`, e.g. `384`, `256:webp:80` or `512:jpeg:90:progressive`."""
+
+        parts = spec.split(':')
+        image_format = parts[1].upper() if len(parts) > 1 else 'JPEG'
+        image_format = 'JPEG' if image_format == 'JPG' else image_format
+        if image_format not in cls.extensions:
+            raise ValueError(f'unsupported image format: {parts[1]}')
+        quality = int(parts[2]) if len(parts) > 2 and parts[2] else None
+        progressive = len(parts) > 3 and parts[3] == 'progressive'
+
+        return cls(int(parts[0]), image_format, quality, progressive)
+
+    @property
+    def extension(self):
+
+        return self.extensions[self.format]
+
+    def save_kwargs(self):
+
+        kwargs = {'format': self.format}
+        if self.quality is not None:
+            kwargs['quality'] = self.quality
+        if self.progressive:
+            kwargs['progressive'] = True
+
+        return kwargs
+
+
+DEFAULT_OUTPUTS = (ImageOutput(MAX_IMAGE_SIZE, 'JPEG', None, False),)
+
+
+def output_path(f_path, idx, output):
+    """The path of the output number `idx`: `f_path` for the first one (the one the dataset builder reads),
+    otherwise the same file name in the directory `<directory of f_path>_<size>`."""
+
+    if idx == 0:
+        return f_path
+
+    dir_name, fn = os.path.split(f_path)
+
+    return os.path.join(f'{dir_name}_{output.size}', f'{os.path.splitext(fn)[0]}.{output.extension}')
+
+
+def output_key(idx, output):
+    """The extension of the output number `idx` in a tar shard sample: `jpg` for the first one, `<size>.<ext>`
+    otherwise."""
+
+    return 'jpg' if idx == 0 else f'{output.size}.{output.extension}'
+
+
 # Resize function
-def resize(img):
+def resize(img, max_size=MAX_IMAGE_SIZE):
 
-    if min(img.size) > MAX_IMAGE_SIZE:
-        img = TF.resize(img, size=MAX_IMAGE_SIZE, interpolation=Image.LANCZOS)
+    if min(img.size) > max_size:
+        # `reducing_gap` lets PIL first `reduce()` by an integer factor, then do the LANCZOS resampling on the
+        # smaller image.
+        img = img.resize(target_size(img.size, max_size), resample=Image.LANCZOS, reducing_gap=3.0)
 
     return img
 
 
+def decode(content, timings=None, max_size=MAX_IMAGE_SIZE):
+    """Decode an image from bytes into an RGB image no larger than needed.
+
+    For JPEGs, draft mode lets the decoder scale down by 1/2, 1/4 or 1/8 while decoding, to the smallest size that
+    is still at least the `max_size` target, so the full resolution image is never materialized.
+
+    The durations of the `decode` and `resize` stages are added to the dict `timings` if one is given.
+    """
+
+    s = time.perf_counter()
+    image = Image.open(io.BytesIO(content))
+    if image.format == 'JPEG' and min(image.size) > max_size:
+        image.draft('RGB', target_size(image.size, max_size))
+    image = image.convert('RGB')
+
+    t = time.perf_counter()
+    image = resize(image, max_size)
+    if timings is not None:
+        timings['decode'] = t - s
+        timings['resize'] = time.perf_counter() - t
+
+    return image
+
+
+def decode_outputs(content, outputs=DEFAULT_OUTPUTS, timings=None):
+    """Decode `content` once, for the largest size of `outputs`, then downscale it successively to the smaller
+    sizes. Returns one image per output."""
+
+    sizes = sorted({x.size for x in outputs}, reverse=True)
+    img = decode(content, timings, max_size=sizes[0])
+
+    s = time.perf_counter()
+    images = {sizes[0]: img}
+    for size in sizes[1:]:
+        # from the previous (smallest so far) image
+        img = images[size] = resize(img, size)
+    if timings is not None:
+        timings['resize'] += time.perf_counter() - s
+
+    return [images[x.size] for x in outputs]
+
+
 def process(entry, target_dir, fn_prefix):
 
     image_id, image_url = entry['image_id'], entry['image_url']
@@ -40,77 +164,607 @@ def process(entry, target_dir, fn_prefix):
 
         fn = f'{fn_prefix}_{image_id:08d}.jpg'  # create filename
         f_path = os.path.join(target_dir, fn)  # concat to get filepath
-        f_path_temp = Path(os.path.join(tmp_dir, fn))
 
         if not os.path.isfile(f_path):
+            content = fetch(requests, image_url, timeout=2)
+            decode_and_save(content, f_path)
 
-            req = requests.get(image_url, stream=True, timeout=2, verify=False)
+    except Exception as e:
+        log_failure(entry, e)
 
-            # Set decode_content value to True, otherwise the downloaded image file's size will be zero.
-            req.raw.decode_content = True
 
-            # check status
-            assert req.status_code == 200, "status != 200"
+def log_failure(entry, e):
 
-            # Open a local file with wb (write binary) permission.
-            with open(f_path_temp, 'wb') as fp:
-                shutil.copyfileobj(req.raw, fp)
+    logging.error(f"image_id: {entry['image_id']}")
+    logging.error(entry['image_url'])
+    logging.error(" ".join(repr(e).splitlines()))
+    logging.error("=" * 8)
 
-            with Image.open(f_path_temp).convert('RGB') as image:
-                img = resize(image)  # resize PIL image
-                img.save(f_path)  # save PIL image
 
-            try:
-                f_path_temp.unlink()
-            except FileNotFoundError:
-                pass
+class HTTPStatusError(Exception):
 
-    except Exception as e:
-        try:
-            f_path_temp.unlink()
-        except FileNotFoundError:
-            pass
-        logging.error(f"image_id: {entry['image_id']}")
-        logging.error(image_url)
-        logging.error(" ".join(repr(e).splitlines()))
-        logging.error("=" * 8)
+    def __init__(self, status_code):
 
+        super().__init__(f'status {status_code} != 200')
+        self.status_code = status_code
 
-if __name__ == '__main__':
 
-    split = 'train'
+def fetch(session, image_url, timeout=2, timings=None):
 
-    image_root_dir = './cc3m_images/'
-    fn_prefix = f'cc3m_{split}'
+    s = time.perf_counter()
+    # `stream` returns once the headers are received, so the `connect` and `transfer` stages can be told apart
+    req = session.get(image_url, timeout=timeout, verify=False, stream=True)
+    t = time.perf_counter()
+    content = req.content
+    if timings is not None:
+        timings['connect'] = t - s
+        timings['transfer'] = time.perf_counter() - t
 
-    n_processes = 32
-    buf_size_per_proc = 1000
+    # check status
+    if req.status_code != 200:
+        raise HTTPStatusError(req.status_code)
 
-    buf_size = buf_size_per_proc * n_processes
-    buf = []
+    return content
 
 
-    target_dir = os.path.join(image_root_dir, fn_prefix)
+def _is_read_timeout(e):
+    """Whether `e` is caused by a read timeout: when the body stalls after the headers, `requests` raises a
+    `ConnectionError` (or a `ChunkedEncodingError`) wrapping urllib3's `ReadTimeoutError`, not a `Timeout`."""
 
-    if not os.path.isdir(target_dir):
-        os.makedirs(target_dir, exist_ok=True)
+    seen = set()
+    errors = [e]
+    while errors:
+        error = errors.pop()
+        if id(error) in seen:
+            continue
+        seen.add(id(error))
+        if isinstance(error, (ReadTimeoutError, TimeoutError)):
+            return True
+        errors.extend(x for x in error.args if isinstance(x, BaseException))
+        errors.extend(x for x in (error.__cause__, error.__context__) if x is not None)
 
-    cc3m_jsonl_file_path = f'./cc3m_{split}.jsonl'
+    return False
+
+
+def classify_fetch_error(e):
+    """Returns `(status, http_status)` for an exception raised by `fetch`."""
+
+    if isinstance(e, HTTPStatusError):
+        return download_status.HTTP_ERROR, e.status_code
+    if isinstance(e, CircuitOpenError):
+        return download_status.CIRCUIT_OPEN, None
+    if isinstance(e, requests.Timeout):
+        return download_status.TIMEOUT, None
+    if isinstance(e, (requests.ConnectionError, requests.exceptions.ChunkedEncodingError)) and _is_read_timeout(e):
+        return download_status.TIMEOUT, None
+    if isinstance(e, requests.ConnectionError):
+        return download_status.CONNECTION_ERROR, None
+
+    return download_status.ERROR, None
+
+
+def _hash(img, with_hash, timings):
+
+    if not with_hash:
+        return None
+
+    s = time.perf_counter()
+    h = dhash(img)
+    if timings is not None:
+        timings['hash'] = time.perf_counter() - s
+
+    return h
+
+
+def decode_and_save(content, f_path, with_hash=False, timings=None, outputs=DEFAULT_OUTPUTS):
+    """Save each of `outputs` (see `output_path`). Returns the perceptual hash of the image if `with_hash`."""
 
-    with open(cc3m_jsonl_file_path, 'r', encoding='UTF-8') as fp:
+    images = decode_outputs(content, outputs, timings)  # decode and resize PIL images
+    s = time.perf_counter()
+    # the first output last: its file marks the image as done
+    for idx in reversed(range(len(outputs))):
+        images[idx].save(output_path(f_path, idx, outputs[idx]), **outputs[idx].save_kwargs())  # save PIL image
+    if timings is not None:
+        timings['save'] = time.perf_counter() - s
 
-        for line in fp:
+    return _hash(images[0], with_hash, timings)
 
-            entry = json.loads(line)
-            buf.append((entry, target_dir, fn_prefix))
 
-            if len(buf) >= buf_size:
+def decode_and_encode(content, with_hash=False, timings=None, outputs=DEFAULT_OUTPUTS):
+    """Returns the encoded bytes of each of `outputs`, and the perceptual hash of the image (or `None`)."""
 
-                with Pool(n_processes) as p:
-                    r = p.starmap(process, buf)
-                    buf = []
+    images = decode_outputs(content, outputs, timings)  # decode and resize PIL images
+    s = time.perf_counter()
+    contents = []
+    for img, output in zip(images, outputs):
+        buf = io.BytesIO()
+        img.save(buf, **output.save_kwargs())
+        contents.append(buf.getvalue())
+    if timings is not None:
+        timings['encode'] = time.perf_counter() - s
 
-        if len(buf) > 0:
-            with Pool(n_processes) as p:
-                r = p.starmap(process, buf)
-                buf = []
+    return contents, _hash(images[0], with_hash, timings)
+
+
+def decode_task(content, f_path=None, with_hash=False, timed=False, outputs=DEFAULT_OUTPUTS):
+    """Runs in a decode worker of `DownloadEngine`: `decode_and_save` to `f_path`, or `decode_and_encode` if it is
+    `None`. Returns `(contents, hash, timings)`: the encoded outputs (`None` once saved), the perceptual hash (or
+    `None`) and the stage durations (`None` unless `timed`)."""
+
+    timings = {} if timed else None
+    if f_path is None:
+        contents, h = decode_and_encode(content, with_hash, timings, outputs)
+    else:
+        contents, h = None, decode_and_save(content, f_path, with_hash, timings, outputs)
+
+    return contents, h, timings
+
+
+def write_file(f_path, content):
+
+    with open(f_path + '.tmp', 'wb') as fp:
+        fp.write(content)
+    os.replace(f_path + '.tmp', f_path)
+
+
+# marks the end of the input entries in the result queue
+_END = object()
+
+
+class DownloadEngine:
+    """Long-lived download engine.
+
+    HTTP fetches run on `n_fetchers` threads, each with its own keep-alive `requests.Session`. The CPU-bound
+    decode/resize/save runs on a fixed process pool of `n_decoders` workers, created once for the whole run. Entries
+    are fed through a bounded queue (backpressure on the input iterator) and results are yielded as soon as they are
+    ready, in no particular order, so one slow URL only holds up its own fetcher thread.
+
+    If a `DownloadStatusStore` is given, every result is recorded in it, and entries are looked up there before
+    anything else: finished entries and failures that `retry_policy` won't retry are skipped without touching the
+    filesystem. Entries without a record fall back to checking whether the image file exists.
+
+    If a `TarShardWriter` is given, images are not written as individual files under `target_dir`: each image is
+    packed with its entry as JSON (caption, translations, ...) into the current tar shard. Shard writes happen on the
+    consuming side of `run`, one at a time. An image only counts as done (`ok` in the status store, `exists` on a
+    later run) once its shard is committed.
+
+    If an `ImageHashIndex` is given, the perceptual hash of each image is computed by the decode workers and added
+    to it, and results have the `canonical_id` of the image (the first one downloaded with the same hash). With
+    `skip_duplicates`, an image with another canonical image is not stored, and gets the status `duplicate`.
+
+    If a `DownloadMetrics` is given, the stages of each download (see `cc3m_download_metrics.STAGES`) are timed, and
+    its snapshots are written while running and at the end.
+
+    Each image is written once per `ImageOutput` of `outputs`, all made from a single decode in the same worker
+    (see `decode_outputs`). The first output is the one the dataset builder reads, the others go to
+    `<target_dir>_<size>` (or to `<size>.<ext>` members of the tar shards).
+
+    If a `HostPolicy` is given, it sets the timeout of each request (instead of `timeout`), retries transient errors
+    and fails the urls of hosts with an open circuit at once (status `circuit_open`, retried on a later run).
+
+    Usage:
+
+        with DownloadEngine(target_dir, fn_prefix) as engine:
+            for result in engine.run(entries):
+                ...
+
+    Each result is a dict with the keys `image_id`, `image_url`, `status`, `http_status`, `error` and
+    `canonical_id`. `status` is `exists`, `skipped` or one of the statuses in `cc3m_download_status`.
+    """
+
+    # number of entries looked up in the status store at once
+    lookup_batch_size = 512
+
+    def __init__(
+            self, target_dir, fn_prefix, n_fetchers=64, n_decoders=None, queue_size=1024, timeout=2,
+            status_store=None, retry_policy=None, shard_writer=None, hash_index=None, skip_duplicates=False,
+            metrics=None, host_policy=None, outputs=DEFAULT_OUTPUTS):
+
+        self.target_dir = target_dir
+        self.fn_prefix = fn_prefix
+        self.n_fetchers = n_fetchers
+        self.n_decoders = n_decoders or os.cpu_count()
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.status_store = status_store
+        self.retry_policy = retry_policy or download_status.RetryPolicy()
+        self.shard_writer = shard_writer
+        self.hash_index = hash_index
+        self.skip_duplicates = skip_duplicates
+        assert hash_index is not None or not skip_duplicates, "`skip_duplicates` needs a `hash_index`"
+        self.metrics = metrics
+        self.host_policy = host_policy
+        if metrics is not None and host_policy is not None:
+            metrics.add_counters('hosts', host_policy.stats)
+        self.outputs = tuple(outputs)
+        assert self.outputs[0].format == 'JPEG', 'the first output should be a JPEG, the dataset builder reads it'
+        if shard_writer is None:
+            for idx, output in enumerate(self.outputs[1:], start=1):
+                os.makedirs(os.path.dirname(output_path(os.path.join(target_dir, 'x.jpg'), idx, output)), exist_ok=True)
+
+        self._done_ids = None
+        self._decode_pool = None
+        self._local = threading.local()
+
+    def __enter__(self):
+
+        self._decode_pool = ProcessPoolExecutor(self.n_decoders)
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def close(self):
+
+        if self._decode_pool is not None:
+            self._decode_pool.shutdown(wait=True, cancel_futures=True)
+            self._decode_pool = None
+
+    def _session(self):
+
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=4)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+
+        return session
+
+    def _key(self, entry):
+
+        return f"{self.fn_prefix}_{entry['image_id']:08d}"
+
+    def _file_path(self, entry):
+
+        return os.path.join(self.target_dir, f"{self._key(entry)}.jpg")
+
+    def _exists(self, entry):
+
+        if self.skip_duplicates and self.hash_index.canonical_id(entry['image_id']) not in (None, entry['image_id']):
+            # a duplicate found on a previous run, it isn't stored
+            return True
+        if self.shard_writer is not None:
+            return entry['image_id'] in self._done_ids
+
+        return os.path.isfile(self._file_path(entry))
+
+    @staticmethod
+    def _result(entry, status, error=None, http_status=None, canonical_id=None):
+
+        if error is not None:
+            log_failure(entry, error)
+            error = " ".join(repr(error).splitlines())
+
+        return {
+            'image_id': entry['image_id'], 'image_url': entry['image_url'], 'status': status,
+            'http_status': http_status, 'error': error, 'canonical_id': canonical_id
+        }
+
+    def _iter_to_download(self, entries, results):
+        """Yields the entries to download, and puts a result for every other entry."""
+
+        if self.status_store is None:
+            for entry in entries:
+                if self._exists(entry):
+                    results.put(self._result(entry, 'exists'))
+                else:
+                    yield entry
+            return
+
+        now = time.time()
+        batch = []
+        for entry in itertools.chain(entries, [None]):
+
+            if entry is not None:
+                batch.append(entry)
+                if len(batch) < self.lookup_batch_size:
+                    continue
+            if not batch:
+                break
+
+            records = self.status_store.lookup(x['image_id'] for x in batch)
+            for x in batch:
+                record = records.get(x['image_id'])
+                if record is None and self._exists(x):
+                    results.put(self._result(x, 'exists'))
+                elif record is not None and record.status == download_status.OK:
+                    results.put(self._result(x, 'exists'))
+                elif not self.retry_policy.should_download(record, now=now):
+                    results.put(self._result(x, 'skipped'))
+                else:
+                    yield x
+            batch = []
+
+    def _produce(self, entries, fetch_queue, results, stop):
+
+        n_entries = 0
+
+        def count(entries):
+            nonlocal n_entries
+            for entry in entries:
+                n_entries += 1
+                yield entry
+
+        try:
+            for entry in self._iter_to_download(count(entries), results):
+                while not stop.is_set():
+                    try:
+                        fetch_queue.put(entry, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            results.put(e)
+        finally:
+            if not stop.is_set():
+                for _ in range(self.n_fetchers):
+                    fetch_queue.put(None)
+            results.put((_END, n_entries))
+
+    def _fetch(self, fetch_queue, results, decode_slots, stop):
+
+        while not stop.is_set():
+
+            entry = fetch_queue.get()
+            if entry is None:
+                break
+
+            timings = {} if self.metrics is not None else None
+            try:
+                content = self._fetch_content(entry['image_url'], timings)
+            except Exception as e:
+                status, http_status = classify_fetch_error(e)
+                results.put(self._result(entry, status, e, http_status=http_status))
+                continue
+            if self.metrics is not None:
+                self.metrics.observe_many(timings)
+                self.metrics.add_bytes(len(content))
+
+            # stored by `_store` (once it is known not to be a duplicate), or saved by the worker
+            f_path = None if self.shard_writer is not None or self.skip_duplicates else self._file_path(entry)
+
+            # bound the number of downloaded images waiting for the decode pool
+            decode_slots.acquire()
+            try:
+                future = self._decode_pool.submit(
+                    decode_task, content, f_path, self.hash_index is not None, self.metrics is not None, self.outputs
+                )
+            except Exception as e:
+                decode_slots.release()
+                results.put(self._result(entry, download_status.ERROR, e))
+                continue
+            future.add_done_callback(partial(self._on_decoded, entry, results, decode_slots))
+
+    def _fetch_content(self, image_url, timings):
+
+        if self.host_policy is None:
+            return fetch(self._session(), image_url, timeout=self.timeout, timings=timings)
+
+        host = host_of(image_url)
+        for attempt in itertools.count():
+            timeout = self.host_policy.before_request(host)
+            s = time.perf_counter()
+            try:
+                content = fetch(self._session(), image_url, timeout=timeout, timings=timings)
+            except Exception as e:
+                status, http_status = classify_fetch_error(e)
+                retry = self.host_policy.on_failure(
+                    host, status, http_status, seconds=time.perf_counter() - s, timeout=timeout
+                )
+                if not retry or attempt >= self.host_policy.max_retries:
+                    raise
+                time.sleep(self.host_policy.retry_delay(host, attempt))
+                continue
+            self.host_policy.on_success(host, time.perf_counter() - s)
+
+            return content
+
+    def _on_decoded(self, entry, results, decode_slots, future):
+
+        decode_slots.release()
+        if future.cancelled():
+            return
+
+        e = future.exception()
+        if e is not None:
+            results.put(self._result(entry, download_status.DECODE_ERROR, e))
+        else:
+            results.put((entry, *future.result()))
+
+    def _store(self, entry, contents, image_hash, timings):
+        """Runs on the consuming side of `run`: records the hash of a decoded image, and stores its outputs
+        (`contents`, `None` if the worker saved them) unless it is a skipped duplicate."""
+
+        if timings is not None:
+            self.metrics.observe_many(timings)
+        s = time.perf_counter()
+
+        canonical_id = None
+        if image_hash is not None:
+            canonical_id = self.hash_index.add(entry['image_id'], image_hash)
+            if self.skip_duplicates and canonical_id != entry['image_id']:
+                return self._result(entry, download_status.DUPLICATE, canonical_id=canonical_id)
+
+        if contents is not None and self.shard_writer is not None:
+            files = {'jpg': contents[0], 'json': dumps(entry).encode('UTF-8')}
+            for idx, output in enumerate(self.outputs[1:], start=1):
+                files[output_key(idx, output)] = contents[idx]
+            committed = self.shard_writer.write(self._key(entry), files, entry['image_id'])
+            self._on_committed(committed)
+        elif contents is not None:
+            # the first output last, as in `decode_and_save`
+            for idx in reversed(range(len(self.outputs))):
+                write_file(output_path(self._file_path(entry), idx, self.outputs[idx]), contents[idx])
+        if contents is not None and self.metrics is not None:
+            self.metrics.observe('store', time.perf_counter() - s)
+
+        return self._result(entry, download_status.OK, canonical_id=canonical_id)
+
+    def _on_committed(self, image_ids):
+
+        self._done_ids.update(image_ids)
+        if self.status_store is not None:
+            for image_id in image_ids:
+                self.status_store.record(image_id, download_status.OK)
+
+    def _record(self, result):
+
+        if result['status'] == 'skipped':
+            return
+        if result['status'] == download_status.OK and self.shard_writer is not None:
+            # recorded when its shard is committed
+            return
+        if result['status'] == 'exists':
+            # found on disk: remember it so the next run doesn't need to check the file again
+            self.status_store.record(result['image_id'], download_status.OK, attempted=False)
+            return
+        if result['status'] == download_status.CIRCUIT_OPEN:
+            # not requested, doesn't use up an attempt
+            self.status_store.record(result['image_id'], result['status'], error=result['error'], attempted=False)
+            return
+
+        self.status_store.record(
+            result['image_id'], result['status'], http_status=result['http_status'], error=result['error']
+        )
+
+    def run(self, entries):
+        """Download `entries` (dicts with `image_id` and `image_url`) and yield one result per entry, unordered."""
+
+        assert self._decode_pool is not None, "`DownloadEngine` should be used as a context manager"
+
+        fetch_queue = queue.Queue(self.queue_size)
+        results = queue.Queue()
+        decode_slots = threading.BoundedSemaphore(2 * self.n_decoders)
+        stop = threading.Event()
+
+        if self.shard_writer is not None:
+            self._done_ids = self.shard_writer.done_ids()
+
+        threads = [threading.Thread(target=self._produce, args=(entries, fetch_queue, results, stop), daemon=True)]
+        for _ in range(self.n_fetchers):
+            threads.append(
+                threading.Thread(target=self._fetch, args=(fetch_queue, results, decode_slots, stop), daemon=True)
+            )
+        for thread in threads:
+            thread.start()
+
+        n_entries = None
+        n_results = 0
+        try:
+            while n_entries is None or n_results < n_entries:
+                result = results.get()
+                if isinstance(result, Exception):
+                    raise result
+                if isinstance(result, tuple) and result[0] is _END:
+                    n_entries = result[1]
+                    continue
+                if isinstance(result, tuple):
+                    result = self._store(*result)
+                n_results += 1
+                if self.status_store is not None:
+                    self._record(result)
+                if self.metrics is not None:
+                    self.metrics.count(result['status'])
+                    self.metrics.maybe_write()
+                yield result
+        finally:
+            stop.set()
+            if self.shard_writer is not None:
+                self._on_committed(self.shard_writer.commit())
+            if self.status_store is not None:
+                self.status_store.flush()
+            if self.hash_index is not None:
+                self.hash_index.flush()
+            if self.metrics is not None:
+                self.metrics.write()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--split", help="", default='train')
+    parser.add_argument("--output_format", help="", choices=['files', 'tar'], default='files')
+    parser.add_argument("--shard_size", help="number of images per tar shard", type=int, default=10000)
+    parser.add_argument("--hash_images", help="index the perceptual hashes of the images", action='store_true')
+    parser.add_argument(
+        "--skip_duplicates", help="don't store the copies of an image (implies --hash_images)", action='store_true'
+    )
+    parser.add_argument("--metrics", help="time the download stages, see `cc3m_download_metrics.py`", action='store_true')
+    parser.add_argument("--metrics_interval", help="seconds between two metrics snapshots", type=float, default=10)
+    parser.add_argument(
+        "--outputs", help="images written for each download, as `<size>[:<format>[:<quality>[:progressive]]]` "
+        "(e.g. 512 384:jpeg:90 256:webp:80), the first one is read by the dataset builder", nargs='+', default=['512']
+    )
+    parser.add_argument("--max_retries", help="retries of a request after a transient error", type=int, default=2)
+    parser.add_argument("--host_cooldown", help="seconds a failing host is skipped for", type=float, default=300)
+
+    args = parser.parse_args()
+
+    split = args.split
+
+    image_root_dir = './cc3m_images/'
+    fn_prefix = f'cc3m_{split}'
+
+    n_fetchers = 64
+    n_decoders = os.cpu_count()
+
+    target_dir = os.path.join(image_root_dir, fn_prefix)
+
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir, exist_ok=True)
+
+    cc3m_jsonl_file_path = f'./cc3m_{split}.jsonl'
+    # or its compressed version (`cc3m_tsv_to_jsonl.py --compression`)
+    for suffix in COMPRESSED_SUFFIXES:
+        if not os.path.isfile(cc3m_jsonl_file_path) and os.path.isfile(cc3m_jsonl_file_path + suffix):
+            cc3m_jsonl_file_path += suffix
+
+    shard_writer = None
+    status_fn = f'{fn_prefix}_status.sqlite'
+    if args.output_format == 'tar':
+        shard_writer = TarShardWriter(os.path.join(image_root_dir, f'{fn_prefix}_shards'), fn_prefix, max_count=args.shard_size)
+        status_fn = f'{fn_prefix}_shards_status.sqlite'
+
+    status_store = download_status.DownloadStatusStore(os.path.join(image_root_dir, status_fn))
+    retry_policy = download_status.RetryPolicy(max_attempts=3, retry_after=3600)
+
+    hash_index = None
+    if args.hash_images or args.skip_duplicates:
+        hash_index = ImageHashIndex(os.path.join(image_root_dir, f'{fn_prefix}_hashes.sqlite'))
+
+    metrics = None
+    if args.metrics:
+        metrics = DownloadMetrics(os.path.join(image_root_dir, f'{fn_prefix}_metrics.jsonl'), interval=args.metrics_interval)
+
+    host_policy = HostPolicy(timeout=2, max_retries=args.max_retries, cooldown=args.host_cooldown)
+
+    counts = {}
+    with status_store, DownloadEngine(
+            target_dir, fn_prefix, n_fetchers=n_fetchers, n_decoders=n_decoders,
+            status_store=status_store, retry_policy=retry_policy, shard_writer=shard_writer,
+            hash_index=hash_index, skip_duplicates=args.skip_duplicates, metrics=metrics,
+            host_policy=host_policy, outputs=[ImageOutput.parse(x) for x in args.outputs]) as engine:
+        for idx, result in enumerate(engine.run(iter_entries(cc3m_jsonl_file_path))):
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+            if (idx + 1) % 10000 == 0:
+                logging.info(f'{idx + 1} entries done: {counts}')
+
+    logging.info(f'all entries done: {counts}')
+    logging.info(f'hosts: {host_policy.stats()}')
+    logging.info(f'most failing hosts: {host_policy.host_stats()}')
+
+    if hash_index is not None:
+        # `image_id` -> the image it is a copy of
+        with open(os.path.join(image_root_dir, f'{fn_prefix}_duplicates.json'), 'w', encoding='UTF-8') as fp:
+            json.dump(hash_index.duplicates(), fp)
+        hash_index.close()
+
+    if shard_writer is None:
+        # lets the dataset builder skip listing the images directory
+        write_image_manifest(target_dir)
@@ -0,0 +1,269 @@
+import os
+import re
+import json
+import sqlite3
+import logging
+import argparse
+import threading
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+
+HASH_SIZE = 8
+# distinct hashes of a band bucket compared pairwise by `ImageHashIndex.clusters`, larger buckets are skipped
+MAX_BUCKET_SIZE = 2000
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    """Difference hash of a PIL image: the signs of the horizontal gradients of a `(hash_size + 1) x hash_size`
+    grayscale thumbnail, as a `hash_size ** 2` bits signed integer (to fit in SQLite)."""
+
+    thumbnail = image.convert('L').resize((hash_size + 1, hash_size), resample=Image.BILINEAR)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+
+    return int(np.packbits(bits).view('>i8')[0])
+
+
+def hamming_distances(h, hashes):
+    """Number of different bits between the hash `h` and each of the (`int64`) `hashes`."""
+
+    # `bitwise_count` counts the bits of the absolute value of signed integers
+    return np.bitwise_count(np.bitwise_xor(hashes, np.int64(h)).view(np.uint64))
+
+
+def _band_keys(hashes, n_bands):
+    """The `n_bands` bands of (about) `64 / n_bands` bits of the `int64` `hashes`: two hashes within `n_bands - 1`
+    bits of each other are equal on at least one band."""
+
+    unsigned = hashes.view(np.uint64)
+    bounds = [64 * band // n_bands for band in range(n_bands + 1)]
+
+    return [
+        (unsigned >> np.uint64(low)) & np.uint64((1 << (high - low)) - 1) for low, high in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+class ImageHashIndex:
+    """Perceptual hashes of the downloaded images in a SQLite database, with the image each one duplicates.
+
+    `add` is called as images are downloaded: an image whose hash is already in the index gets the `canonical_id`
+    of the first image with that hash (its own `image_id` otherwise). Exact hash matches cover re-hosted and
+    re-encoded copies; `clusters` can also group near duplicates (a few different bits) afterwards.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS image_hash (
+            image_id INTEGER PRIMARY KEY,
+            hash INTEGER NOT NULL,
+            canonical_id INTEGER NOT NULL
+        )
+    """
+
+    def __init__(self, path, commit_every=1000):
+
+        self.path = path
+        self.commit_every = commit_every
+
+        self._lock = threading.Lock()
+        self._n_pending = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(self._SCHEMA)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS image_hash_hash ON image_hash (hash)')
+        self._conn.commit()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def add(self, image_id, h):
+        """Record the hash `h` of `image_id`, returns its canonical image id."""
+
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT image_id, canonical_id FROM image_hash WHERE hash = ? ORDER BY image_id LIMIT 1', (h,)
+            ).fetchone()
+            canonical_id = image_id
+            if row is not None and row[0] != image_id:
+                canonical_id = row[1]
+            self._conn.execute(
+                'INSERT OR REPLACE INTO image_hash (image_id, hash, canonical_id) VALUES (?, ?, ?)',
+                (image_id, h, canonical_id)
+            )
+            self._n_pending += 1
+            if self._n_pending >= self.commit_every:
+                self._conn.commit()
+                self._n_pending = 0
+
+        return canonical_id
+
+    def canonical_id(self, image_id):
+        """The canonical image id of `image_id`, or `None` if it isn't in the index."""
+
+        with self._lock:
+            row = self._conn.execute('SELECT canonical_id FROM image_hash WHERE image_id = ?', (image_id,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def duplicates(self):
+        """A dict `image_id -> canonical image id` for the images found to be duplicates when they were added."""
+
+        with self._lock:
+            rows = self._conn.execute('SELECT image_id, canonical_id FROM image_hash WHERE image_id != canonical_id')
+            return dict(rows)
+
+    def hashes(self):
+        """The image ids and hashes, as two `int64` arrays."""
+
+        with self._lock:
+            rows = self._conn.execute('SELECT image_id, hash FROM image_hash ORDER BY image_id').fetchall()
+
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        image_ids, hashes = np.array(rows, dtype=np.int64).T
+
+        return image_ids, hashes
+
+    def clusters(self, max_distance=0, max_bucket_size=MAX_BUCKET_SIZE):
+        """Groups of (at least 2) image ids whose hashes differ by at most `max_distance` bits, largest first.
+
+        Images with the same hash are grouped first, so the near duplicate search runs on the distinct hashes only
+        (blank or placeholder images share one hash). Candidate pairs are then the hashes sharing one of
+        `max_distance + 1` bands of their bits (multi-index hashing: any two hashes within `max_distance` bits share
+        at least one), found by sorting each band; their distances are checked with NumPy and the pairs are merged
+        with a union-find. The hashes of a band bucket are compared pairwise, so buckets of more than
+        `max_bucket_size` distinct hashes are skipped (and logged): the search stays `O(n * max_bucket_size)`.
+
+        The first image of a cluster is its canonical image: the smallest id among the images which were their own
+        canonical image when added (the first downloaded of each hash, the only ones stored with `skip_duplicates`).
+        """
+
+        image_ids, hashes = self.hashes()
+        with self._lock:
+            rows = self._conn.execute('SELECT image_id FROM image_hash WHERE image_id = canonical_id')
+            canonical = {x for x, in rows}
+
+        # one node per distinct hash
+        unique_hashes, hash_idx = np.unique(hashes, return_inverse=True)
+        parents = np.arange(len(unique_hashes))
+
+        def find(idx):
+            while parents[idx] != idx:
+                parents[idx] = parents[parents[idx]]
+                idx = parents[idx]
+            return idx
+
+        bands = _band_keys(unique_hashes, max_distance + 1) if max_distance > 0 else []
+        n_skipped = 0
+        for keys in bands:
+            order = np.argsort(keys, kind='stable')
+            sorted_keys = keys[order]
+            # runs of equal keys
+            starts = np.flatnonzero(np.diff(sorted_keys, prepend=sorted_keys[:1] - 1) != 0)
+            ends = np.append(starts[1:], len(order))
+            for start, end in zip(starts[ends - starts > 1], ends[ends - starts > 1]):
+                if end - start > max_bucket_size:
+                    n_skipped += 1
+                    continue
+                members = order[start:end]
+                for pos, idx in enumerate(members[:-1]):
+                    others = members[pos + 1:]
+                    for other in others[hamming_distances(unique_hashes[idx], unique_hashes[others]) <= max_distance]:
+                        parents[find(other)] = find(idx)
+        if n_skipped:
+            logging.warning(f'{n_skipped} band buckets of more than {max_bucket_size} hashes skipped')
+
+        groups = {}
+        for idx in range(len(image_ids)):
+            groups.setdefault(find(hash_idx[idx]), []).append(int(image_ids[idx]))
+
+        clusters = []
+        for group in groups.values():
+            if len(group) > 1:
+                first = min((x for x in group if x in canonical), default=min(group))
+                clusters.append([first] + sorted(x for x in group if x != first))
+
+        return sorted(clusters, key=len, reverse=True)
+
+    def flush(self):
+
+        with self._lock:
+            self._conn.commit()
+            self._n_pending = 0
+
+    def close(self):
+
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+def _hash_file(path):
+
+    try:
+        with Image.open(path) as image:
+            image.draft('RGB', (HASH_SIZE * 4, HASH_SIZE * 4))
+            return dhash(image)
+    except Exception:
+        return None
+
+
+def hash_image_dir(index, image_dir, n_workers=None):
+    """Add the images already in `image_dir` (named `<prefix>_<image_id>.jpg`) to `index`. Returns the number of
+    images hashed."""
+
+    pattern = re.compile(r'_(\d+)\.jpg$')
+
+    with os.scandir(image_dir) as it:
+        files = [(int(m.group(1)), entry.path) for entry in it for m in [pattern.search(entry.name)] if m]
+    files.sort()
+
+    n_hashed = 0
+    with Pool(n_workers) as p:
+        for (image_id, _), h in zip(files, p.imap(_hash_file, [path for _, path in files], chunksize=64)):
+            if h is not None and index.canonical_id(image_id) is None:
+                index.add(image_id, h)
+                n_hashed += 1
+    index.flush()
+
+    return n_hashed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--index", help="path of the hash index (SQLite)", required=True)
+    parser.add_argument("--image_dir", help="hash the images of this directory first", required=False)
+    parser.add_argument("--n_workers", help="", type=int, default=os.cpu_count())
+    parser.add_argument("--max_distance", help="max. number of different bits between duplicates", type=int, default=0)
+    parser.add_argument("--max_bucket_size", help="larger band buckets aren't searched for near duplicates", type=int, default=MAX_BUCKET_SIZE)
+    parser.add_argument("--output_json", help="write the duplicate clusters to this file", required=False)
+
+    args = parser.parse_args()
+
+    with ImageHashIndex(args.index) as index:
+
+        if args.image_dir:
+            print(f'{hash_image_dir(index, args.image_dir, n_workers=args.n_workers)} images hashed')
+
+        clusters = index.clusters(max_distance=args.max_distance, max_bucket_size=args.max_bucket_size)
+
+    n_duplicates = sum(len(x) - 1 for x in clusters)
+    print(f'{len(clusters)} clusters of duplicates, {n_duplicates} images could be dropped')
+    for cluster in clusters[:10]:
+        print(f'    {len(cluster)} images: {cluster[:10]}')
+
+    if args.output_json:
+        with open(args.output_json, 'w', encoding='UTF-8') as fp:
+            # the first image of a cluster is its canonical image (a stored one)
+            json.dump({'clusters': clusters, 'canonical_ids': {x: c[0] for c in clusters for x in c[1:]}}, fp)
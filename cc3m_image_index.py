@@ -0,0 +1,69 @@
+import os
+import logging
+import argparse
+
+
+MANIFEST_FN = 'manifest.txt'
+
+
+def scan_image_dir(image_dir):
+    """The names of the files in `image_dir`, listed with a single `os.scandir` pass (no `stat` per file on
+    filesystems reporting the file type in the directory entries)."""
+
+    with os.scandir(image_dir) as it:
+        return {entry.name for entry in it if entry.is_file() and entry.name != MANIFEST_FN}
+
+
+def read_image_manifest(path):
+
+    with open(path, 'r', encoding='UTF-8') as fp:
+        return {line.rstrip('\n') for line in fp if line.strip()}
+
+
+def write_image_manifest(image_dir, path=None):
+    """Write the names of the files in `image_dir`, one per line, to `path` (`<image_dir>/manifest.txt` by default)."""
+
+    path = os.path.join(image_dir, MANIFEST_FN) if path is None else path
+    fns = sorted(scan_image_dir(image_dir))
+
+    with open(path + '.tmp', 'w', encoding='UTF-8') as fp:
+        fp.write(''.join(f'{fn}\n' for fn in fns))
+    os.replace(path + '.tmp', path)
+    # the rename changed the mtime of the directory, the manifest must not look older than it (see `image_files`)
+    os.utime(path)
+
+    return len(fns)
+
+
+def image_files(image_dir, manifest=None):
+    """The set of the image file names in `image_dir`, read from the manifest `manifest` if given and up to date,
+    otherwise by scanning the directory. A relative `manifest` is relative to `image_dir`.
+
+    A manifest older than the directory (files were added or removed after it was written, for example by a resumed
+    download) is ignored.
+    """
+
+    if not os.path.isdir(image_dir):
+        return set()
+
+    if manifest is not None:
+        path = os.path.join(image_dir, manifest)
+        if os.path.isfile(path):
+            if os.stat(path).st_mtime_ns >= os.stat(image_dir).st_mtime_ns:
+                return read_image_manifest(path)
+            logging.warning(f'{path} is older than {image_dir}, listing the directory instead')
+
+    return scan_image_dir(image_dir)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--image_dir", help="", required=True)
+    parser.add_argument("--manifest", help="default: <image_dir>/manifest.txt", required=False)
+
+    args = parser.parse_args()
+
+    n_files = write_image_manifest(args.image_dir, args.manifest)
+    print(f'{n_files} image files listed')
@@ -0,0 +1,170 @@
+import os
+import json
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+
+
+INDEX_SUFFIX = '.idx'
+
+_MAGIC = b'CC3MJSONLIDX\x02'
+# file size, file mtime (ns), number of lines, ids stored, ids sorted, ids consecutive
+_HEADER = struct.Struct('<qqq???')
+
+
+def entry_id(entry):
+
+    return entry['_id'] if '_id' in entry else entry['id']
+
+
+def _is_consecutive(ids):
+
+    return len(ids) == 0 or ids[-1] - ids[0] == len(ids) - 1
+
+
+class JsonlIndex:
+    """Byte offsets of the lines of a jsonl file, and the id of each line.
+
+    The index is stored next to the file (`<path>.idx`): a small header with the file size and mtime it was built
+    for, and whether the ids are sorted / consecutive (so loading doesn't go through the ids), then `offsets`
+    (`n_lines + 1` unsigned 64-bit offsets, the last one being the file size) and `ids` (one signed 64-bit id per
+    line) as raw arrays. `load_or_build` rebuilds it, in one pass over the file, when it is missing or
+    doesn't match the file anymore.
+
+    Lookups by id are O(1) when the ids are consecutive (as in `cc3m_train.jsonl`), a binary search when they are
+    sorted, and a dict built on first use otherwise.
+    """
+
+    def __init__(self, path, offsets, ids, ids_sorted=None, ids_consecutive=None):
+
+        self.path = path
+        self.offsets = offsets
+        self.ids = ids
+
+        self._id_to_line = None
+        if ids_sorted is None:
+            ids_sorted = all(ids[idx] < ids[idx + 1] for idx in range(len(ids) - 1))
+        if ids_consecutive is None:
+            ids_consecutive = ids_sorted and _is_consecutive(ids)
+        self.ids_sorted = ids_sorted
+        self.ids_consecutive = ids_consecutive
+
+    def __len__(self):
+
+        return len(self.offsets) - 1
+
+    @staticmethod
+    def index_path(path):
+
+        return path + INDEX_SUFFIX
+
+    @classmethod
+    def build(cls, path):
+
+        offsets = array('Q', [0])
+        ids = array('q')
+
+        offset = 0
+        ids_sorted = True
+        with open(path, 'rb', buffering=1 << 22) as fp:
+            for line in fp:
+                offset += len(line)
+                offsets.append(offset)
+                _id = entry_id(json.loads(line))
+                if ids and _id <= ids[-1]:
+                    ids_sorted = False
+                ids.append(_id)
+
+        return cls(path, offsets, ids, ids_sorted, ids_sorted and _is_consecutive(ids))
+
+    def save(self):
+
+        stat = os.stat(self.path)
+        # several processes (the workers of `cc3m_translation_driver.py`, `num_proc` builds) may save the same index
+        tmp_path = f'{self.index_path(self.path)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(_MAGIC)
+            fp.write(
+                _HEADER.pack(stat.st_size, stat.st_mtime_ns, len(self), True, self.ids_sorted, self.ids_consecutive)
+            )
+            self.offsets.tofile(fp)
+            self.ids.tofile(fp)
+        os.replace(tmp_path, self.index_path(self.path))
+
+    @classmethod
+    def load(cls, path):
+        """The saved index of `path`, or `None` if there is none or it is stale."""
+
+        index_path = cls.index_path(path)
+        if not os.path.isfile(index_path):
+            return None
+
+        stat = os.stat(path)
+        with open(index_path, 'rb') as fp:
+            if fp.read(len(_MAGIC)) != _MAGIC:
+                return None
+            file_size, mtime_ns, n_lines, _, ids_sorted, ids_consecutive = _HEADER.unpack(fp.read(_HEADER.size))
+            if file_size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+                return None
+            offsets = array('Q')
+            offsets.fromfile(fp, n_lines + 1)
+            ids = array('q')
+            ids.fromfile(fp, n_lines)
+
+        return cls(path, offsets, ids, ids_sorted, ids_consecutive)
+
+    @classmethod
+    def load_or_build(cls, path):
+
+        index = cls.load(path)
+        if index is None:
+            index = cls.build(path)
+            index.save()
+
+        return index
+
+    def line_of_id(self, _id):
+        """The line number of the entry with id `_id`, or `None`."""
+
+        if self.ids_consecutive:
+            line = _id - self.ids[0] if len(self.ids) > 0 else -1
+            return line if 0 <= line < len(self) else None
+
+        if self.ids_sorted:
+            line = bisect_left(self.ids, _id)
+            return line if line < len(self) and self.ids[line] == _id else None
+
+        if self._id_to_line is None:
+            self._id_to_line = {x: line for line, x in enumerate(self.ids)}
+
+        return self._id_to_line.get(_id)
+
+    def line_of_min_id(self, inf):
+        """A line from which reading the file finds all the entries with an id `>= inf`: the first such line if the
+        ids are sorted, otherwise the first line."""
+
+        if not self.ids_sorted:
+            return 0
+
+        return bisect_left(self.ids, inf)
+
+    def offset_of_min_id(self, inf):
+        """The offset of `line_of_min_id(inf)`."""
+
+        return self.offsets[self.line_of_min_id(inf)]
+
+    def read_line(self, fp, line):
+        """The bytes of line `line`, read from `fp` (opened in binary mode)."""
+
+        fp.seek(self.offsets[line])
+        return fp.read(self.offsets[line + 1] - self.offsets[line])
+
+    def get(self, fp, _id):
+        """The entry with id `_id` (or `None`), read from `fp` (opened in binary mode)."""
+
+        line = self.line_of_id(_id)
+        if line is None:
+            return None
+
+        return json.loads(self.read_line(fp, line))
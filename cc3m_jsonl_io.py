@@ -0,0 +1,228 @@
+import io
+import os
+import json
+import gzip
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+BUFFER_SIZE = 1 << 22
+# number of bytes of lines read at once by `iter_line_batches`
+BATCH_BYTES = 1 << 20
+
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+
+_encode = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def loads(line):
+    """Decode one jsonl line (`str` or `bytes`), with `orjson` if it is installed.
+
+    `orjson` rejects the `NaN` values `json.dumps` writes for missing captions / urls, such lines are decoded with
+    `json` instead.
+    """
+
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass
+
+    return json.loads(line)
+
+
+def loads_batch(lines):
+    """Decode a list of jsonl lines (`bytes`).
+
+    Without `orjson`, the lines are decoded as one JSON array, which is a single call into the C decoder of `json`
+    instead of one per line.
+    """
+
+    if orjson is not None:
+        return [loads(line) for line in lines]
+
+    try:
+        return json.loads(b'[' + b','.join(lines) + b']')
+    except ValueError:
+        # empty lines, or an invalid line, for which `json.loads` gives the better error
+        return [json.loads(line) for line in lines]
+
+
+def dumps(entry):
+    """Encode one entry as a jsonl line (without the newline), exactly like `json.dumps(entry, ensure_ascii=False)`.
+
+    The output format is part of the data (the jsonl files are compared and merged as text), so the stdlib encoder is
+    always used here.
+    """
+
+    return _encode(entry)
+
+
+def is_compressed(path):
+
+    return path.endswith(COMPRESSED_SUFFIXES)
+
+
+def open_file(path, mode='rb', buffer_size=BUFFER_SIZE):
+    """Open `path` in binary mode (`rb`, `wb` or `ab`) with a large buffer, (de)compressing `.gz` and `.zst` files."""
+
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=6)
+
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError(f'`zstandard` is needed to read or write {path}')
+        return io.BufferedReader(zstandard.open(path, mode), buffer_size) if 'r' in mode else zstandard.open(path, mode)
+
+    return open(path, mode, buffering=buffer_size)
+
+
+def iter_line_batches(fp, batch_bytes=BATCH_BYTES):
+    """Yield lists of raw lines (`bytes`, with their newline) read from `fp`, about `batch_bytes` bytes at a time."""
+
+    while True:
+        lines = fp.readlines(batch_bytes)
+        if not lines:
+            return
+        yield lines
+
+
+def byte_ranges(path, range_size):
+    """Split the (uncompressed) file `path` into `[start, end)` byte ranges of about `range_size` bytes, each made of
+    complete lines, to be processed in parallel."""
+
+    size = os.path.getsize(path)
+
+    boundaries = [0]
+    with open(path, 'rb') as fp:
+        while boundaries[-1] + range_size < size:
+            fp.seek(boundaries[-1] + range_size)
+            # move to the start of the next line
+            fp.readline()
+            boundaries.append(min(fp.tell(), size))
+    if boundaries[-1] < size:
+        boundaries.append(size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def iter_range_line_batches(path, start, end, batch_bytes=BATCH_BYTES):
+    """Like `iter_line_batches`, for the lines in the byte range `[start, end)` of `path` (see `byte_ranges`)."""
+
+    with open(path, 'rb') as fp:
+        fp.seek(start)
+        remaining = end - start
+        rest = b''
+        while remaining > 0:
+            data = fp.read(min(batch_bytes, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            data = rest + data
+            # keep the incomplete last line for the next block (`end` is a line boundary)
+            cut = data.rfind(b'\n') + 1 if remaining > 0 else len(data)
+            data, rest = data[:cut], data[cut:]
+            if data:
+                yield data.splitlines(keepends=True)
+
+
+def iter_batches(path, offset=0, batch_bytes=BATCH_BYTES):
+    """Yield lists of the entries of the jsonl file `path`, starting from byte `offset` (uncompressed files only)."""
+
+    with open_file(path, 'rb') as fp:
+        if offset:
+            assert not is_compressed(path)
+            fp.seek(offset)
+        for lines in iter_line_batches(fp, batch_bytes):
+            yield loads_batch(lines)
+
+
+def iter_entries(path, offset=0):
+    """Yield the entries of the jsonl file `path`, starting from byte `offset` (uncompressed files only)."""
+
+    for batch in iter_batches(path, offset=offset):
+        yield from batch
+
+
+def encode_lines(lines):
+    """The bytes of the jsonl lines `lines` (strings without their newline)."""
+
+    return ''.join(x + '\n' for x in lines).encode('UTF-8')
+
+
+class JsonlWriter:
+    """Buffered jsonl writer: `write` encodes entries, `write_lines` takes already encoded lines, and the data goes
+    to the file in blocks of about `buffer_size` bytes.
+
+    `mode` is 'w' or 'a'; `.gz` and `.zst` paths are compressed.
+    """
+
+    def __init__(self, path, mode='w', buffer_size=BUFFER_SIZE):
+
+        self.path = path
+        self.buffer_size = buffer_size
+        self.n_lines = 0
+
+        self._fp = open_file(path, mode + 'b')
+        self._buf = []
+        self._buf_size = 0
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def write(self, entry):
+
+        self.write_lines([dumps(entry)])
+
+    def write_many(self, entries):
+
+        self.write_lines([dumps(entry) for entry in entries])
+
+    def write_lines(self, lines):
+
+        self._buf.extend(lines)
+        self._buf_size += sum(len(x) for x in lines) + len(lines)
+        self.n_lines += len(lines)
+        if self._buf_size >= self.buffer_size:
+            self._write_buf()
+
+    def write_data(self, data):
+        """Write `data`, a block of complete lines (`str` or `bytes`, each ending with a newline)."""
+
+        self._write_buf()
+        if isinstance(data, str):
+            data = data.encode('UTF-8')
+        self._fp.write(data)
+        self.n_lines += data.count(b'\n')
+
+    def _write_buf(self):
+
+        if self._buf:
+            self._fp.write(encode_lines(self._buf))
+            self._buf = []
+            self._buf_size = 0
+
+    def flush(self):
+
+        self._write_buf()
+        self._fp.flush()
+
+    def close(self):
+
+        if self._fp is not None:
+            self._write_buf()
+            self._fp.close()
+            self._fp = None
@@ -0,0 +1,297 @@
+import os
+import json
+import argparse
+from collections import Counter
+from multiprocessing import Pool
+
+from cc3m_jsonl_index import JsonlIndex, entry_id
+from cc3m_jsonl_io import byte_ranges, is_compressed, iter_batches, iter_entries, iter_range_line_batches, loads_batch
+
+
+# the keys of an entry which aren't languages
+NON_LANG_KEYS = {'image_id', 'id', '_id', 'caption', 'image_url', 'image_file'}
+
+# size of the byte ranges processed by each task, it bounds the memory used by a worker
+RANGE_SIZE = 1 << 26
+# number of id gaps listed in the report (all of them are counted)
+MAX_GAPS = 100
+
+
+def print_entry(entry):
+
+    print(json.dumps(entry, ensure_ascii=False, indent=4))
+    print('-' * 120)
+
+
+class LangStats:
+    """Counts for one language (or the `caption`) column."""
+
+    def __init__(self):
+
+        self.n_present = 0
+        self.n_missing = 0
+        self.n_none = 0
+        self.n_empty = 0
+        self.n_person_mismatches = 0
+        # length in characters -> number of texts, bounded by the longest text
+        self.lengths = Counter()
+
+    def add(self, text, n_persons):
+
+        if text is None:
+            self.n_none += 1
+            return
+        if not isinstance(text, str):
+            # `NaN` for a missing caption in `cc3m_*.jsonl`
+            self.n_none += 1
+            return
+        if not text:
+            self.n_empty += 1
+            return
+
+        self.n_present += 1
+        self.lengths[len(text)] += 1
+        if n_persons is not None and text.count('<PERSON>') != n_persons:
+            self.n_person_mismatches += 1
+
+    def merge(self, other):
+
+        self.n_present += other.n_present
+        self.n_missing += other.n_missing
+        self.n_none += other.n_none
+        self.n_empty += other.n_empty
+        self.n_person_mismatches += other.n_person_mismatches
+        self.lengths.update(other.lengths)
+
+    def length_percentiles(self, percentiles=(50, 90, 99, 100)):
+
+        n_texts = sum(self.lengths.values())
+        if n_texts == 0:
+            return {}
+
+        results = {}
+        targets = sorted(percentiles)
+        n_seen = 0
+        for length in sorted(self.lengths):
+            n_seen += self.lengths[length]
+            while targets and n_seen >= n_texts * targets[0] / 100:
+                results[f'p{targets.pop(0)}'] = length
+        return results
+
+    def histogram(self, bucket_size):
+
+        histogram = Counter()
+        for length, count in self.lengths.items():
+            histogram[length // bucket_size * bucket_size] += count
+        return dict(sorted(histogram.items()))
+
+
+class CorpusStats:
+    """Statistics of a part of a jsonl file, merged (in file order) with `merge`.
+
+    Memory is bounded: lengths are kept as histograms, and only the first `MAX_GAPS` id gaps are listed.
+    """
+
+    def __init__(self):
+
+        self.n_entries = 0
+        self.columns = {}
+        self.first_id = None
+        self.last_id = None
+        self.n_gaps = 0
+        self.n_missing_ids = 0
+        self.n_unordered = 0
+        self.gaps = []
+
+    def _column(self, key):
+
+        if key not in self.columns:
+            self.columns[key] = LangStats()
+            # the entries seen before didn't have this column
+            self.columns[key].n_missing = self.n_entries
+        return self.columns[key]
+
+    def _add_gap(self, prev_id, _id):
+
+        if _id <= prev_id:
+            self.n_unordered += 1
+        elif _id > prev_id + 1:
+            self.n_gaps += 1
+            self.n_missing_ids += _id - prev_id - 1
+            if len(self.gaps) < MAX_GAPS:
+                self.gaps.append((prev_id + 1, _id))
+
+    def add(self, entry):
+
+        _id = entry_id(entry)
+        if self.last_id is None:
+            self.first_id = _id
+        else:
+            self._add_gap(self.last_id, _id)
+        self.last_id = _id
+
+        # `<PERSON>` placeholders are counted in the normalized english caption, which the translations come from
+        reference = entry.get('en', entry.get('caption'))
+        n_persons = reference.count('<PERSON>') if isinstance(reference, str) else None
+
+        # an entry without `caption` is counted as `missing` (below), not as `none`
+        caption_column = self._column('caption')
+        if 'caption' in entry:
+            caption_column.add(entry['caption'], None)
+        for key, text in entry.items():
+            if key not in NON_LANG_KEYS:
+                self._column(key).add(text, n_persons if key != 'en' else None)
+        for key, column in self.columns.items():
+            if key not in entry:
+                column.n_missing += 1
+
+        self.n_entries += 1
+
+    def merge(self, other):
+        """Add the statistics of `other`, the part of the file right after this one."""
+
+        for key in other.columns:
+            self._column(key)
+        for key, column in self.columns.items():
+            if key in other.columns:
+                column.merge(other.columns[key])
+            else:
+                column.n_missing += other.n_entries
+
+        if other.first_id is not None:
+            if self.last_id is None:
+                self.first_id = other.first_id
+            else:
+                self._add_gap(self.last_id, other.first_id)
+            self.last_id = other.last_id
+
+        self.n_entries += other.n_entries
+        self.n_gaps += other.n_gaps
+        self.n_missing_ids += other.n_missing_ids
+        self.n_unordered += other.n_unordered
+        self.gaps = (self.gaps + other.gaps)[:MAX_GAPS]
+
+    def report(self, bucket_size=10):
+
+        columns = {}
+        for key, column in self.columns.items():
+            columns[key] = {
+                'coverage': column.n_present / max(self.n_entries, 1),
+                'present': column.n_present,
+                'missing': column.n_missing,
+                'none': column.n_none,
+                'empty': column.n_empty,
+                'person_mismatches': column.n_person_mismatches,
+                'length': column.length_percentiles(),
+                'length_histogram': column.histogram(bucket_size),
+            }
+
+        return {
+            'n_entries': self.n_entries,
+            'first_id': self.first_id,
+            'last_id': self.last_id,
+            'n_gaps': self.n_gaps,
+            'n_missing_ids': self.n_missing_ids,
+            'n_unordered': self.n_unordered,
+            'gaps': self.gaps,
+            'columns': columns,
+        }
+
+
+def _range_stats(args):
+
+    path, start, end = args
+
+    stats = CorpusStats()
+    for lines in iter_range_line_batches(path, start, end):
+        for entry in loads_batch(lines):
+            stats.add(entry)
+
+    return stats
+
+
+def compute_stats(path, n_workers=None, range_size=RANGE_SIZE):
+    """The `CorpusStats` of the jsonl file `path`, computed over byte ranges in `n_workers` processes."""
+
+    if is_compressed(path):
+        # compressed files can't be split, they are read by a single process
+        stats = CorpusStats()
+        for batch in iter_batches(path):
+            for entry in batch:
+                stats.add(entry)
+        return stats
+
+    ranges = [(path, start, end) for start, end in byte_ranges(path, range_size)]
+
+    stats = CorpusStats()
+    with Pool(n_workers) as p:
+        # results come back in order, so the id gaps between the ranges are found when merging
+        for partial in p.imap(_range_stats, ranges):
+            stats.merge(partial)
+
+    return stats
+
+
+def print_report(report):
+
+    print(f'{report["n_entries"]} entries, ids {report["first_id"]} to {report["last_id"]}')
+    print(
+        f'{report["n_gaps"]} id gaps ({report["n_missing_ids"]} ids missing), '
+        f'{report["n_unordered"]} ids not increasing'
+    )
+    for inf, sup in report['gaps'][:10]:
+        print(f'    missing ids {inf} to {sup - 1}')
+
+    print('-' * 120)
+    header = ['coverage', 'present', 'missing', 'none', 'empty', '<PERSON>']
+    print(f'{"column":>10} ' + ' '.join(f'{x:>9}' for x in header) + '  length')
+    for key, column in report['columns'].items():
+        length = ' '.join(f'{k}={v}' for k, v in column['length'].items())
+        print(
+            f'{key:>10} {column["coverage"]:>9.2%} {column["present"]:>9} {column["missing"]:>9} '
+            f'{column["none"]:>9} {column["empty"]:>9} {column["person_mismatches"]:>9}  {length}'
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("command", help="", choices=['stats', 'show'], nargs='?', default='stats')
+    parser.add_argument("--input_fn", help="", default='cc3m_train.jsonl')
+    parser.add_argument("--n_workers", help="", type=int, default=os.cpu_count())
+    parser.add_argument("--output_json", help="also write the statistics to this file", required=False)
+    parser.add_argument("--bucket_size", help="length histogram bucket width", type=int, default=10)
+    parser.add_argument("--ids", help="show: ids of the entries to show", type=int, nargs='*')
+    parser.add_argument("--inf", help="show: show the entries from this id on", type=int, default=0)
+    parser.add_argument("--n_entries", help="show: number of entries to show", type=int, default=2000)
+
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        report = compute_stats(args.input_fn, n_workers=args.n_workers).report(args.bucket_size)
+        print_report(report)
+        if args.output_json:
+            with open(args.output_json, 'w', encoding='UTF-8') as fp:
+                json.dump(report, fp, ensure_ascii=False, indent=4)
+
+    elif args.ids:
+        index = JsonlIndex.load_or_build(args.input_fn)
+        with open(args.input_fn, 'rb') as fp:
+            for _id in args.ids:
+                print_entry(index.get(fp, _id))
+
+    else:
+        offset = 0
+        if not is_compressed(args.input_fn):
+            offset = JsonlIndex.load_or_build(args.input_fn).offset_of_min_id(args.inf)
+        n_entries = 0
+        for entry in iter_entries(args.input_fn, offset=offset):
+            if entry_id(entry) < args.inf:
+                continue
+
+            print_entry(entry)
+
+            n_entries += 1
+            if n_entries >= args.n_entries:
+                break
@@ -0,0 +1,252 @@
+import os
+import re
+import glob
+import json
+import heapq
+import shutil
+import logging
+import argparse
+
+from cc3m_jsonl_index import entry_id
+from cc3m_jsonl_io import BUFFER_SIZE, COMPRESSED_SUFFIXES, JsonlWriter, iter_line_batches, loads_batch, open_file
+from cc3m_jsonl_stats import MAX_GAPS, NON_LANG_KEYS
+
+
+logging.basicConfig(filename='cc3m-data.log', level=logging.INFO)
+
+# number of lines of an unsorted input sorted in memory at once
+RUN_SIZE = 200000
+# number of lines written to an output shard at once
+WRITE_BATCH_SIZE = 10000
+# number of bytes read at once from each merged file
+MERGE_BATCH_BYTES = 1 << 18
+# total number of bytes of the read buffers and batches of the merged files, shared between them
+MERGE_BUFFER_BYTES = 1 << 26
+# smallest read buffer / batch of a merged file
+MIN_BUFFER_BYTES = 1 << 14
+
+
+def n_langs(entry):
+    """The number of non-empty languages of `entry`, which decides which of two entries with the same id is kept."""
+
+    return sum(1 for key, text in entry.items() if key not in NON_LANG_KEYS and isinstance(text, str) and text)
+
+
+def iter_lines(path, batch_bytes=MERGE_BATCH_BYTES, buffer_size=BUFFER_SIZE):
+    """Yield `(id, n_langs, line)` for the lines (`bytes`, with their newline) of the jsonl file `path`."""
+
+    with open_file(path, buffer_size=buffer_size) as fp:
+        for lines in iter_line_batches(fp, batch_bytes):
+            for line, entry in zip(lines, loads_batch(lines)):
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                yield entry_id(entry), n_langs(entry), line
+
+
+def is_sorted(path):
+
+    prev_id = None
+    for _id, _, _ in iter_lines(path):
+        if prev_id is not None and _id < prev_id:
+            return False
+        prev_id = _id
+
+    return True
+
+
+def write_runs(path, run_prefix, run_size=RUN_SIZE):
+    """Cut the unsorted file `path` into sorted run files of `run_size` lines, `<run_prefix>_<n>.jsonl`. Returns
+    their paths."""
+
+    run_paths = []
+
+    def write_run(run):
+        # a stable sort: of the lines with the same id, the first one in the file stays first
+        run.sort(key=lambda x: x[0])
+        run_path = f'{run_prefix}_{len(run_paths):06d}.jsonl'
+        with open(run_path, 'wb') as fp:
+            fp.writelines(line for _, _, line in run)
+        run_paths.append(run_path)
+
+    run = []
+    for item in iter_lines(path):
+        run.append(item)
+        if len(run) >= run_size:
+            write_run(run)
+            run = []
+    if run:
+        write_run(run)
+
+    return run_paths
+
+
+def iter_merged(sources):
+    """k-way merge of the sorted `sources` (iterators of `(id, n_langs, line)`), yields `(id, line, n_dropped,
+    replaced)` once per id: the line with the most languages (the first one on a tie), the number of other lines with
+    that id, and whether the kept line isn't the first one."""
+
+    current = None
+    n_dropped = 0
+    replaced = False
+    for item in heapq.merge(*sources, key=lambda x: x[0]):
+        if current is not None and item[0] == current[0]:
+            n_dropped += 1
+            if item[1] > current[1]:
+                current = item
+                replaced = True
+            continue
+        if current is not None:
+            yield current[0], current[2], n_dropped, replaced
+        current = item
+        n_dropped = 0
+        replaced = False
+
+    if current is not None:
+        yield current[0], current[2], n_dropped, replaced
+
+
+def shard_fn(prefix, idx, compression=None):
+
+    return f'{prefix}_{idx:05d}.jsonl' + (f'.{compression}' if compression else '')
+
+
+def merge_shards(input_paths, output_dir, prefix, shard_size=100000, compression=None, run_size=RUN_SIZE):
+    """Merge the translated jsonl files `input_paths` into `output_dir/<prefix>_<n>.jsonl`, `shard_size` entries per
+    file, sorted by id, with one entry per id. Returns a report (a dict) with the id gaps.
+
+    The inputs are streamed through a k-way merge. Inputs which aren't sorted (resumed translations) are first cut
+    into sorted runs of `run_size` lines. The read buffers of the merged files share `MERGE_BUFFER_BYTES`, so the
+    memory used depends on `run_size`, not on the corpus size or the number of runs. Of the entries with the same id, the one with the most non-empty languages is kept.
+    The lines are copied unchanged.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_dir = os.path.join(output_dir, '.merge_tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    report = {
+        'n_inputs': len(input_paths), 'n_unsorted_inputs': 0, 'n_entries': 0, 'n_duplicates': 0, 'n_replaced': 0,
+        'first_id': None, 'last_id': None, 'n_gaps': 0, 'n_missing_ids': 0, 'gaps': [], 'shards': [],
+    }
+
+    source_paths = []
+    for idx, path in enumerate(input_paths):
+        if is_sorted(path):
+            source_paths.append(path)
+        else:
+            report['n_unsorted_inputs'] += 1
+            run_paths = write_runs(path, os.path.join(tmp_dir, f'run_{idx:05d}'), run_size=run_size)
+            logging.info(f'{path} is not sorted by id, cut into {len(run_paths)} sorted runs')
+            source_paths.extend(run_paths)
+
+    # the read buffer and the batch of lines of each source share `MERGE_BUFFER_BYTES`
+    source_bytes = max(MERGE_BUFFER_BYTES // max(2 * len(source_paths), 1), MIN_BUFFER_BYTES)
+    sources = [
+        iter_lines(path, batch_bytes=min(source_bytes, MERGE_BATCH_BYTES), buffer_size=source_bytes)
+        for path in source_paths
+    ]
+
+    writer = None
+    shard = None
+    lines = []
+
+    def close_shard():
+        writer.write_data(b''.join(lines))
+        lines.clear()
+        writer.close()
+        report['shards'].append(shard)
+        logging.info(
+            f'{shard["fn"]} written: {shard["n_entries"]} entries, ids {shard["first_id"]} to {shard["last_id"]}'
+        )
+
+    for _id, line, n_dropped, replaced in iter_merged(sources):
+
+        if writer is None:
+            shard = {'fn': shard_fn(prefix, len(report['shards']), compression), 'n_entries': 0, 'first_id': _id}
+            # written in `tmp_dir` first, and moved to `output_dir` once all of them are written
+            writer = JsonlWriter(os.path.join(tmp_dir, shard['fn']))
+
+        lines.append(line)
+        if len(lines) >= WRITE_BATCH_SIZE:
+            writer.write_data(b''.join(lines))
+            lines.clear()
+        shard['n_entries'] += 1
+        shard['last_id'] = _id
+
+        prev_id = report['last_id']
+        if prev_id is None:
+            report['first_id'] = _id
+        elif _id > prev_id + 1:
+            report['n_gaps'] += 1
+            report['n_missing_ids'] += _id - prev_id - 1
+            if len(report['gaps']) < MAX_GAPS:
+                report['gaps'].append((prev_id + 1, _id))
+        report['last_id'] = _id
+        report['n_entries'] += 1
+        report['n_duplicates'] += n_dropped
+        report['n_replaced'] += replaced
+
+        if shard['n_entries'] >= shard_size:
+            close_shard()
+            writer = None
+
+    if writer is not None:
+        close_shard()
+
+    # an interrupted merge leaves `output_dir` as it was, never a mix of new and previous shards
+    for shard in report['shards']:
+        os.replace(os.path.join(tmp_dir, shard['fn']), os.path.join(output_dir, shard['fn']))
+
+    # the shards of a previous merge with more shards
+    kept = {shard['fn'] for shard in report['shards']}
+    suffixes = '|'.join(re.escape(x) for x in COMPRESSED_SUFFIXES)
+    pattern = re.compile(re.escape(prefix) + r'_\d{5}\.jsonl(' + suffixes + ')?$')
+    for fn in os.listdir(output_dir):
+        if pattern.match(fn) and fn not in kept:
+            os.remove(os.path.join(output_dir, fn))
+
+    shutil.rmtree(tmp_dir)
+
+    return report
+
+
+def print_report(report):
+
+    print(
+        f'{report["n_entries"]} entries (ids {report["first_id"]} to {report["last_id"]}) in {len(report["shards"])} '
+        f'shards, from {report["n_inputs"]} files ({report["n_unsorted_inputs"]} not sorted)'
+    )
+    print(
+        f'{report["n_duplicates"]} duplicates dropped ({report["n_replaced"]} replaced by a more complete entry), '
+        f'{report["n_gaps"]} id gaps ({report["n_missing_ids"]} ids missing)'
+    )
+    for inf, sup in report['gaps'][:10]:
+        print(f'    missing ids {inf} to {sup - 1}')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--input_fns", help="default: cc3m_train_translated_*_to_*.jsonl", nargs='+', required=False)
+    parser.add_argument("--output_dir", help="", default='cc3m_jsonls/train')
+    parser.add_argument("--prefix", help="output shards are named <prefix>_<n>.jsonl", default='cc3m_train')
+    parser.add_argument("--shard_size", help="number of entries per output shard", type=int, default=100000)
+    parser.add_argument("--run_size", help="number of lines of an unsorted input sorted at once", type=int, default=RUN_SIZE)
+    parser.add_argument("--compression", help="compress the output shards", choices=['gz', 'zst'], required=False)
+    parser.add_argument("--report_json", help="also write the report to this file", required=False)
+
+    args = parser.parse_args()
+
+    input_fns = args.input_fns or sorted(glob.glob('cc3m_train_translated_*_to_*.jsonl'))
+
+    report = merge_shards(
+        input_fns, args.output_dir, args.prefix, shard_size=args.shard_size, compression=args.compression,
+        run_size=args.run_size
+    )
+    print_report(report)
+
+    if args.report_json:
+        with open(args.report_json, 'w', encoding='UTF-8') as fp:
+            json.dump(report, fp, indent=4)
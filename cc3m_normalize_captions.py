@@ -0,0 +1,93 @@
+import os
+import time
+import logging
+import argparse
+from multiprocessing import Pool
+
+from cc3m_text_normalization import normalize_captions
+from cc3m_jsonl_io import JsonlWriter, byte_ranges, dumps, iter_range_line_batches, loads_batch
+
+
+logging.basicConfig(filename='cc3m-data.log', level=logging.INFO)
+
+# size of the byte ranges normalized by each task
+RANGE_SIZE = 1 << 24
+
+
+def normalize_entry(entry, en_text):
+    """`entry` with its normalized caption `en_text` as `en`, with the key order `translate_batch` gives."""
+
+    normalized = {}
+    for key, value in entry.items():
+        if key in ('image_url', '_id', 'en'):
+            continue
+        normalized[key] = value
+        if key == 'caption':
+            normalized['en'] = en_text
+    for key in ('image_url', '_id'):
+        if key in entry:
+            normalized[key] = entry[key]
+
+    return normalized
+
+
+def _normalize_range(args):
+    """Normalize the captions of the lines in the byte range `[start, end)`, returns the lines to write (as one
+    string) and the number of entries."""
+
+    path, start, end = args
+
+    lines = []
+    # duplicate captions are normalized once
+    cache = {}
+    for batch in iter_range_line_batches(path, start, end):
+        for entry in loads_batch(batch):
+            text = entry['caption']
+            if isinstance(text, str) and text not in cache:
+                try:
+                    cache[text] = normalize_captions.normalize(text)
+                except IndexError:
+                    # the caption is reduced to nothing, `translate_batch` fails on it as it always did
+                    cache[text] = None
+            en_text = cache[text] if isinstance(text, str) else None
+            if en_text is not None:
+                entry = normalize_entry(entry, en_text)
+            lines.append(dumps(entry) + '\n')
+
+    return ''.join(lines), len(lines)
+
+
+def normalize_jsonl(input_path, output_path, n_workers=None, range_size=RANGE_SIZE):
+    """Write the entries of `input_path` to `output_path` with their normalized caption as `en`, normalizing the
+    byte ranges of the input in `n_workers` processes.
+
+    The output can be given to `translate_annotations(..., normalized=True)`, which then doesn't normalize again.
+    """
+
+    ranges = [(input_path, start, end) for start, end in byte_ranges(input_path, range_size)]
+
+    s = time.time()
+    n_entries = 0
+    with JsonlWriter(output_path + '.tmp') as writer, Pool(n_workers) as p:
+        # `imap` returns the ranges in order, so the output has the order of the input
+        for data, n in p.imap(_normalize_range, ranges):
+            writer.write_data(data)
+            n_entries += n
+            logging.info(f'{n_entries} captions normalized, {n_entries / (time.time() - s):.0f} captions/sec')
+    os.replace(output_path + '.tmp', output_path)
+
+    return n_entries
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--input_fn", help="", default='cc3m_train.jsonl')
+    parser.add_argument("--output_fn", help="", default='cc3m_train_normalized.jsonl')
+    parser.add_argument("--n_workers", help="", type=int, default=os.cpu_count())
+
+    args = parser.parse_args()
+
+    n_entries = normalize_jsonl(args.input_fn, args.output_fn, n_workers=args.n_workers)
+    print(f'{n_entries} captions normalized')
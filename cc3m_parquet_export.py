@@ -0,0 +1,90 @@
+import os
+import logging
+import argparse
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cc3m_jsonl_io import iter_entries
+
+
+logging.basicConfig(filename='cc3m-data.log', level=logging.INFO)
+
+LANGS = ['en', 'fr', 'es', 'pt', 'it', 'ja', 'ko', 'zh-CN']
+
+
+def parquet_schema(langs):
+    """The columns of `ImageCaptionDataset._info`, except `image_file` which depends on where the images are."""
+
+    fields = [
+        pa.field('image_id', pa.int64()),
+        pa.field('id', pa.int64()),
+        pa.field('caption', pa.string()),
+    ]
+    fields += [pa.field(lang, pa.string()) for lang in langs]
+    fields.append(pa.field('image_url', pa.string()))
+
+    return pa.schema(fields)
+
+
+def export_to_parquet(input_paths, output_path, langs=LANGS, row_group_size=100000, compression='zstd'):
+    """Stream the entries of the jsonl files `input_paths` into the Parquet file `output_path`, `row_group_size`
+    entries per row group. Returns the number of entries.
+
+    Each language is its own column, so a reader only decodes the languages it asks for, and the min/max `id` kept
+    for each row group lets it skip the row groups outside an id range. Values of the string columns which aren't
+    strings (`NaN` for a missing caption) are written as nulls.
+    """
+
+    schema = parquet_schema(langs)
+    names = schema.names
+    string_names = {field.name for field in schema if pa.types.is_string(field.type)}
+
+    n_entries = 0
+    columns = {name: [] for name in names}
+
+    def write_row_group(writer):
+
+        writer.write_table(pa.table(columns, schema=schema), row_group_size=row_group_size)
+        for name in names:
+            columns[name] = []
+
+    with pq.ParquetWriter(output_path + '.tmp', schema, compression=compression) as writer:
+        for input_path in input_paths:
+            for entry in iter_entries(input_path):
+                for name in names:
+                    value = entry.get(name)
+                    # missing captions / urls are `NaN` in the jsonl files (see `cc3m_jsonl_io.loads`)
+                    if name in string_names and not isinstance(value, str):
+                        value = None
+                    columns[name].append(value)
+                n_entries += 1
+                if n_entries % row_group_size == 0:
+                    write_row_group(writer)
+                    logging.info(f'{n_entries} entries exported')
+        if columns['id']:
+            write_row_group(writer)
+
+    os.replace(output_path + '.tmp', output_path)
+    logging.info(f'{n_entries} entries exported to {output_path}')
+
+    return n_entries
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--input_fns", help="translated jsonl files, exported in this order", nargs='+', required=True)
+    parser.add_argument("--output_fn", help="", required=True)
+    parser.add_argument("--langs", help="", nargs='+', default=LANGS)
+    parser.add_argument("--row_group_size", help="", type=int, default=100000)
+    parser.add_argument("--compression", help="", default='zstd')
+
+    args = parser.parse_args()
+
+    n_entries = export_to_parquet(
+        args.input_fns, args.output_fn, langs=args.langs, row_group_size=args.row_group_size,
+        compression=args.compression
+    )
+    print(f'{n_entries} entries exported')
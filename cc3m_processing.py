@@ -1,257 +1,274 @@
 import os
-import json
 from copy import deepcopy
-from shutil import copyfile
-from googletrans import Translator
 import time
 import re
-from google.cloud import storage
 import argparse
 import logging
 
+from cc3m_text_normalization import to_remove, process_1_annotation, normalize_captions
+from cc3m_translation_cache import TranslationCache
+from cc3m_translation import GoogletransBackend, StubBackend, TranslationEngine
+from cc3m_checkpoint import CheckpointedJsonlWriter
+from cc3m_jsonl_index import JsonlIndex
+from cc3m_jsonl_io import dumps, is_compressed, iter_entries
+from cc3m_storage import GCSBackend, LocalBackend, SegmentUploader
+from cc3m_work_queue import WorkQueue, open_lease_store
 
-logging.basicConfig(filename='cc3m-data.log', level=logging.INFO)
 
-translator = Translator()
-to_remove = ['.', '?', ',', '!', '&', '_', '-', '=', ';', ':']
+logging.basicConfig(filename='cc3m-data.log', level=logging.INFO)
 
-regex = re.compile(r'( \'[^ ]*(?: |$))', flags=re.IGNORECASE)
-# Used to deal with the cases like " \\ 't ", for example, "won \\ 't need".
-regex_2 = re.compile(r'( \\ \'t(?: |$))', flags=re.IGNORECASE)
-apostrophe_to_check = {
-    " 'm", " 'll ", " 'm ", " 're", " 's", " 's ",
-    " 'd", " 're ", " 've ", " 've", " 'd ", " 't ", " 't"
-}
+translation_backend = GoogletransBackend()
+# set to a `TranslationCache` to look translations up before calling `translation_backend`
+translation_cache = None
+translation_engine = TranslationEngine(n_workers=8, rate=10.0)
+# number of captions sent in one translation request (see `translate_pack`), 1 to translate them one by one
+translation_pack_size = 1
 
+langs = ['fr', 'es', 'pt', 'it', 'ja', 'ko', 'zh-CN']
 regex_3 = re.compile(r'robert|ロバート|로버트|罗伯特', flags=re.IGNORECASE)
 
-prefix_targets = [
-    "a black and white photograph of ",
-    "a black and white portrait of ",
-    "a black and white picture of ",
-    "a black and white photo of ",
-    "a black and white image of ",
-
-    "black and white photograph of ",
-    "black and white portrait of ",
-    "black and white picture of ",
-    "black and white photo of ",
-    "black and white image of ",
-
-    "an old photograph of ",
-    "an old portrait of ",
-    "an old picture of ",
-    "an old photo of ",
-    "an old image of ",
-
-    "old photograph of ",
-    "old portrait of ",
-    "old picture of ",
-    "old photo of ",
-    "old image of ",
-
-    "a photograph - like illustration of ",
-    "a photograph-like illustration of ",
-    "a photograph like illustration of ",
-    "a photographic illustration of ",
-    "a colorful illustration of ",
-    "a color illustration of ",
-    "an illustration of ",
-
-    "photograph - like illustration of ",
-    "photograph-like illustration of ",
-    "photograph like illustration of ",
-    "photographic illustration of ",
-    "colorful illustration of ",
-    "color illustration of ",
-    "illustration of ",
-
-    "a photograph of ",
-    "a portrait of ",
-    "a picture of ",
-    "a photo of ",
-    "an image of ",
-    "a view of ",
-    "a scene of ",
-
-    "photograph of ",
-    "portrait of ",
-    "picture of ",
-    "photo of ",
-    "image of ",
-    "view of ",
-    "scene of ",
-
-    "a close - up on ",
-    "a close-up on ",
-    "a close up on ",
-    "a closeup on ",
-
-    "close - up on ",
-    "close-up on ",
-    "close up on ",
-    "closeup on ",
-
-    "a close - up of ",
-    "a close-up of ",
-    "a close up of ",
-    "a closeup of ",
-
-    "close - up of ",
-    "close-up of ",
-    "close up of ",
-    "closeup of ",
-
-    "close - up ",
-    "close-up ",
-    "close up ",
-    "closeup ",
-
-    "a couple of ",
-    "a group of ",
-    "a bunch of ",
-
-    "there are ",
-    "there is ",
-
-    "these are ",
-    "this is ",
-
-    "a lot of ",
-    "some of ",
-    "several ",
-    "a few ",
-    "some ",
-    "many ",
-    "and ",
-    "or ",
-    "of ",
-]
-
-postfix_targets = [
-    ' in the background.',
-    ' in the background',
-    ' in the foreground.',
-    ' in the foreground',
-    ' in background.',
-    ' in background',
-    ' in foreground.',
-    ' in foreground',
-    ' and',
-    ' or'
-]
-
-
-def remove_space_before_apostrophe(text):
-
-    def repl(match_obj):
-
-        assert match_obj.group(0)[0] == ' '
-
-        result = match_obj.group(0)
-        if result.lower() in apostrophe_to_check:
-            result = result[1:]
-
-        return result
+# the captions of a pack are joined by `PACK_DELIMITER`, and the translation is split on the lines made of it only
+# (translators may change the spaces around it, or use full width bars): a delimiter moved onto the line of a caption
+# changes the number of pieces, instead of shifting text from a caption to another
+PACK_DELIMITER = '\n|||\n'
+pack_delimiter_regex = re.compile(r'\s*\n[ \t]*[|｜]{3}[ \t]*\n\s*')
+# translators limit the size of a request (5000 characters for Google Translate)
+MAX_PACK_CHARS = 4500
+# result of `translate_pack` for the captions to translate on their own
+FALLBACK = object()
 
-    modified = regex.sub(repl, text)
 
-    return modified
+def translate_text(text, src, dest):
 
+    if translation_cache is not None:
+        translated = translation_cache.get(text, dest)
+        if translated is not None:
+            return translated
 
-def remove_2(text):
+    translated = _translate_text(text, src, dest)
 
-    def repl(match_obj):
+    if translation_cache is not None:
+        translation_cache.put(text, dest, translated)
 
-        assert match_obj.group(0).lower().startswith(" \\ 't")
-        return match_obj.group(0)[len(" \\"):]
+    return translated
 
-    modified = regex_2.sub(repl, text)
 
-    return modified
+def protect_placeholders(text):
+    """Replace the `<PERSON>` placeholders of `text` by a name the translators keep. Returns the text and whether it
+    had placeholders, or `None` if it can't be done safely."""
 
+    has_person_placeholder = False
+    while '<PERSON>' in text:
 
-def _process_1_annotation(text):
+        # to avoid possible mistake
+        if 'robert' in text.lower():
+            return None
 
-    text = text.strip()
-    text = remove_2(text)
+        start = text.find('<PERSON>')
+        end = start + len('<PERSON>')
 
-    while '...' in text:
-        text = text.replace('...', ' , ').strip()
-    while '--' in text:
-        text = text.replace('--', ' - ').strip()
-    while '  ' in text:
-        text = text.replace('  ', ' ').strip()
+        placeholder = 'Robert'
+        text = text[:start] + placeholder + text[end:]
 
-    # remove trailing '.'
-    while text[-1] in to_remove:
-        text = text[:-1].strip()
-    while text[0] in to_remove:
-        text = text[1:].strip()
+        has_person_placeholder = True
 
-    text = remove_space_before_apostrophe(text)  # TODO: check case
+    return text, has_person_placeholder
 
-    for target in postfix_targets:
-        if text[-len(target):].lower() == target:
-            text = text[:-len(target)].strip()
 
-    for target in prefix_targets:
-        if text[:len(target)].lower() == target:
-            text = text[len(target):].strip()
+def restore_placeholders(translated, has_person_placeholder):
 
-    return text
+    if has_person_placeholder:
+        translated = regex_3.sub(repl='<PERSON>', string=translated)
 
+    return translated
 
-def process_1_annotation(text):
 
-    new_text = _process_1_annotation(text)
-    while new_text != text:
-        text = new_text
-        new_text = _process_1_annotation(text)
+def _translate_text(text, src, dest):
 
-    return text
+    protected = protect_placeholders(text)
+    if protected is None:
+        return ''
+    text, has_person_placeholder = protected
 
+    translated = translation_backend.translate(text, src=src, dest=dest)
 
-def translate_text(text, src, dest):
+    return restore_placeholders(translated, has_person_placeholder)
 
-    has_person_placeholder = False
-    while '<PERSON>' in text:
 
-        # to avoid possible mistake
-        if 'robert' in text.lower():
-            return ''
+def translate_caption(en_text, lang):
+    """Translate a normalized caption. Returns `None` if the translation is rejected."""
 
-        start = text.find('<PERSON>')
-        end = start + len('<PERSON>')
+    return clean_translation(en_text, translate_text(en_text, src='en', dest=lang))
 
-        placeholder = 'Robert'
-        text = text[:start] + placeholder + text[end:]
 
-        has_person_placeholder = True
+def clean_translation(en_text, lang_text):
+    """Check and clean the translation `lang_text` of `en_text`. Returns `None` if it is rejected."""
 
-    translated = translator.translate(text, src=src, dest=dest).text
+    _nb = en_text.count('<PERSON>')
 
-    if has_person_placeholder:
-        translated = regex_3.sub(repl='<PERSON>', string=translated)
+    lang_text = lang_text.strip()
 
-    return translated
+    if lang_text == '':
+        return None
+
+    # Ignore translations not having the same number of <PERSON>
+    _nb_new = lang_text.count('<PERSON>')
+    if _nb_new != _nb:
+        return None
+
+    # remove trailing '.'
+    while lang_text[-1] in to_remove:
+        lang_text = lang_text[:-1].strip()
+    while lang_text[0] in to_remove:
+        lang_text = lang_text[1:].strip()
+
+    return lang_text
+
+
+def translate_pack(en_texts, lang):
+    """Translate the normalized captions `en_texts` in a single request, as lines separated by `PACK_DELIMITER`.
+
+    Returns the result of `translate_caption` for each caption, or `FALLBACK` for the captions to translate on their
+    own: all of them if the translation doesn't split back into as many captions, and those whose translation hasn't
+    kept their number of `<PERSON>`. The `<PERSON>` placeholders are replaced and restored per caption, so a caption
+    without placeholders keeps the names of its translation.
+    """
+
+    results = [None] * len(en_texts)
+    packed = []
+    for idx, en_text in enumerate(en_texts):
+        if translation_cache is not None:
+            translated = translation_cache.get(en_text, lang)
+            if translated is not None:
+                results[idx] = _clean_packed_translation(en_text, translated)
+                continue
+        if '\n' in en_text:
+            results[idx] = FALLBACK
+            continue
+        protected = protect_placeholders(en_text)
+        if protected is None:
+            results[idx] = FALLBACK
+            continue
+        packed.append((idx, *protected))
+
+    if len(packed) < 2:
+        for idx, _, _ in packed:
+            results[idx] = FALLBACK
+        return results
+
+    text = PACK_DELIMITER.join(x for _, x, _ in packed)
+    pieces = pack_delimiter_regex.split(translation_backend.translate(text, src='en', dest=lang).strip())
+
+    if len(pieces) != len(packed):
+        logging.info(f'packed translation split into {len(pieces)} captions instead of {len(packed)}, falling back')
+        for idx, _, _ in packed:
+            results[idx] = FALLBACK
+        return results
+
+    for (idx, _, has_person_placeholder), piece in zip(packed, pieces):
+        en_text = en_texts[idx]
+        translated = restore_placeholders(piece, has_person_placeholder)
+        if not translated.strip() or translated.count('<PERSON>') != en_text.count('<PERSON>'):
+            results[idx] = FALLBACK
+            continue
+        if translation_cache is not None:
+            translation_cache.put(en_text, lang, translated)
+        results[idx] = _clean_packed_translation(en_text, translated)
+
+    return results
+
+
+def _clean_packed_translation(en_text, translated):
+
+    # `clean_translation` raises on a translation made of punctuation only (e.g. "."): an error here would fail (and
+    # retry) the whole pack, so the caption is rejected on its own instead
+    try:
+        return clean_translation(en_text, translated)
+    except IndexError:
+        return None
+
+
+def make_packs(jobs, pack_size, max_chars=MAX_PACK_CHARS):
+    """Group the `(en_text, lang)` jobs into `(en_texts, lang)` jobs of up to `pack_size` captions of a language."""
+
+    packs = []
+    for lang in dict.fromkeys(lang for _, lang in jobs):
+        pack = []
+        n_chars = 0
+        for en_text, _lang in jobs:
+            if _lang != lang:
+                continue
+            if pack and (len(pack) >= pack_size or n_chars + len(en_text) + len(PACK_DELIMITER) > max_chars):
+                packs.append((tuple(pack), lang))
+                pack = []
+                n_chars = 0
+            pack.append(en_text)
+            n_chars += len(en_text) + len(PACK_DELIMITER)
+        if pack:
+            packs.append((tuple(pack), lang))
+
+    return packs
+
+
+def translate_jobs(jobs):
+    """The results of `translate_caption` for the `(en_text, lang)` jobs, run by `translation_engine`.
 
+    With `translation_pack_size > 1`, the captions are sent `translation_pack_size` at a time (see `translate_pack`),
+    and the ones which can't be split back from a packed translation (or whose pack failed) are translated on their
+    own.
+    """
 
-def translate_batch(batch, langs, buf):
+    if translation_pack_size <= 1:
+        return translation_engine.map(translate_caption, jobs)
 
-    en_batch = [process_1_annotation(x['caption']) for x in batch]
+    unique_jobs = list(dict.fromkeys(jobs))
+    packs = make_packs(unique_jobs, translation_pack_size)
+
+    results = {}
+    for (en_texts, lang), pack_results in zip(packs, translation_engine.map(translate_pack, packs)):
+        if pack_results is None:
+            pack_results = [FALLBACK] * len(en_texts)
+        for en_text, lang_text in zip(en_texts, pack_results):
+            results[(en_text, lang)] = lang_text
+
+    fallback_jobs = [job for job in unique_jobs if results[job] is FALLBACK]
+    for job, lang_text in zip(fallback_jobs, translation_engine.map(translate_caption, fallback_jobs)):
+        results[job] = lang_text
+
+    return [results[job] for job in jobs]
+
+
+def translate_batch(batch, langs, buf, normalized=False):
+
+    if normalized:
+        # `en` is already there (see `cc3m_normalize_captions.py`), except for the captions it couldn't normalize
+        # (reduced to nothing, or not a string): normalizing them again would only raise, they are written without
+        # `en` nor translations
+        en_batch = [x.get('en') for x in batch]
+    else:
+        en_batch = normalize_captions([x['caption'] for x in batch])
     for x, en_text in zip(batch, en_batch):
         x['to_process'] = True
+        if en_text is None:
+            x['to_process'] = False
+            continue
         if 'en' in x and x['en'] == en_text:
             # no need to update
             x['to_process'] = False
             continue
         x['en'] = en_text
 
+    jobs = []
+    positions = []
+    lang_batches = {}
     for lang in langs:
         lang_batch = []
-        # Currently, bulk (batch) translation is not working
-        for x, en_text in zip(batch, en_batch):
+        # Bulk translation (a list of texts in one call) is not working, see `translate_pack` instead
+        for idx, (x, en_text) in enumerate(zip(batch, en_batch)):
+            if en_text is None:
+                lang_batch.append(None)
+                continue
+
             lang_text = None
             if not x['to_process'] and lang in x:
                 lang_text = x[lang]
@@ -262,35 +279,19 @@ def translate_batch(batch, langs, buf):
             if _nb > 4:
                 continue
 
-            n_tried = 0
-            while not lang_text and n_tried <= 5:
-                try:
-                    n_tried += 1
-                    lang_text = translate_text(en_text, src='en', dest=lang).strip()
-
-                    if lang_text == '':
-                        break
-
-                    # Ignore translations not having the same number of <PERSON>
-                    _nb_new = lang_text.count('<PERSON>')
-                    if _nb_new != _nb:
-                        break
-
-                    # remove trailing '.'
-                    while lang_text[-1] in to_remove:
-                        lang_text = lang_text[:-1].strip()
-                    while lang_text[0] in to_remove:
-                        lang_text = lang_text[1:].strip()
-                    lang_batch[-1] = lang_text
-                except Exception as e:
-                    # logging.info(f'error for translating caption: {en_text}')
-                    # logging.info(e)
-                    # logging.info('-' * 40)
-                    lang_text = None
-                    time.sleep(0.5)
-            time.sleep(0.2)
-
-        for x, lang_text in zip(batch, lang_batch):
+            if not lang_text:
+                jobs.append((en_text, lang))
+                positions.append((lang, idx))
+
+        lang_batches[lang] = lang_batch
+
+    # All the (caption, language) pairs are translated concurrently, with retries, by `translation_engine`.
+    for (lang, idx), lang_text in zip(positions, translate_jobs(jobs)):
+        if lang_text is not None:
+            lang_batches[lang][idx] = lang_text
+
+    for lang in langs:
+        for x, lang_text in zip(batch, lang_batches[lang]):
             x[lang] = lang_text
 
     for x in batch:
@@ -302,26 +303,39 @@ def translate_batch(batch, langs, buf):
         if '_id' in x:
             _id = x.pop('_id')
             x['_id'] = _id
-        jsonl = json.dumps(x, ensure_ascii=False, indent=None)
+        jsonl = dumps(x)
         buf.append(jsonl)
 
 
 def translate_annotations(
         input_dir, input_fn, output_dir, output_fn, langs, batch_size=20, buf_size=100,
-        inf=0, sup=None, storage_params=None):
+        inf=0, sup=None, storage_params=None, shared_range=None, normalized=False):
+    """Translate the entries with `inf <= id < sup` of the input into `output_fn`, resuming previous work.
+
+    `shared_range` (optional, see `cc3m_translation_driver.SharedRange` and `cc3m_work_queue.HeldLease`) can stop the
+    processing before `sup` by refusing to `claim` an id, and gets the progress reported. With `storage_params`, the
+    uploaded segments are only composed into the final blob if the whole range was processed and
+    `shared_range.complete()` succeeds.
+
+    `normalized`: the input was written by `cc3m_normalize_captions.py`, its `en` captions are used as they are.
+    """
 
     entry_ids_processed = set()
 
     input_path = os.path.join(input_dir, input_fn)
     output_path = os.path.join(output_dir, output_fn)
 
+    # Truncates whatever was not committed by an interrupted run
+    output_writer = CheckpointedJsonlWriter(output_path)
+
+    uploader = None
+    if storage_params:
+        uploader = SegmentUploader(storage_params['backend'], storage_params['blob_name'], output_path)
+
     # Load previous work done
     if os.path.isfile(output_path):
-        with open(output_path, 'r', encoding='UTF-8') as fp:
-            for jsonl in fp:
-                assert jsonl.strip()
-                entry = json.loads(jsonl)
-                entry_ids_processed.add(entry['_id'] if '_id' in entry else entry['id'])
+        for entry in iter_entries(output_path):
+            entry_ids_processed.add(entry['_id'] if '_id' in entry else entry['id'])
 
     logging.info(f'There are already {len(entry_ids_processed)} captions being processed!')
     logging.info('start processing annotations ...')
@@ -329,82 +343,117 @@ def translate_annotations(
     buf = []
     batch = []
     n_entries = len(entry_ids_processed)
+    # the processing stopped before the end of the range
+    stopped = False
 
-    with open(input_path, 'r', encoding='UTF-8') as input_fp:
-        for jsonl in input_fp:
+    offset = 0
+    if not is_compressed(input_path):
+        # Skip straight to the first entry with an id >= `inf`
+        offset = JsonlIndex.load_or_build(input_path).offset_of_min_id(inf)
 
-            entry = json.loads(jsonl)
+    for entry in iter_entries(input_path, offset=offset):
 
-            _id = entry['_id'] if '_id' in entry else entry['id']
+        _id = entry['_id'] if '_id' in entry else entry['id']
 
-            if _id in entry_ids_processed:
-                continue
-            if _id < inf:
-                continue
-            if sup is not None and _id >= sup:
-                break
-
-            batch.append(entry)
-            if len(batch) == batch_size:
-                translate_batch(batch, langs=langs, buf=buf)
-                n_entries += len(batch)
-                # empty batch
-                batch = []
-
-            if n_entries % buf_size == 0 and len(buf) > 0:
-                with open(output_path, 'a', encoding='UTF-8') as output_fp:
-                    # write data to file
-                    data = ''
-                    for x in buf:
-                        data += x + '\n'
-                    output_fp.write(data)
-                    # empty the buffer
-                    buf = []
-
-                logging.info(n_entries)
-                copyfile(output_path, os.path.join(output_dir, output_fn + '-backup'))
-                if storage_params and n_entries % storage_params['batch_size'] == 0 and n_entries > 0:
-                    bucket_name, blob_name = storage_params['bucket_name'], storage_params['blob_name']
-                    upload_to_storage(bucket_name, blob_name, output_dir, output_fn)
-
-        # remain
-        if len(batch) > 0:
-            translate_batch(batch, langs=langs, buf=buf)
+        if _id < inf:
+            continue
+        if sup is not None and _id >= sup:
+            break
+        # claimed even when already processed, so that a split of `shared_range` doesn't give it away again
+        if shared_range is not None and not shared_range.claim(_id):
+            stopped = True
+            break
+        if _id in entry_ids_processed:
+            continue
+
+        batch.append(entry)
+        if len(batch) == batch_size:
+            translate_batch(batch, langs=langs, buf=buf, normalized=normalized)
             n_entries += len(batch)
+            if shared_range is not None:
+                shared_range.add_done(len(batch))
             # empty batch
             batch = []
 
-        # remain
-        if len(buf) > 0:
-            with open(output_path, 'a', encoding='UTF-8') as output_fp:
-                logging.info(n_entries)
-                # write data to file
-                data = ''
-                for x in buf:
-                    data += x + '\n'
-                output_fp.write(data)
-                # empty the buffer
-                buf = []
-
+        if n_entries % buf_size == 0 and len(buf) > 0:
+            # write data to file
+            output_writer.append(buf)
+            # empty the buffer
+            buf = []
+
+            logging.info(n_entries)
+            if translation_cache is not None:
+                logging.info(f'translation cache: {translation_cache.stats()}')
+            if uploader and n_entries % storage_params['batch_size'] == 0 and n_entries > 0:
+                # uploads the new part of the output in the background
+                uploader.sync(output_writer.size)
+
+    # remain
+    if len(batch) > 0:
+        translate_batch(batch, langs=langs, buf=buf, normalized=normalized)
+        n_entries += len(batch)
+        if shared_range is not None:
+            shared_range.add_done(len(batch))
+        # empty batch
+        batch = []
+
+    # remain
+    if len(buf) > 0:
         logging.info(n_entries)
-        copyfile(output_path, os.path.join(output_dir, output_fn + '-backup'))
-        if storage_params:
-            bucket_name, blob_name = storage_params['bucket_name'], storage_params['blob_name']
-            upload_to_storage(bucket_name, blob_name, output_dir, output_fn)
-
-
-def upload_to_storage(bucket_name, blob_name, f_dir, fn):
-
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    f_path = os.path.join(f_dir, fn)
-    blob.upload_from_filename(f_path)
-    logging.info(
-        "File {} uploaded to {}.".format(
-            f_path, f'{blob_name}/{fn}'
+        # write data to file
+        output_writer.append(buf)
+        # empty the buffer
+        buf = []
+
+    output_writer.close()
+
+    logging.info(n_entries)
+    if uploader:
+        # a node which lost its lease leaves its segments: the node which took the range over composes the final blob
+        if shared_range is None or (not stopped and shared_range.complete()):
+            uploader.finalize(output_writer.size)
+        else:
+            logging.error(f'{output_fn} not finalized, the range was not completed')
+            uploader.flush(output_writer.size)
+        uploader.close()
+
+
+def add_translation_arguments(parser):
+
+    parser.add_argument("--translation_backend", help="", choices=['googletrans', 'stub'], default='googletrans')
+    parser.add_argument("--translation_workers", help="number of translation requests in flight", type=int, default=8)
+    parser.add_argument("--translation_rate", help="max. translation requests per second", type=float, default=10.0)
+    parser.add_argument("--translation_cache", help="path of the translation cache (SQLite)", required=False)
+    parser.add_argument("--translation_cache_max_entries", help="", type=int, required=False)
+    parser.add_argument("--translation_pack_size", help="number of captions per translation request", type=int, default=1)
+    parser.add_argument("--normalized", help="the input is the output of cc3m_normalize_captions.py", action='store_true')
+
+
+def setup_translation(args):
+    """Set up the translation backend, engine and cache from the arguments of `add_translation_arguments`."""
+
+    global translation_backend, translation_engine, translation_cache, translation_pack_size
+
+    if args.translation_backend == 'stub':
+        translation_backend = StubBackend()
+    translation_engine.close()
+    translation_engine = TranslationEngine(n_workers=args.translation_workers, rate=args.translation_rate)
+    translation_pack_size = args.translation_pack_size
+
+    if args.translation_cache:
+        translation_cache = TranslationCache(
+            args.translation_cache, backend=translation_backend.name, max_entries=args.translation_cache_max_entries
         )
-    )
+
+
+def close_translation():
+
+    logging.info(f'translation engine: {translation_engine.stats()}')
+    translation_engine.close()
+
+    if translation_cache is not None:
+        logging.info(f'translation cache: {translation_cache.stats()}')
+        translation_cache.close()
 
 
 if __name__ == "__main__":
@@ -415,12 +464,16 @@ if __name__ == "__main__":
     parser.add_argument("--input_fn", help="", required=True)
     parser.add_argument("--batch_size", help="", type=int, default=100)
     parser.add_argument("--buf_size", help="", type=int, default=100)
-    parser.add_argument("--inf", help="", type=int, required=True)
-    parser.add_argument("--sup", help="", type=int, required=True)
+    parser.add_argument("--inf", help="", type=int, required=False)
+    parser.add_argument("--sup", help="", type=int, required=False)
+    parser.add_argument("--queue", help="translate the ranges leased from this work queue: SQLite path (single machine) or gs://<bucket>/<name>", required=False)
+    parser.add_argument("--lease_duration", help="", type=float, default=600)
     parser.add_argument("--output_dir", help="", required=True)
     parser.add_argument("--bucket_name", help="", required=False)
+    parser.add_argument("--storage_dir", help="upload to this local directory instead of a bucket", required=False)
     parser.add_argument("--blob_prefix", help="", required=False)
     parser.add_argument("--upload_batch_size", help="", type=int, required=False)
+    add_translation_arguments(parser)
 
     args = parser.parse_args()
 
@@ -435,25 +488,42 @@ if __name__ == "__main__":
     blob_prefix = args.blob_prefix
     upload_batch_size = args.upload_batch_size
 
+    setup_translation(args)
+
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir, exist_ok=True)
 
-    output_fn = f'cc3m_train_translated_{inf}_to_{sup}.jsonl'
-
-    langs = ['fr', 'es', 'pt', 'it', 'ja', 'ko', 'zh-CN']
-
-    storage_params = None
-    if bucket_name:
+    storage_backend = None
+    if bucket_name or args.storage_dir:
         assert blob_prefix
         assert upload_batch_size
-        blob_name = os.path.join(blob_prefix, output_fn)
-        storage_params = {
-            'bucket_name': bucket_name,
-            'blob_name': blob_name,
-            'batch_size': upload_batch_size
-        }
-
-    translate_annotations(
-        input_dir, input_fn, output_dir, output_fn, langs, batch_size=batch_size, buf_size=buf_size,
-        inf=inf, sup=sup, storage_params=storage_params
-    )
+        storage_backend = GCSBackend(bucket_name) if bucket_name else LocalBackend(args.storage_dir)
+
+    def translate_range(inf, sup, shared_range=None):
+
+        output_fn = f'cc3m_train_translated_{inf}_to_{sup}.jsonl'
+
+        storage_params = None
+        if storage_backend is not None:
+            blob_name = os.path.join(blob_prefix, output_fn)
+            storage_params = {
+                'backend': storage_backend,
+                'blob_name': blob_name,
+                'batch_size': upload_batch_size
+            }
+
+        translate_annotations(
+            input_dir, input_fn, output_dir, output_fn, langs, batch_size=batch_size, buf_size=buf_size,
+            inf=inf, sup=sup, storage_params=storage_params, shared_range=shared_range, normalized=args.normalized
+        )
+
+    if args.queue:
+        store = open_lease_store(args.queue)
+        for held in WorkQueue(store, lease_duration=args.lease_duration, wait=True):
+            translate_range(held.lease.inf, held.lease.sup, shared_range=held)
+        store.close()
+    else:
+        assert inf is not None and sup is not None
+        translate_range(inf, sup)
+
+    close_translation()
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import queue
+import shutil
+import logging
+import threading
+
+
+class StorageBackend:
+    """Where translation outputs are uploaded to. Blobs are identified by `/`-separated names."""
+
+    def upload(self, name, data):
+        raise NotImplementedError
+
+    def compose(self, source_names, name):
+        """Create the blob `name` as the concatenation of the blobs `source_names`."""
+        raise NotImplementedError
+
+
+class GCSBackend(StorageBackend):
+    """A Google Cloud Storage bucket, with one client for the whole run."""
+
+    # maximum number of sources of one compose request
+    max_compose_sources = 32
+
+    def __init__(self, bucket_name):
+
+        from google.cloud import storage
+
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+
+    def upload(self, name, data):
+
+        self.bucket.blob(name).upload_from_string(data)
+
+    def compose(self, source_names, name):
+
+        # compose at most `max_compose_sources` blobs at a time, into intermediate blobs if needed
+        level = 0
+        intermediates = []
+        while len(source_names) > self.max_compose_sources:
+            composed = []
+            for idx in range(0, len(source_names), self.max_compose_sources):
+                composed_name = f'{name}.compose/{level}-{idx // self.max_compose_sources:06d}'
+                self.bucket.blob(composed_name).compose(
+                    [self.bucket.blob(x) for x in source_names[idx:idx + self.max_compose_sources]]
+                )
+                composed.append(composed_name)
+            intermediates.extend(composed)
+            source_names = composed
+            level += 1
+
+        self.bucket.blob(name).compose([self.bucket.blob(x) for x in source_names])
+
+        for x in intermediates:
+            self.bucket.blob(x).delete()
+
+
+class LocalBackend(StorageBackend):
+    """A local directory standing in for a bucket, to run the upload flow offline."""
+
+    def __init__(self, root_dir):
+
+        self.root_dir = root_dir
+
+    def _path(self, name):
+
+        return os.path.join(self.root_dir, *name.split('/'))
+
+    def upload(self, name, data):
+
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as fp:
+            fp.write(data)
+        os.replace(path + '.tmp', path)
+
+    def compose(self, source_names, name):
+
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as fp:
+            for x in source_names:
+                with open(self._path(x), 'rb') as source_fp:
+                    shutil.copyfileobj(source_fp, fp)
+        os.replace(path + '.tmp', path)
+
+
+class SegmentUploader:
+    """Uploads an append-only local file as immutable segments, on a background thread.
+
+    `sync(size)` asks for the first `size` bytes of the file to be uploaded and returns immediately. The background
+    thread uploads the bytes not uploaded yet as a new segment `<blob_name>.segments/<start>-<end>`, and records it in
+    a local state file (`<local_path>.upload.json`) so that a restarted run continues where it stopped. `size` should
+    only cover data that won't change anymore (for example the committed size of a `CheckpointedJsonlWriter`).
+
+    `finalize()` waits for the pending uploads, then composes the segments into `blob_name` and uploads a manifest
+    `<blob_name>.manifest.json` listing them.
+    """
+
+    def __init__(self, backend, blob_name, local_path, max_attempts=5, backoff=1.0):
+
+        self.backend = backend
+        self.blob_name = blob_name
+        self.local_path = local_path
+        self.state_path = local_path + '.upload.json'
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+        self.segments = []
+        if os.path.isfile(self.state_path):
+            with open(self.state_path, 'r', encoding='UTF-8') as fp:
+                self.segments = json.load(fp)['segments']
+
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def uploaded_size(self):
+
+        return self.segments[-1]['end'] if self.segments else 0
+
+    def _save_state(self):
+
+        with open(self.state_path + '.tmp', 'w', encoding='UTF-8') as fp:
+            json.dump({'blob_name': self.blob_name, 'segments': self.segments}, fp)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def _upload_segment(self, size):
+
+        start = self.uploaded_size
+        if size <= start:
+            return
+
+        with open(self.local_path, 'rb') as fp:
+            fp.seek(start)
+            data = fp.read(size - start)
+
+        name = f'{self.blob_name}.segments/{start:012d}-{size:012d}'
+        for attempt in range(self.max_attempts):
+            try:
+                self.backend.upload(name, data)
+                break
+            except Exception as e:
+                if attempt + 1 == self.max_attempts:
+                    raise
+                logging.info(f'upload of {name} failed, retrying: {repr(e)}')
+                time.sleep(self.backoff * 2 ** attempt)
+
+        self.segments.append({'name': name, 'start': start, 'end': size})
+        self._save_state()
+        logging.info(f'segment {name} uploaded')
+
+    def _run(self):
+
+        stop = False
+        while not stop:
+
+            # coalesce the requests waiting in the queue into one segment
+            requests = [self._requests.get()]
+            while not self._requests.empty():
+                requests.append(self._requests.get())
+
+            sizes = [size for size, _ in requests if size is not None]
+            stop = len(sizes) < len(requests)
+            try:
+                if sizes:
+                    self._upload_segment(max(sizes))
+            except Exception as e:
+                logging.error(f'upload of {self.local_path} up to {max(sizes)} failed: {repr(e)}')
+
+            for _, done in requests:
+                if done is not None:
+                    done.set()
+
+    def sync(self, size):
+
+        self._requests.put((size, None))
+
+    def flush(self, size=None):
+        """Block until the segments up to `size` (if given) and all the previous requests are uploaded."""
+
+        done = threading.Event()
+        self._requests.put((size if size is not None else self.uploaded_size, done))
+        done.wait()
+
+    def finalize(self, size):
+        """Upload what is left up to `size`, compose the segments into `blob_name` and upload the manifest."""
+
+        self.flush(size)
+        if self.uploaded_size != size:
+            raise RuntimeError(f'{self.local_path} is uploaded up to {self.uploaded_size} instead of {size}')
+
+        self.backend.compose([x['name'] for x in self.segments], self.blob_name)
+        manifest = {'blob_name': self.blob_name, 'size': size, 'segments': self.segments}
+        self.backend.upload(f'{self.blob_name}.manifest.json', json.dumps(manifest, indent=4).encode('UTF-8'))
+        logging.info(f'{self.local_path} uploaded to {self.blob_name}')
+
+    def close(self):
+
+        done = threading.Event()
+        self._requests.put((None, done))
+        done.wait()
@@ -0,0 +1,215 @@
+"""Synthetic CC3M-like data and a local image server, shared by `cc3m_benchmark.py` and the tests."""
+import io
+import os
+import time
+import random
+import socket
+import string
+import threading
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+def make_synthetic_tsv(path, n_rows, seed=0):
+
+    rng = random.Random(seed)
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(5000)]
+    words += ['café', 'naïve', '<PERSON>', 'über', '東京', '"quoted"', 'back\\slash']
+
+    with open(path, 'w', encoding='UTF-8') as fp:
+        for idx in range(n_rows):
+            caption = ' '.join(rng.choices(words, k=rng.randint(5, 20)))
+            image_url = f'http://example{idx % 97}.com/images/{idx:08d}.jpg'
+            fp.write(f'{caption}\t{image_url}\n')
+
+
+@lru_cache(maxsize=64)
+def make_synthetic_jpeg(width, height, seed=0):
+
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    # smooth gradients plus noise compress like a photo rather than like pure noise
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    pixels += rng.normal(0, 12, size=pixels.shape)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+
+    buf = io.BytesIO()
+    image.save(buf, format='JPEG', quality=90)
+
+    return buf.getvalue()
+
+
+class _SyntheticImageHandler(BaseHTTPRequestHandler):
+    """Serves `/<anything>?w=<width>&h=<height>&delay=<seconds>&status=<code>`."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        delay = float(params.get('delay', self.server.default_delay))
+        status = int(params.get('status', 200))
+        width, height = int(params.get('w', 1024)), int(params.get('h', 768))
+
+        if delay > 0:
+            time.sleep(delay)
+
+        body = make_synthetic_jpeg(width, height) if status == 200 else b'error'
+        self.server.n_requests += 1
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _QuietThreadingHTTPServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # clients giving up on slow responses are expected
+        pass
+
+
+class SyntheticImageServer:
+    """Local HTTP server serving synthetic JPEGs, with per-URL delay/status (see `_SyntheticImageHandler`)."""
+
+    def __init__(self, default_delay=0.0):
+
+        self.httpd = _QuietThreadingHTTPServer(('127.0.0.1', 0), _SyntheticImageHandler)
+        self.httpd.default_delay = default_delay
+        self.httpd.n_requests = 0
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+
+        host, port = self.httpd.server_address
+        return f'http://{host}:{port}'
+
+    def url(self, name, **params):
+
+        query = '&'.join(f'{k}={v}' for k, v in params.items())
+        return f'{self.base_url}/{name}' + (f'?{query}' if query else '')
+
+    def __enter__(self):
+
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def make_download_entries(server, n_entries, slow_every=50, slow_delay=1.5, error_every=20, seed=0):
+
+    rng = random.Random(seed)
+    entries = []
+    for idx in range(n_entries):
+        params = {'w': rng.choice([640, 1024, 1600]), 'h': rng.choice([480, 768, 1200])}
+        if slow_every and idx % slow_every == slow_every - 1:
+            params['delay'] = slow_delay
+        if error_every and idx % error_every == error_every - 1:
+            params['status'] = 404
+        entries.append({'image_id': idx, 'image_url': server.url(f'{idx:08d}.jpg', **params)})
+
+    return entries
+
+
+def closed_port():
+    """A local port nobody listens on (connections to it are refused)."""
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_synthetic_captions(n_captions, seed=0):
+    """CC3M-like captions, with the prefixes/postfixes/punctuation that `process_1_annotation` deals with."""
+
+    from cc3m_text_normalization import prefix_targets, postfix_targets
+
+    rng = random.Random(seed)
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(3000)]
+    extras = [' .', ' ...', ' -- ', " 's", " 't", " \\ 't", '  ', ' , ', '<PERSON>', ' !']
+
+    captions = []
+    for _ in range(n_captions):
+        caption = ' '.join(rng.choices(words, k=rng.randint(4, 16)))
+        if rng.random() < 0.4:
+            caption = rng.choice(prefix_targets) + caption
+        if rng.random() < 0.15:
+            caption = rng.choice(prefix_targets).capitalize() + caption
+        if rng.random() < 0.2:
+            caption += rng.choice(postfix_targets)
+        if rng.random() < 0.3:
+            caption += rng.choice(extras)
+        captions.append(caption)
+
+    # duplicate captions are common in CC3M
+    captions += rng.choices(captions, k=n_captions // 10)
+
+    return captions
+
+
+def normalize_or_error(normalize, caption):
+    """`normalize(caption)`, or `IndexError` for a caption it reduces to nothing."""
+
+    try:
+        return normalize(caption)
+    except IndexError:
+        return IndexError
+
+
+def make_translated_entries(n_entries, langs=('en', 'fr', 'es', 'pt', 'it', 'ja', 'ko', 'zh-CN')):
+
+    captions = make_synthetic_captions(n_entries)
+
+    return [
+        {'image_id': idx, 'id': idx, 'caption': x, **{lang: f'[{lang}] {x}' for lang in langs}, 'image_url': ''}
+        for idx, x in enumerate(captions)
+    ]
+
+
+def make_dataset_dir(data_dir, n_entries, n_files=4, langs=('en', 'fr'), image_ratio=0.9, seed=0):
+    """A `cc3m` data directory for `image_caption_dataset.py`: the train split as `n_files` jsonl files and as
+    Parquet files, and (empty) image files for `image_ratio` of the entries, with their manifest."""
+
+    from cc3m_jsonl_io import JsonlWriter
+    from cc3m_image_index import write_image_manifest
+    from cc3m_parquet_export import export_to_parquet
+
+    rng = random.Random(seed)
+    entries = make_translated_entries(n_entries, langs=langs)
+
+    jsonl_dir = os.path.join(data_dir, 'cc3m_jsonls', 'train')
+    parquet_dir = os.path.join(data_dir, 'cc3m_parquets', 'train')
+    image_dir = os.path.join(data_dir, 'cc3m_images', 'train')
+    for path in (jsonl_dir, parquet_dir, image_dir):
+        os.makedirs(path, exist_ok=True)
+
+    n_per_file = -(-n_entries // n_files)
+    for idx in range(n_files):
+        jsonl_path = os.path.join(jsonl_dir, f'cc3m_train_{idx:02d}.jsonl')
+        with JsonlWriter(jsonl_path) as writer:
+            writer.write_many(entries[idx * n_per_file:(idx + 1) * n_per_file])
+        export_to_parquet([jsonl_path], os.path.join(parquet_dir, f'cc3m_train_{idx:02d}.parquet'), langs=langs)
+
+    # the builder only checks that the image files exist
+    for entry in entries:
+        if rng.random() < image_ratio:
+            open(os.path.join(image_dir, f'cc3m_train_{entry["image_id"]:08d}.jpg'), 'wb').close()
+    write_image_manifest(image_dir)
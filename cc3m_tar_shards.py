@@ -0,0 +1,202 @@
+import os
+import io
+import json
+import glob
+import tarfile
+import time
+
+
+SHARD_SUFFIX = '.tar'
+INDEX_SUFFIX = '.index.jsonl'
+TMP_SUFFIX = '.tmp'
+
+
+def _fsync_dir(dir_path):
+
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def shard_paths(output_dir, prefix):
+    """Committed shards (`<prefix>-NNNNNN.tar`) in `output_dir`, sorted by shard number."""
+
+    return sorted(glob.glob(os.path.join(output_dir, f'{prefix}-[0-9][0-9][0-9][0-9][0-9][0-9]{SHARD_SUFFIX}')))
+
+
+def index_path(shard_path):
+
+    return shard_path[:-len(SHARD_SUFFIX)] + INDEX_SUFFIX
+
+
+def read_index(shard_path):
+    """Index records of a shard. Each record has `key`, `image_id` and, for each member extension, its
+    `[offset, size]` in the tar file."""
+
+    with open(index_path(shard_path), 'r', encoding='UTF-8') as fp:
+        return [json.loads(line) for line in fp]
+
+
+def read_member(shard_path, record, ext):
+    """Random access to one member of a shard, using its index record."""
+
+    offset, size = record[ext]
+    with open(shard_path, 'rb') as fp:
+        fp.seek(offset)
+        return fp.read(size)
+
+
+def split_member_name(name):
+    """`(key, ext)` of a tar member name. As in WebDataset, the key ends at the first dot of the base name, so an
+    extension can itself contain dots (`<key>.384.jpg`)."""
+
+    dir_name, fn = os.path.split(name)
+    key, ext = fn.split('.', 1)
+
+    return os.path.join(dir_name, key) if dir_name else key, ext
+
+
+def iter_shard(shard_path):
+    """Sequentially yields `(key, {ext: bytes})` for the samples of a shard, in write order."""
+
+    key, sample = None, {}
+    with tarfile.open(shard_path, 'r|') as tar:
+        for member in tar:
+            member_key, ext = split_member_name(member.name)
+            if member_key != key and sample:
+                yield key, sample
+                sample = {}
+            key = member_key
+            sample[ext] = tar.extractfile(member).read()
+    if sample:
+        yield key, sample
+
+
+class TarShardWriter:
+    """Packs samples into WebDataset-style tar shards: `<prefix>-000000.tar`, `<prefix>-000001.tar`, ...
+
+    A sample is a key (without dots) and a dict `{ext: bytes}`, stored as the tar members `<key>.<ext>`. A shard is
+    closed once it has `max_count` samples or `max_size` bytes. Each shard gets an index `<prefix>-NNNNNN.index.jsonl`
+    giving, for each sample, the offset and size of its members in the (uncompressed) tar, for random access.
+
+    Shards are written sequentially to a `.tmp` file, and only renamed to their final name once complete and
+    fsync'ed (the index first, then the tar), so a shard either exists completely or not at all. Leftovers of an
+    interrupted run are removed on start: the samples in them have to be written again, which is what
+    `done_ids` / the `write` return value let the caller track.
+    """
+
+    def __init__(self, output_dir, prefix, max_count=10000, max_size=1 << 30):
+
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_count = max_count
+        self.max_size = max_size
+
+        os.makedirs(output_dir, exist_ok=True)
+        self._remove_incomplete()
+
+        paths = shard_paths(output_dir, prefix)
+        self.shard_idx = int(paths[-1][-len(SHARD_SUFFIX) - 6:-len(SHARD_SUFFIX)]) + 1 if paths else 0
+
+        self._fp = None
+        self._tar = None
+        self._index = []
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def _shard_path(self, shard_idx):
+
+        return os.path.join(self.output_dir, f'{self.prefix}-{shard_idx:06d}{SHARD_SUFFIX}')
+
+    def _remove_incomplete(self):
+
+        for path in glob.glob(os.path.join(self.output_dir, f'{self.prefix}-*{TMP_SUFFIX}')):
+            os.unlink(path)
+
+        # an index whose tar was never renamed
+        for path in glob.glob(os.path.join(self.output_dir, f'{self.prefix}-*{INDEX_SUFFIX}')):
+            if not os.path.isfile(path[:-len(INDEX_SUFFIX)] + SHARD_SUFFIX):
+                os.unlink(path)
+
+    def done_ids(self):
+        """The `image_id`s of all the samples in committed shards."""
+
+        ids = set()
+        for path in shard_paths(self.output_dir, self.prefix):
+            ids.update(record['image_id'] for record in read_index(path))
+
+        return ids
+
+    def _open(self):
+
+        self._fp = open(self._shard_path(self.shard_idx) + TMP_SUFFIX, 'wb')
+        self._tar = tarfile.open(fileobj=self._fp, mode='w', format=tarfile.USTAR_FORMAT)
+        self._index = []
+
+    def write(self, key, files, image_id):
+        """Add a sample. Returns the `image_id`s of the samples that got committed by this call (when it completes a
+        shard), otherwise an empty list."""
+
+        if self._tar is None:
+            self._open()
+
+        if '.' in os.path.basename(key):
+            raise ValueError(f'a sample key can\'t contain a dot: {key}')
+
+        record = {'key': key, 'image_id': image_id}
+        mtime = time.time()
+        for ext, data in files.items():
+            info = tarfile.TarInfo(f'{key}.{ext}')
+            info.size = len(data)
+            info.mtime = mtime
+            offset_data = self._tar.offset + len(info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors))
+            self._tar.addfile(info, io.BytesIO(data))
+            record[ext] = [offset_data, info.size]
+        self._index.append(record)
+
+        if len(self._index) >= self.max_count or self._fp.tell() >= self.max_size:
+            return self.commit()
+
+        return []
+
+    def commit(self):
+        """Close and commit the current shard (if any). Returns the `image_id`s it contains."""
+
+        if self._tar is None:
+            return []
+
+        self._tar.close()
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._fp.close()
+
+        shard_path = self._shard_path(self.shard_idx)
+        with open(index_path(shard_path) + TMP_SUFFIX, 'w', encoding='UTF-8') as fp:
+            fp.write(''.join(json.dumps(record) + '\n' for record in self._index))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.rename(index_path(shard_path) + TMP_SUFFIX, index_path(shard_path))
+        os.rename(shard_path + TMP_SUFFIX, shard_path)
+        _fsync_dir(self.output_dir)
+
+        committed = [record['image_id'] for record in self._index]
+
+        self.shard_idx += 1
+        self._fp = None
+        self._tar = None
+        self._index = []
+
+        return committed
+
+    def close(self):
+
+        return self.commit()
@@ -0,0 +1,360 @@
+import re
+
+
+to_remove = ['.', '?', ',', '!', '&', '_', '-', '=', ';', ':']
+
+regex = re.compile(r'( \'[^ ]*(?: |$))', flags=re.IGNORECASE)
+# Used to deal with the cases like " \\ 't ", for example, "won \\ 't need".
+regex_2 = re.compile(r'( \\ \'t(?: |$))', flags=re.IGNORECASE)
+apostrophe_to_check = {
+    " 'm", " 'll ", " 'm ", " 're", " 's", " 's ",
+    " 'd", " 're ", " 've ", " 've", " 'd ", " 't ", " 't"
+}
+
+prefix_targets = [
+    "a black and white photograph of ",
+    "a black and white portrait of ",
+    "a black and white picture of ",
+    "a black and white photo of ",
+    "a black and white image of ",
+
+    "black and white photograph of ",
+    "black and white portrait of ",
+    "black and white picture of ",
+    "black and white photo of ",
+    "black and white image of ",
+
+    "an old photograph of ",
+    "an old portrait of ",
+    "an old picture of ",
+    "an old photo of ",
+    "an old image of ",
+
+    "old photograph of ",
+    "old portrait of ",
+    "old picture of ",
+    "old photo of ",
+    "old image of ",
+
+    "a photograph - like illustration of ",
+    "a photograph-like illustration of ",
+    "a photograph like illustration of ",
+    "a photographic illustration of ",
+    "a colorful illustration of ",
+    "a color illustration of ",
+    "an illustration of ",
+
+    "photograph - like illustration of ",
+    "photograph-like illustration of ",
+    "photograph like illustration of ",
+    "photographic illustration of ",
+    "colorful illustration of ",
+    "color illustration of ",
+    "illustration of ",
+
+    "a photograph of ",
+    "a portrait of ",
+    "a picture of ",
+    "a photo of ",
+    "an image of ",
+    "a view of ",
+    "a scene of ",
+
+    "photograph of ",
+    "portrait of ",
+    "picture of ",
+    "photo of ",
+    "image of ",
+    "view of ",
+    "scene of ",
+
+    "a close - up on ",
+    "a close-up on ",
+    "a close up on ",
+    "a closeup on ",
+
+    "close - up on ",
+    "close-up on ",
+    "close up on ",
+    "closeup on ",
+
+    "a close - up of ",
+    "a close-up of ",
+    "a close up of ",
+    "a closeup of ",
+
+    "close - up of ",
+    "close-up of ",
+    "close up of ",
+    "closeup of ",
+
+    "close - up ",
+    "close-up ",
+    "close up ",
+    "closeup ",
+
+    "a couple of ",
+    "a group of ",
+    "a bunch of ",
+
+    "there are ",
+    "there is ",
+
+    "these are ",
+    "this is ",
+
+    "a lot of ",
+    "some of ",
+    "several ",
+    "a few ",
+    "some ",
+    "many ",
+    "and ",
+    "or ",
+    "of ",
+]
+
+postfix_targets = [
+    ' in the background.',
+    ' in the background',
+    ' in the foreground.',
+    ' in the foreground',
+    ' in background.',
+    ' in background',
+    ' in foreground.',
+    ' in foreground',
+    ' and',
+    ' or'
+]
+
+
+def remove_space_before_apostrophe(text):
+
+    def repl(match_obj):
+
+        assert match_obj.group(0)[0] == ' '
+
+        result = match_obj.group(0)
+        if result.lower() in apostrophe_to_check:
+            result = result[1:]
+
+        return result
+
+    modified = regex.sub(repl, text)
+
+    return modified
+
+
+def remove_2(text):
+
+    def repl(match_obj):
+
+        assert match_obj.group(0).lower().startswith(" \\ 't")
+        return match_obj.group(0)[len(" \\"):]
+
+    modified = regex_2.sub(repl, text)
+
+    return modified
+
+
+def _process_1_annotation(text):
+
+    text = text.strip()
+    text = remove_2(text)
+
+    while '...' in text:
+        text = text.replace('...', ' , ').strip()
+    while '--' in text:
+        text = text.replace('--', ' - ').strip()
+    while '  ' in text:
+        text = text.replace('  ', ' ').strip()
+
+    # remove trailing '.'
+    while text[-1] in to_remove:
+        text = text[:-1].strip()
+    while text[0] in to_remove:
+        text = text[1:].strip()
+
+    text = remove_space_before_apostrophe(text)  # TODO: check case
+
+    for target in postfix_targets:
+        if text[-len(target):].lower() == target:
+            text = text[:-len(target)].strip()
+
+    for target in prefix_targets:
+        if text[:len(target)].lower() == target:
+            text = text[len(target):].strip()
+
+    return text
+
+
+def process_1_annotation(text):
+
+    new_text = _process_1_annotation(text)
+    while new_text != text:
+        text = new_text
+        new_text = _process_1_annotation(text)
+
+    return text
+
+
+class CaptionNormalizer:
+    """Compiled equivalent of `process_1_annotation`.
+
+    A pass does the same steps as `_process_1_annotation`, but:
+
+        - the `while ... replace` loops are single `str.replace` / regex substitutions (one `replace` already leaves
+          no `...` or `--`),
+        - the leading/trailing `to_remove` characters are stripped with one regex each,
+        - instead of testing ~100 prefix (and 10 postfix) targets one by one, the candidate prefixes of the text that
+          end with a space (all the targets do) are looked up in a dict `target -> positions in the list`. After a
+          target is removed, the search continues with the targets after it, as the `for` loop does. Postfixes work
+          the same way from the end of the text, on candidates starting with a space.
+
+    Passes are repeated until the text doesn't change, and a batch is normalized with each distinct caption
+    processed once. Captions that make `process_1_annotation` fail (those reduced to an empty string) raise the
+    same `IndexError`.
+    """
+
+    def __init__(self, prefix_targets=prefix_targets, postfix_targets=postfix_targets, to_remove=to_remove):
+
+        assert all(t.endswith(' ') for t in prefix_targets), "prefix targets should end with a space"
+        assert all(t.startswith(' ') for t in postfix_targets), "postfix targets should start with a space"
+
+        self.prefix_targets = list(prefix_targets)
+        self.postfix_targets = list(postfix_targets)
+
+        self._prefix_table = self._build_table(self.prefix_targets)
+        self._postfix_table = self._build_table(self.postfix_targets)
+        self._max_prefix_len = max(len(t) for t in self.prefix_targets)
+        self._max_postfix_len = max(len(t) for t in self.postfix_targets)
+        self._prefix_first_words = {t[:t.find(' ') + 1] for t in self.prefix_targets}
+        self._postfix_last_words = {t[t.rfind(' '):] for t in self.postfix_targets}
+
+        self._to_remove = set(to_remove)
+        chars = ''.join(re.escape(c) for c in to_remove)
+        self._trailing = re.compile(f'[{chars}][\\s{chars}]*\\Z')
+        self._leading = re.compile(f'[{chars}][\\s{chars}]*')
+        self._multiple_spaces = re.compile(' {2,}')
+
+    @staticmethod
+    def _build_table(targets):
+
+        table = {}
+        for idx, target in enumerate(targets):
+            table.setdefault(target, []).append(idx)
+
+        return table
+
+    @staticmethod
+    def _first_from(table, candidates, idx):
+        """The smallest position `>= idx` in the target list of any of the `candidates`."""
+
+        best = None
+        for candidate in candidates:
+            for pos in table.get(candidate, ()):
+                if pos >= idx:
+                    if best is None or pos < best:
+                        best = pos
+                    break
+
+        return best
+
+    def _remove_prefixes(self, text):
+
+        idx = 0
+        while True:
+            head = text[:self._max_prefix_len]
+            lowered = head.lower()
+            end = head.find(' ')
+            if end == -1:
+                return text
+            if len(lowered) != len(head):
+                # `lower()` changed the length (`İ`), slicing `lowered` wouldn't give `text[:n].lower()`
+                candidates = [head[:m.end()].lower() for m in re.finditer(' ', head)]
+            elif lowered[:end + 1] not in self._prefix_first_words:
+                # all targets start with one of these words: this rules out most captions with one lookup
+                return text
+            else:
+                candidates = [lowered[:m.end()] for m in re.finditer(' ', lowered)]
+            best = self._first_from(self._prefix_table, candidates, idx)
+            if best is None:
+                return text
+            text = text[len(self.prefix_targets[best]):].strip()
+            idx = best + 1
+
+    def _remove_postfixes(self, text):
+
+        idx = 0
+        while True:
+            tail = text[-self._max_postfix_len:]
+            lowered = tail.lower()
+            start = tail.rfind(' ')
+            if start == -1:
+                return text
+            if len(lowered) != len(tail):
+                candidates = [tail[m.start():].lower() for m in re.finditer(' ', tail)]
+            elif lowered[start:] not in self._postfix_last_words:
+                # all targets end with one of these words
+                return text
+            else:
+                candidates = [lowered[m.start() - len(tail):] for m in re.finditer(' ', tail)]
+            best = self._first_from(self._postfix_table, candidates, idx)
+            if best is None:
+                return text
+            text = text[:-len(self.postfix_targets[best])].strip()
+            idx = best + 1
+
+    def _normalize_once(self, text):
+
+        text = text.strip()
+        if ' \\ \'' in text:
+            text = remove_2(text)
+
+        if '...' in text:
+            text = text.replace('...', ' , ').strip()
+        if '--' in text:
+            text = text.replace('--', ' - ').strip()
+        if '  ' in text:
+            text = self._multiple_spaces.sub(' ', text).strip()
+
+        # remove trailing '.'
+        if text and text[-1] in self._to_remove:
+            text = text[:self._trailing.search(text).start()].rstrip()
+        if not text:
+            # where `_process_1_annotation` fails on `text[-1]`
+            raise IndexError('string index out of range')
+        if text[0] in self._to_remove:
+            text = text[self._leading.match(text).end():]
+
+        if " '" in text:
+            text = remove_space_before_apostrophe(text)
+
+        text = self._remove_postfixes(text)
+        text = self._remove_prefixes(text)
+
+        return text
+
+    def normalize(self, text):
+
+        new_text = self._normalize_once(text)
+        while new_text != text:
+            text = new_text
+            new_text = self._normalize_once(text)
+
+        return text
+
+    def __call__(self, texts):
+        """Normalize a list of captions, returns a list."""
+
+        cache = {}
+        normalized = []
+        for text in texts:
+            if text not in cache:
+                cache[text] = self.normalize(text)
+            normalized.append(cache[text])
+
+        return normalized
+
+
+normalize_captions = CaptionNormalizer()
@@ -0,0 +1,184 @@
+import time
+import random
+import zlib
+import logging
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TranslationBackend:
+    """A translator: `translate(text, src, dest)` returns the translated text, or raises on errors.
+
+    `name` identifies the backend (for example in the translation cache keys).
+    """
+
+    name = None
+
+    def translate(self, text, src, dest):
+        raise NotImplementedError
+
+
+class GoogletransBackend(TranslationBackend):
+    """`googletrans`, with one `Translator` per thread."""
+
+    name = 'googletrans'
+
+    def __init__(self):
+
+        self._local = threading.local()
+
+    def translate(self, text, src, dest):
+
+        translator = getattr(self._local, 'translator', None)
+        if translator is None:
+            from googletrans import Translator
+            translator = Translator()
+            self._local.translator = translator
+
+        return translator.translate(text, src=src, dest=dest).text
+
+
+class StubBackend(TranslationBackend):
+    """Deterministic offline translator, returns `[<dest>] <line>` for each line of the text (lines without letters or
+    digits are kept as they are).
+
+    Each call sleeps `latency` seconds. A fraction `failure_rate` of the (text, dest) pairs (chosen by hash) fail on
+    their first `n_failures` calls, to exercise retries. A fraction `merge_rate` of the texts of several lines get two
+    of their lines merged, as a real translator sometimes does with packed captions (see
+    `cc3m_processing.translate_pack`). `n_requests` counts the calls.
+    """
+
+    name = 'stub'
+
+    def __init__(self, latency=0.0, failure_rate=0.0, n_failures=1, merge_rate=0.0):
+
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.n_failures = n_failures
+        self.merge_rate = merge_rate
+
+        self.n_requests = 0
+        self._n_calls = {}
+        self._lock = threading.Lock()
+
+    def translate(self, text, src, dest):
+
+        key = (text, dest)
+        with self._lock:
+            self.n_requests += 1
+            n_calls = self._n_calls.get(key, 0)
+            self._n_calls[key] = n_calls + 1
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        h = zlib.crc32(f'{dest}\0{text}'.encode('UTF-8'))
+        if h % 1000 < 1000 * self.failure_rate and n_calls < self.n_failures:
+            raise ConnectionError(f'stub failure for {key}')
+
+        lines = text.split('\n')
+        if len(lines) > 1 and (h >> 10) % 1000 < 1000 * self.merge_rate:
+            idx = (h >> 20) % (len(lines) - 1)
+            lines[idx:idx + 2] = [f'{lines[idx]} {lines[idx + 1]}']
+
+        return '\n'.join(f'[{dest}] {line}' if any(c.isalnum() for c in line) else line for line in lines)
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class TranslationEngine:
+    """Runs translation jobs on a persistent thread pool.
+
+    `map(fn, jobs)` calls `fn(*job)` for each job, with up to `n_workers` calls in flight, and returns the results in
+    the order of `jobs`. Identical jobs are only run once. Every call (including retries) first takes a token from a
+    `TokenBucket` of `rate` calls per second (no limit if `rate` is `None`). A call that raises is retried with
+    exponential backoff and jitter, up to `max_attempts` calls in total; a job that still fails gets `None`.
+    """
+
+    def __init__(self, n_workers=8, rate=None, burst=None, max_attempts=6, backoff=0.5, max_backoff=30.0):
+
+        self.n_workers = n_workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self._pool = ThreadPoolExecutor(n_workers)
+
+        self.n_calls = 0
+        self.n_errors = 0
+        self.n_failed = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def _call(self, fn, job):
+
+        for attempt in range(self.max_attempts):
+
+            if self._bucket is not None:
+                self._bucket.acquire()
+
+            try:
+                with self._lock:
+                    self.n_calls += 1
+                return fn(*job)
+            except Exception as e:
+                with self._lock:
+                    self.n_errors += 1
+                if attempt + 1 < self.max_attempts:
+                    time.sleep(min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0))
+                else:
+                    logging.info(f'translation failed after {self.max_attempts} attempts: {job}: {repr(e)}')
+
+        with self._lock:
+            self.n_failed += 1
+
+        return None
+
+    def map(self, fn, jobs):
+
+        jobs = list(jobs)
+        unique_jobs = list(dict.fromkeys(jobs))
+        results = dict(zip(unique_jobs, self._pool.map(partial(self._call, fn), unique_jobs)))
+
+        return [results[job] for job in jobs]
+
+    def stats(self):
+
+        return {'n_calls': self.n_calls, 'n_errors': self.n_errors, 'n_failed': self.n_failed}
+
+    def close(self):
+
+        self._pool.shutdown(wait=True)
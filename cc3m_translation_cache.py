@@ -0,0 +1,164 @@
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class TranslationCache:
+    """Persistent translation cache, keyed by (normalized English text, target language, backend).
+
+    Translations are stored in SQLite under a content hash of the key, with an in-process LRU of `lru_size` entries in
+    front of it. Writes (new translations and last-use times) are buffered and committed every `commit_every`
+    operations. If `max_entries` is set, the least recently used entries are evicted from the database when it grows
+    past it (checked on commit).
+
+    `stats()` reports the hits (from memory or from the database) and misses.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS translations (
+            key BLOB PRIMARY KEY,
+            backend TEXT NOT NULL,
+            lang TEXT NOT NULL,
+            text TEXT NOT NULL,
+            translation TEXT NOT NULL,
+            last_used REAL NOT NULL
+        )
+    """
+
+    def __init__(self, path, backend, lru_size=100000, max_entries=None, commit_every=1000):
+
+        self.path = path
+        self.backend = backend
+        self.lru_size = lru_size
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+
+        self._lru = OrderedDict()
+        self._pending = {}
+        self._touched = {}
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(self._SCHEMA)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used)')
+        self._conn.commit()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def _key(self, text, lang):
+
+        return hashlib.sha1('\0'.join([self.backend, lang, text]).encode('UTF-8')).digest()
+
+    def _remember(self, key, translation):
+
+        self._lru[key] = translation
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, text, lang):
+        """The cached translation of `text` into `lang`, or `None`."""
+
+        key = self._key(text, lang)
+
+        with self._lock:
+
+            translation = self._lru.get(key)
+            if translation is not None:
+                self._lru.move_to_end(key)
+                self._touched[key] = time.time()
+                self.memory_hits += 1
+                return translation
+
+            row = self._conn.execute('SELECT translation FROM translations WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            translation = row[0]
+            self._remember(key, translation)
+            self._touched[key] = time.time()
+            self.db_hits += 1
+            self._maybe_commit()
+
+        return translation
+
+    def put(self, text, lang, translation):
+
+        key = self._key(text, lang)
+
+        with self._lock:
+            self._remember(key, translation)
+            self._pending[key] = (key, self.backend, lang, text, translation, time.time())
+            self._maybe_commit()
+
+    def stats(self):
+
+        n_lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.db_hits) / n_lookups if n_lookups > 0 else 0.0,
+        }
+
+    def __len__(self):
+
+        with self._lock:
+            self._commit()
+            return self._conn.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+
+    def _maybe_commit(self):
+
+        if len(self._pending) + len(self._touched) >= self.commit_every:
+            self._commit()
+
+    def _commit(self):
+
+        if self._pending:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO translations (key, backend, lang, text, translation, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                list(self._pending.values())
+            )
+        if self._touched:
+            self._conn.executemany(
+                'UPDATE translations SET last_used = ? WHERE key = ?',
+                [(last_used, key) for key, last_used in self._touched.items()]
+            )
+        if self._pending and self.max_entries is not None:
+            n_entries = self._conn.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+            if n_entries > self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM translations WHERE key IN '
+                    '(SELECT key FROM translations ORDER BY last_used LIMIT ?)',
+                    (n_entries - self.max_entries,)
+                )
+        self._conn.commit()
+        self._pending = {}
+        self._touched = {}
+
+    def flush(self):
+
+        with self._lock:
+            self._commit()
+
+    def close(self):
+
+        with self._lock:
+            self._commit()
+            self._conn.close()
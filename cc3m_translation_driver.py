@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import logging
+import argparse
+import multiprocessing as mp
+
+import cc3m_processing
+from cc3m_jsonl_index import JsonlIndex, entry_id
+from cc3m_jsonl_io import JsonlWriter, is_compressed, iter_entries
+
+
+class SharedRange:
+    """The range `[start, end)` of one chunk, shared between the driver and the worker process translating it.
+
+    The worker `claim`s each id before processing it, and the driver can move `end` down (to give the rest of the chunk
+    to another worker) with `split`. Both happen under the same lock, so an id is never processed by both.
+    """
+
+    def __init__(self, start, end):
+
+        self.start = start
+        self._lock = mp.Lock()
+        self._end = mp.Value('q', end, lock=False)
+        self._last_id = mp.Value('q', start - 1, lock=False)
+        self._n_done = mp.Value('q', 0, lock=False)
+
+    @property
+    def end(self):
+
+        return self._end.value
+
+    @property
+    def n_done(self):
+
+        return self._n_done.value
+
+    def claim(self, _id):
+
+        with self._lock:
+            if _id >= self._end.value:
+                return False
+            self._last_id.value = _id
+            return True
+
+    def add_done(self, n):
+
+        with self._lock:
+            self._n_done.value += n
+
+    def remaining(self):
+
+        with self._lock:
+            return self._end.value - self._last_id.value - 1
+
+    def split(self, min_size):
+        """Give away the second half of what is left, if at least `min_size` ids. Returns the new `[start, end)` or
+        `None`."""
+
+        with self._lock:
+            end = self._end.value
+            mid = (self._last_id.value + 1 + end + 1) // 2
+            if end - mid < min_size:
+                return None
+            self._end.value = mid
+
+        return mid, end
+
+
+def _translate_chunk(args, chunk_dir, shared_range):
+
+    cc3m_processing.setup_translation(args)
+    cc3m_processing.translate_annotations(
+        args.input_dir, args.input_fn, chunk_dir, chunk_fn(shared_range.start), cc3m_processing.langs,
+        batch_size=args.batch_size, buf_size=args.buf_size, inf=shared_range.start, sup=None,
+        shared_range=shared_range, normalized=args.normalized
+    )
+    cc3m_processing.close_translation()
+
+
+def chunk_fn(start):
+
+    return f'{start:09d}.jsonl'
+
+
+class TranslationDriver:
+    """Translates `[inf, sup)` with up to `n_workers` processes on one node.
+
+    The range is cut into chunks of `chunk_size` ids, each translated by its own process (with
+    `cc3m_processing.translate_annotations`) into `<chunk_dir>/<start>.jsonl`, so an interrupted run resumes each
+    chunk where it stopped. When no chunk is left to start and a worker is free, the running chunk with the most ids
+    left is split and its second half handed to a new worker (work stealing).
+
+    The chunk plan is saved in `<chunk_dir>/chunks.json` whenever it changes. Once every chunk is done, the chunk
+    outputs are merged, in id order, into `<output_dir>/<output_fn>`.
+
+    A chunk whose worker fails is restarted, up to `max_attempts` times in total, then the run is aborted.
+
+    `--translation_rate` and `--translation_workers` are limits for the node: each worker gets `1 / n_workers` of
+    them.
+    """
+
+    def __init__(
+            self, args, output_dir, output_fn, n_workers, chunk_size, min_split_size=None, report_every=60,
+            max_attempts=3):
+
+        self.args = args
+        self.output_dir = output_dir
+        self.output_fn = output_fn
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.min_split_size = min_split_size or max(1, chunk_size // 10)
+        self.report_every = report_every
+        self.max_attempts = max_attempts
+
+        self.chunk_dir = os.path.join(output_dir, output_fn + '.chunks')
+        self.plan_path = os.path.join(self.chunk_dir, 'chunks.json')
+        os.makedirs(self.chunk_dir, exist_ok=True)
+
+        # the arguments of the workers, with their share of the translation limits
+        self.worker_args = argparse.Namespace(**vars(args))
+        self.worker_args.translation_rate = args.translation_rate / n_workers
+        self.worker_args.translation_workers = max(1, args.translation_workers // n_workers)
+
+    def _load_plan(self, inf, sup):
+
+        if os.path.isfile(self.plan_path):
+            with open(self.plan_path, 'r', encoding='UTF-8') as fp:
+                plan = json.load(fp)
+            if plan['inf'] == inf and plan['sup'] == sup:
+                return plan
+
+        chunks = [[start, min(start + self.chunk_size, sup)] for start in range(inf, sup, self.chunk_size)]
+        return {'inf': inf, 'sup': sup, 'chunks': chunks, 'done': []}
+
+    def _save_plan(self, plan):
+
+        with open(self.plan_path + '.tmp', 'w', encoding='UTF-8') as fp:
+            json.dump(plan, fp)
+        os.replace(self.plan_path + '.tmp', self.plan_path)
+
+    def _start(self, shared_range):
+
+        process = mp.Process(target=_translate_chunk, args=(self.worker_args, self.chunk_dir, shared_range))
+        process.start()
+        return process
+
+    def _report(self, running, n_total, n_done_before, s):
+
+        n_done = n_done_before + sum(r.n_done for r, _ in running.values())
+        elapsed = time.time() - s
+        msg = (
+            f'{n_done} / {n_total} entries done, {len(running)} workers, '
+            f'{(n_done - self._n_done_at_start) / max(elapsed, 1e-9):.1f} entries/sec'
+        )
+        logging.info(msg)
+        print(msg)
+
+    def run(self, inf, sup):
+
+        input_path = os.path.join(self.args.input_dir, self.args.input_fn)
+        if not is_compressed(input_path):
+            # built once here, rather than by every worker at the same time
+            JsonlIndex.load_or_build(input_path)
+
+        plan = self._load_plan(inf, sup)
+        self._save_plan(plan)
+
+        done = {tuple(x) for x in plan['done']}
+        pending = [tuple(x) for x in plan['chunks'] if tuple(x) not in done]
+        running = {}
+        # chunk start -> number of failed workers
+        n_failures = {}
+
+        n_done_before = sum(end - start for start, end in done)
+        self._n_done_at_start = n_done_before
+        s = time.time()
+        last_report = s
+
+        while pending or running:
+
+            while pending and len(running) < self.n_workers:
+                start, end = pending.pop(0)
+                shared_range = SharedRange(start, end)
+                running[start] = (shared_range, self._start(shared_range))
+
+            # steal work for the free workers
+            while not pending and len(running) < self.n_workers and running:
+                victim = max(running.values(), key=lambda x: x[0].remaining())[0]
+                stolen = victim.split(self.min_split_size)
+                if stolen is None:
+                    break
+                plan['chunks'] = [x for x in plan['chunks'] if x[0] != victim.start]
+                plan['chunks'] += [[victim.start, stolen[0]], list(stolen)]
+                self._save_plan(plan)
+                logging.info(f'chunk {victim.start} split at {stolen[0]}')
+                shared_range = SharedRange(*stolen)
+                running[stolen[0]] = (shared_range, self._start(shared_range))
+
+            time.sleep(1)
+
+            for start, (shared_range, process) in list(running.items()):
+                if process.is_alive():
+                    continue
+                del running[start]
+                if process.exitcode != 0:
+                    n_failures[start] = n_failures.get(start, 0) + 1
+                    if n_failures[start] >= self.max_attempts:
+                        self._abort(running)
+                        raise RuntimeError(
+                            f'chunk {start} to {shared_range.end} failed {n_failures[start]} times (last exit code '
+                            f'{process.exitcode}), see cc3m-data.log'
+                        )
+                    logging.error(f'chunk {start} failed with exit code {process.exitcode}, restarting it')
+                    pending.append((start, shared_range.end))
+                    continue
+                done.add((start, shared_range.end))
+                n_done_before += shared_range.end - start
+                plan['done'] = sorted(done)
+                self._save_plan(plan)
+
+            if time.time() - last_report >= self.report_every:
+                self._report(running, sup - inf, n_done_before, s)
+                last_report = time.time()
+
+        self._report(running, sup - inf, n_done_before, s)
+
+        return self.merge(sorted(done))
+
+    def _abort(self, running):
+
+        for _, process in running.values():
+            process.terminate()
+        for _, process in running.values():
+            process.join()
+
+    def merge(self, chunks):
+        """Concatenate the chunk outputs in id order into the final output file.
+
+        A chunk resumed after an interruption can be split before its worker skipped past the entries it had already
+        translated, so the same id may appear in two chunk outputs: only the first one is kept.
+        """
+
+        output_path = os.path.join(self.output_dir, self.output_fn)
+        ids = set()
+        n_entries = 0
+        with JsonlWriter(output_path + '.tmp') as writer:
+            for start, end in chunks:
+                path = os.path.join(self.chunk_dir, chunk_fn(start))
+                if not os.path.isfile(path):
+                    continue
+                entries = sorted(iter_entries(path), key=entry_id)
+                for entry in entries:
+                    if entry_id(entry) in ids:
+                        continue
+                    ids.add(entry_id(entry))
+                    writer.write(entry)
+                    n_entries += 1
+        os.replace(output_path + '.tmp', output_path)
+        logging.info(f'{n_entries} entries merged into {output_path}')
+
+        return output_path
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--input_dir", help="", required=True)
+    parser.add_argument("--input_fn", help="", required=True)
+    parser.add_argument("--batch_size", help="", type=int, default=100)
+    parser.add_argument("--buf_size", help="", type=int, default=100)
+    parser.add_argument("--inf", help="", type=int, required=True)
+    parser.add_argument("--sup", help="", type=int, required=True)
+    parser.add_argument("--output_dir", help="", required=True)
+    parser.add_argument("--n_workers", help="number of worker processes", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk_size", help="number of ids per chunk", type=int, default=10000)
+    cc3m_processing.add_translation_arguments(parser)
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    output_fn = f'cc3m_train_translated_{args.inf}_to_{args.sup}.jsonl'
+
+    driver = TranslationDriver(args, args.output_dir, output_fn, n_workers=args.n_workers, chunk_size=args.chunk_size)
+    driver.run(args.inf, args.sup)
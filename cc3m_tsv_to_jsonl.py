@@ -1,6 +1,9 @@
 import pandas as pd
-import json
+import argparse
 from copy import deepcopy
+from multiprocessing import Pool
+
+from cc3m_jsonl_io import JsonlWriter, dumps
 
 
 default_entry = {
@@ -14,7 +17,7 @@ default_entry = {
 def convert_to_jsonl(chunked_df, output_fn):
 
     idx = -1
-    with open(output_fn, 'w', encoding='UTF-8') as fp:
+    with JsonlWriter(output_fn) as writer:
 
         for chunk in chunked_df:
             for _, row in list(chunk.iterrows()):
@@ -27,8 +30,8 @@ def convert_to_jsonl(chunked_df, output_fn):
                 entry['caption'] = row[0]
                 entry['image_url'] = row[1]
 
-                jsonl = json.dumps(entry, ensure_ascii=False, indent=None)
-                fp.write(jsonl + '\n')
+                jsonl = dumps(entry)
+                writer.write_lines([jsonl])
 
                 if (idx + 1) % 10000 == 0:
                     print(idx)
@@ -36,10 +39,79 @@ def convert_to_jsonl(chunked_df, output_fn):
                     print('-' * 120)
 
 
+def _chunk_to_jsonl(args):
+    """Serialize one chunk (`start` id, caption column, url column) into a block of jsonl lines.
+
+    The entries are written as formatted strings with the same key order and separators as `json.dumps(entry)`, so
+    the output is byte-identical to `convert_to_jsonl`.
+    """
+
+    start, captions, image_urls = args
+
+    lines = [
+        f'{{"image_id": {idx}, "id": {idx}, "caption": {dumps(caption)}, "image_url": {dumps(image_url)}}}\n'
+        for idx, caption, image_url in zip(range(start, start + len(captions)), captions, image_urls)
+    ]
+
+    return ''.join(lines)
+
+
+def _iter_chunk_columns(chunked_df):
+
+    start = 0
+    for chunk in chunked_df:
+        # `tolist()` gives python objects (str / float('nan')), which is what `json.dumps` sees in `convert_to_jsonl`.
+        captions = chunk[0].tolist()
+        image_urls = chunk[1].tolist()
+        yield start, captions, image_urls
+        start += len(captions)
+
+
+def convert_to_jsonl_columnar(chunked_df, output_fn, n_workers=0):
+    """Same output as `convert_to_jsonl`, but works on whole chunks: ids are assigned per chunk, each chunk is
+    serialized in bulk and written with a single `write`.
+
+    If `n_workers > 0`, chunks are serialized in a process pool. The results are consumed in order, so the output
+    file is still identical.
+    """
+
+    n_rows = 0
+    with JsonlWriter(output_fn) as writer:
+
+        columns = _iter_chunk_columns(chunked_df)
+
+        if n_workers > 0:
+            with Pool(n_workers) as p:
+                for data in p.imap(_chunk_to_jsonl, columns):
+                    writer.write_data(data)
+                    n_rows += data.count('\n')
+                    print(n_rows - 1)
+        else:
+            for data in map(_chunk_to_jsonl, columns):
+                writer.write_data(data)
+                n_rows += data.count('\n')
+                print(n_rows - 1)
+
+    return n_rows
+
+
 if __name__ == "__main__":
 
-    df = pd.read_csv('cc3m_captions_train.tsv', sep='\t', iterator=True, chunksize=50000, header=None)
-    convert_to_jsonl(df, output_fn='cc3m_train.jsonl')
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--mode", help="", choices=['row', 'columnar'], default='columnar')
+    parser.add_argument("--n_workers", help="", type=int, default=0)
+    parser.add_argument("--chunksize", help="", type=int, default=50000)
+    parser.add_argument("--compression", help="compress the output jsonl files", choices=['gz', 'zst'], required=False)
+
+    args = parser.parse_args()
+
+    for split in ['train', 'valid']:
+
+        output_fn = f'cc3m_{split}.jsonl' + (f'.{args.compression}' if args.compression else '')
 
-    df = pd.read_csv('cc3m_captions_valid.tsv', sep='\t', iterator=True, chunksize=50000, header=None)
-    convert_to_jsonl(df, output_fn='cc3m_valid.jsonl')
+        df = pd.read_csv(f'cc3m_captions_{split}.tsv', sep='\t', iterator=True, chunksize=args.chunksize, header=None)
+        if args.mode == 'row':
+            convert_to_jsonl(df, output_fn=output_fn)
+        else:
+            convert_to_jsonl_columnar(df, output_fn=output_fn, n_workers=args.n_workers)
@@ -0,0 +1,448 @@
+import os
+import json
+import time
+import random
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+from collections import namedtuple
+
+
+# range states
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+
+# `token` is increased every time the range is leased, so a node whose lease expired (and was taken over by another
+# node) can no longer renew or complete it.
+Lease = namedtuple('Lease', ['inf', 'sup', 'owner', 'token', 'expires_at'])
+
+
+class LeaseStore:
+    """Where the id ranges to process and their leases are kept.
+
+    A range is `pending` until a node leases it, `leased` until the node completes it, and `done` after that. A
+    lease that isn't renewed before it expires can be acquired by any node.
+    """
+
+    def add_ranges(self, ranges):
+        """Add the `(inf, sup)` ranges which aren't known yet as `pending`."""
+
+        raise NotImplementedError
+
+    def acquire(self, owner, duration, now=None):
+        """Lease a pending (or expired) range to `owner` for `duration` seconds. Returns a `Lease` or `None`."""
+
+        raise NotImplementedError
+
+    def renew(self, lease, duration, now=None):
+        """Extend `lease` by `duration` seconds. Returns the new `Lease`, or `None` if the lease was lost."""
+
+        raise NotImplementedError
+
+    def complete(self, lease):
+        """Mark the range of `lease` as done. Returns `False` if the lease was lost."""
+
+        raise NotImplementedError
+
+    def release(self, lease):
+        """Give the range of `lease` back, so another node can take it right away."""
+
+        raise NotImplementedError
+
+    def counts(self, now=None):
+        """Returns a dict `state -> number of ranges`, with expired leases counted as `expired`."""
+
+        raise NotImplementedError
+
+    def close(self):
+
+        pass
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """`LeaseStore` in a SQLite database, for the nodes of a single machine: SQLite locking isn't reliable on network
+    filesystems (NFS, GCSFuse), use `GCSLeaseStore` for nodes on several machines.
+
+    Every operation is a single `BEGIN IMMEDIATE` transaction, so two nodes can't acquire the same range.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS ranges (
+            inf INTEGER PRIMARY KEY,
+            sup INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            owner TEXT,
+            token INTEGER NOT NULL DEFAULT 0,
+            expires_at REAL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )
+    """
+
+    def __init__(self, path, timeout=60):
+
+        self.path = path
+
+        self._lock = threading.Lock()
+        # autocommit mode, transactions are started explicitly
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute(self._SCHEMA)
+
+    def _transaction(self, fn):
+
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+        return result
+
+    def add_ranges(self, ranges):
+
+        def _add(conn):
+            conn.executemany(
+                'INSERT OR IGNORE INTO ranges (inf, sup, state) VALUES (?, ?, ?)',
+                [(inf, sup, PENDING) for inf, sup in ranges]
+            )
+
+        self._transaction(_add)
+
+    def acquire(self, owner, duration, now=None):
+
+        now = time.time() if now is None else now
+
+        def _acquire(conn):
+            row = conn.execute(
+                'SELECT inf, sup, token FROM ranges WHERE state = ? OR (state = ? AND expires_at < ?) '
+                'ORDER BY inf LIMIT 1',
+                (PENDING, LEASED, now)
+            ).fetchone()
+            if row is None:
+                return None
+            inf, sup, token = row
+            conn.execute(
+                'UPDATE ranges SET state = ?, owner = ?, token = ?, expires_at = ?, attempts = attempts + 1 '
+                'WHERE inf = ?',
+                (LEASED, owner, token + 1, now + duration, inf)
+            )
+            return Lease(inf, sup, owner, token + 1, now + duration)
+
+        return self._transaction(_acquire)
+
+    def _update_held(self, lease, state, expires_at):
+
+        def _update(conn):
+            cursor = conn.execute(
+                'UPDATE ranges SET state = ?, expires_at = ? WHERE inf = ? AND state = ? AND token = ?',
+                (state, expires_at, lease.inf, LEASED, lease.token)
+            )
+            return cursor.rowcount == 1
+
+        return self._transaction(_update)
+
+    def renew(self, lease, duration, now=None):
+
+        now = time.time() if now is None else now
+        if not self._update_held(lease, LEASED, now + duration):
+            return None
+
+        return lease._replace(expires_at=now + duration)
+
+    def complete(self, lease):
+
+        return self._update_held(lease, DONE, None)
+
+    def release(self, lease):
+
+        return self._update_held(lease, PENDING, None)
+
+    def counts(self, now=None):
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT CASE WHEN state = ? AND expires_at < ? THEN ? ELSE state END AS s, COUNT(*) '
+                'FROM ranges GROUP BY s',
+                (LEASED, now, 'expired')
+            )
+            return dict(rows)
+
+    def close(self):
+
+        with self._lock:
+            self._conn.close()
+
+
+class GCSLeaseStore(LeaseStore):
+    """`LeaseStore` in a JSON object of a Google Cloud Storage bucket, for nodes on different machines (SQLite locks
+    don't work reliably on network filesystems).
+
+    Every operation reads the object, and writes it back only if it wasn't changed in the meantime (a generation
+    precondition); otherwise it starts again, up to `max_attempts` times. So, like with `SQLiteLeaseStore`, two nodes
+    can't acquire the same range. Meant for tens of ranges and nodes: each operation rewrites the whole object.
+    """
+
+    def __init__(self, bucket_name, blob_name, max_attempts=20, backoff=0.1):
+
+        from google.cloud import storage
+        from google.api_core.exceptions import PreconditionFailed
+
+        self.bucket = storage.Client().bucket(bucket_name)
+        self.blob_name = blob_name
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._precondition_failed = PreconditionFailed
+
+    def _read(self):
+        """The ranges (a dict `str(inf) -> range`) and the generation of the object (0 if it doesn't exist)."""
+
+        blob = self.bucket.get_blob(self.blob_name)
+        if blob is None:
+            return {}, 0
+
+        return json.loads(blob.download_as_bytes(if_generation_match=blob.generation)), blob.generation
+
+    def _transaction(self, fn):
+        """Apply `fn(ranges)`, which returns `(result, changed)`, and write the ranges back if they changed."""
+
+        for attempt in range(self.max_attempts):
+            try:
+                ranges, generation = self._read()
+                result, changed = fn(ranges)
+                if changed:
+                    self.bucket.blob(self.blob_name).upload_from_string(
+                        json.dumps(ranges), content_type='application/json', if_generation_match=generation
+                    )
+                return result
+            except self._precondition_failed:
+                # another node changed the object first
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+        raise RuntimeError(f'gs://{self.bucket.name}/{self.blob_name} kept changing, {self.max_attempts} attempts')
+
+    def add_ranges(self, ranges):
+
+        def _add(stored):
+            new = [(inf, sup) for inf, sup in ranges if str(inf) not in stored]
+            for inf, sup in new:
+                stored[str(inf)] = {
+                    'sup': sup, 'state': PENDING, 'owner': None, 'token': 0, 'expires_at': None, 'attempts': 0
+                }
+            return None, bool(new)
+
+        self._transaction(_add)
+
+    def acquire(self, owner, duration, now=None):
+
+        now = time.time() if now is None else now
+
+        def _acquire(stored):
+            for inf in sorted(stored, key=int):
+                r = stored[inf]
+                if r['state'] == PENDING or (r['state'] == LEASED and r['expires_at'] < now):
+                    r.update(
+                        state=LEASED, owner=owner, token=r['token'] + 1, expires_at=now + duration,
+                        attempts=r['attempts'] + 1
+                    )
+                    return Lease(int(inf), r['sup'], owner, r['token'], now + duration), True
+            return None, False
+
+        return self._transaction(_acquire)
+
+    def _update_held(self, lease, state, expires_at):
+
+        def _update(stored):
+            r = stored.get(str(lease.inf))
+            if r is None or r['state'] != LEASED or r['token'] != lease.token:
+                return False, False
+            r.update(state=state, expires_at=expires_at)
+            return True, True
+
+        return self._transaction(_update)
+
+    def renew(self, lease, duration, now=None):
+
+        now = time.time() if now is None else now
+        if not self._update_held(lease, LEASED, now + duration):
+            return None
+
+        return lease._replace(expires_at=now + duration)
+
+    def complete(self, lease):
+
+        return self._update_held(lease, DONE, None)
+
+    def release(self, lease):
+
+        return self._update_held(lease, PENDING, None)
+
+    def counts(self, now=None):
+
+        now = time.time() if now is None else now
+
+        counts = {}
+        for r in self._read()[0].values():
+            state = 'expired' if r['state'] == LEASED and r['expires_at'] < now else r['state']
+            counts[state] = counts.get(state, 0) + 1
+
+        return counts
+
+
+def open_lease_store(queue):
+    """The `LeaseStore` of `--queue`: `gs://<bucket>/<name>` for a `GCSLeaseStore`, otherwise the path of a
+    `SQLiteLeaseStore` (for the nodes of a single machine)."""
+
+    if queue.startswith('gs://'):
+        bucket_name, _, blob_name = queue[len('gs://'):].partition('/')
+        return GCSLeaseStore(bucket_name, blob_name)
+
+    return SQLiteLeaseStore(queue)
+
+
+class HeldLease:
+    """A lease being worked on, renewed by a background thread every `duration / 3` seconds.
+
+    It can be passed as `shared_range` to `cc3m_processing.translate_annotations`: `claim` returns `False` once the
+    lease is lost (renewal refused, or not renewed in time), which stops the processing of the range. `complete`
+    marks the range as done, which `WorkQueue` does after the processing if it wasn't done already.
+    """
+
+    def __init__(self, store, lease, duration):
+
+        self.store = store
+        self.lease = lease
+        self.duration = duration
+        self.n_done = 0
+        # `None` until `complete` is called, then whether the range was marked as done
+        self.completed = None
+
+        self._lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+        self._thread.start()
+
+    @property
+    def lost(self):
+
+        return self._lost.is_set() or time.time() >= self.lease.expires_at
+
+    def _renew(self):
+
+        while not self._stop.wait(self.duration / 3):
+            try:
+                lease = self.store.renew(self.lease, self.duration)
+            except Exception as e:
+                # try again at the next period, the lease is lost if it expires in the meantime
+                logging.warning(f'failed to renew lease {self.lease.inf}: {e}')
+                continue
+            if lease is None:
+                logging.error(f'lease {self.lease.inf} to {self.lease.sup} lost')
+                self._lost.set()
+                return
+            self.lease = lease
+
+    def claim(self, _id):
+
+        return self.lease.inf <= _id < self.lease.sup and not self.lost
+
+    def add_done(self, n):
+
+        self.n_done += n
+
+    def complete(self):
+        """Stop renewing the lease and mark its range as done. Returns `False` if the lease was lost."""
+
+        self.stop()
+        self.completed = not self.lost and self.store.complete(self.lease)
+
+        return self.completed
+
+    def stop(self):
+
+        self._stop.set()
+        self._thread.join()
+
+
+class WorkQueue:
+    """Hands out the ranges of a `LeaseStore` to the node `owner`, one lease at a time.
+
+        for held in queue:
+            process(held.lease.inf, held.lease.sup, shared_range=held)
+
+    The lease is completed when the loop body returns normally (unless it was lost in the meantime), and released
+    if it raises.
+    """
+
+    def __init__(self, store, owner=None, lease_duration=600, poll_interval=None, wait=False):
+
+        self.store = store
+        self.owner = owner or default_owner()
+        self.lease_duration = lease_duration
+        self.poll_interval = min(30, lease_duration / 4) if poll_interval is None else poll_interval
+        # keep polling for expired leases while other nodes hold the remaining ranges
+        self.wait = wait
+
+    def __iter__(self):
+
+        while True:
+            lease = self.store.acquire(self.owner, self.lease_duration)
+            if lease is None:
+                counts = self.store.counts()
+                if not self.wait or not (counts.get(LEASED) or counts.get('expired')):
+                    return
+                time.sleep(self.poll_interval)
+                continue
+
+            logging.info(f'{self.owner} leased {lease.inf} to {lease.sup} (token {lease.token})')
+            held = HeldLease(self.store, lease, self.lease_duration)
+            try:
+                yield held
+            except BaseException:
+                held.stop()
+                self.store.release(held.lease)
+                raise
+            held.stop()
+
+            if held.completed is None:
+                held.complete()
+            if not held.completed:
+                logging.error(f'{self.owner} lost {lease.inf} to {lease.sup} before completing it')
+            else:
+                logging.info(f'{self.owner} completed {lease.inf} to {lease.sup}')
+
+
+def default_owner():
+
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(filename='cc3m-data.log', level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("command", help="", choices=['init', 'status'])
+    parser.add_argument("--queue", help="path of the lease database (SQLite, single machine) or gs://<bucket>/<name>", required=True)
+    parser.add_argument("--inf", help="", type=int, default=0)
+    parser.add_argument("--sup", help="", type=int, required=False)
+    parser.add_argument("--range_size", help="number of ids per lease", type=int, default=100000)
+
+    args = parser.parse_args()
+
+    store = open_lease_store(args.queue)
+
+    if args.command == 'init':
+        assert args.sup is not None
+        ranges = [(inf, min(inf + args.range_size, args.sup)) for inf in range(args.inf, args.sup, args.range_size)]
+        store.add_ranges(ranges)
+
+    print(store.counts())
+    store.close()
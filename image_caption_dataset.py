@@ -5,11 +5,31 @@ import os
 import datasets
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
+
+from .cc3m_jsonl_index import JsonlIndex, entry_id
+from .cc3m_jsonl_io import COMPRESSED_SUFFIXES, is_compressed, iter_entries
+from .cc3m_image_index import MANIFEST_FN, image_files
 
 
 class ImageCaptionBuilderConfig(datasets.BuilderConfig):
 
-    def __init__(self, name, splits, langs, prefix_before_image_fn=False, zfill=1, **kwargs):
+    def __init__(
+            self, name, splits, langs, prefix_before_image_fn=False, zfill=1, inf=None, sup=None,
+            image_manifest=MANIFEST_FN, data_format='jsonl', **kwargs):
+        """`inf`/`sup`: only use the entries with `inf <= id < sup`.
+
+        `data_format`: 'jsonl' to read `<name>_jsonls/<split>/*.jsonl`, or 'parquet' to read
+        `<name>_parquets/<split>/*.parquet` (written by `cc3m_parquet_export.py`), in which only the columns of `langs`
+        are decoded.
+
+        `image_manifest`: the file (in each image directory) listing the image files, written by
+        `cc3m_image_index.py` (and at the end of a download). Without it, or if the directory changed after it was
+        written, the image directory is scanned once.
+
+        The images downloaded with `--skip_duplicates` have no file of their own: their examples get the file of the
+        image they are a copy of, from the `<name>_<split>_duplicates.json` file next to the image directory.
+        """
 
         super().__init__(name, **kwargs)
 
@@ -17,6 +37,10 @@ class ImageCaptionBuilderConfig(datasets.BuilderConfig):
         self.langs = langs
         self.prefix_before_image_fn = prefix_before_image_fn
         self.zfill = zfill
+        self.inf = inf
+        self.sup = sup
+        self.image_manifest = image_manifest
+        self.data_format = data_format
 
 
 # TODO: Add BibTeX citation
@@ -107,7 +131,7 @@ class ImageCaptionDataset(datasets.GeneratorBasedBuilder):
                     name=datasets.Split.TRAIN,
                     # These kwargs will be passed to _generate_examples
                     gen_kwargs={
-                        "jsonl_dir": os.path.join(data_dir, f'{self.config.name}_jsonls', 'train'),
+                        "data_files": self._data_files(os.path.join(data_dir, f'{self.config.name}_{self.config.data_format}s', 'train')),
                         "image_dir": os.path.join(data_dir, f'{self.config.name}_images', 'train'),
                         "split": "train",
                     }
@@ -117,7 +141,7 @@ class ImageCaptionDataset(datasets.GeneratorBasedBuilder):
                     name=datasets.Split.VALIDATION,
                     # These kwargs will be passed to _generate_examples
                     gen_kwargs={
-                        "jsonl_dir": os.path.join(data_dir, f'{self.config.name}_jsonls', 'valid'),
+                        "data_files": self._data_files(os.path.join(data_dir, f'{self.config.name}_{self.config.data_format}s', 'valid')),
                         "image_dir": os.path.join(data_dir, f'{self.config.name}_images', 'valid'),
                         "split": "valid",
                     },
@@ -127,7 +151,7 @@ class ImageCaptionDataset(datasets.GeneratorBasedBuilder):
                     name=datasets.Split.TEST,
                     # These kwargs will be passed to _generate_examples
                     gen_kwargs={
-                        "jsonl_dir": os.path.join(data_dir, f'{self.config.name}_jsonls', 'test'),
+                        "data_files": self._data_files(os.path.join(data_dir, f'{self.config.name}_{self.config.data_format}s', 'test')),
                         "image_dir": os.path.join(data_dir, f'{self.config.name}_images', 'test'),
                         "split": "test",
                     },
@@ -137,11 +161,77 @@ class ImageCaptionDataset(datasets.GeneratorBasedBuilder):
 
             splits.append(dataset)
 
+        for dataset in splits:
+            # listed once here, instead of one `os.path.isfile` per example
+            dataset.gen_kwargs["image_fns"] = image_files(dataset.gen_kwargs["image_dir"], self.config.image_manifest)
+            dataset.gen_kwargs["canonical_ids"] = self._canonical_ids(
+                dataset.gen_kwargs["image_dir"], dataset.gen_kwargs["split"]
+            )
+
         return splits
 
+    def _canonical_ids(self, image_dir, split):
+        """`image_id -> canonical image id` for the duplicate images which weren't stored (`cc3m_image_downloader.py
+        --skip_duplicates`), empty if there is no duplicates file."""
+
+        path = os.path.join(os.path.dirname(image_dir), f'{self.config.name}_{split}_duplicates.json')
+        if not os.path.isfile(path):
+            return {}
+
+        with open(path, 'r', encoding='UTF-8') as fp:
+            # JSON keys are strings
+            return {int(k): v for k, v in json.load(fp).items()}
+
+    def _data_files(self, data_dir):
+
+        # `.jsonl` files can be compressed
+        suffixes = tuple(self.config.data_format + suffix for suffix in ('',) + COMPRESSED_SUFFIXES)
+
+        # a list, so `datasets` can split the files between processes (`num_proc`)
+        return sorted(os.path.join(data_dir, fn) for fn in os.listdir(data_dir) if os.path.isfile(os.path.join(data_dir, fn)) and fn.endswith(suffixes))
+
+    def _iter_jsonl(self, jsonl_file):
+
+        id_ = -1
+        offset = 0
+        if self.config.inf is not None and not is_compressed(jsonl_file):
+            # seek straight to the first entry in the range
+            index = JsonlIndex.load_or_build(jsonl_file)
+            line = index.line_of_min_id(self.config.inf)
+            id_ += line
+            offset = index.offsets[line]
+
+        for ex in iter_entries(jsonl_file, offset=offset):
+
+            id_ += 1
+            yield id_, ex
+
+    def _iter_parquet(self, parquet_file):
+
+        pf = pq.ParquetFile(parquet_file)
+        columns = ['image_id', 'id', 'caption'] + list(self.config.langs) + ['image_url']
+        id_column = pf.schema_arrow.get_field_index('id')
+
+        id_ = -1
+        for row_group in range(pf.num_row_groups):
+
+            metadata = pf.metadata.row_group(row_group)
+            stats = metadata.column(id_column).statistics
+            # skip the row groups outside [inf, sup) without reading them
+            if stats is not None and stats.has_min_max and (
+                    (self.config.inf is not None and stats.max < self.config.inf)
+                    or (self.config.sup is not None and stats.min >= self.config.sup)):
+                id_ += metadata.num_rows
+                continue
+
+            for batch in pf.iter_batches(row_groups=[row_group], columns=columns):
+                for ex in batch.to_pylist():
+                    id_ += 1
+                    yield id_, ex
+
     def _generate_examples(
         # method parameters are unpacked from `gen_kwargs` as given in `_split_generators`
-        self, jsonl_dir, image_dir, split
+        self, data_files, image_dir, image_fns, split, canonical_ids=None
     ):
         """ Yields examples as (key, example) tuples. """
         # This method handles input defined in _split_generators to yield (key, example) tuples from the dataset.
@@ -150,38 +240,40 @@ class ImageCaptionDataset(datasets.GeneratorBasedBuilder):
         if split == 'dev':
             split = 'valid'
 
-        fns = [os.path.join(jsonl_dir, fn) for fn in os.listdir(jsonl_dir) if os.path.isfile(os.path.join(jsonl_dir, fn)) and fn.endswith("jsonl")]
+        iter_entries = self._iter_parquet if self.config.data_format == 'parquet' else self._iter_jsonl
 
-        for jsonl_file in fns:
+        for data_file in data_files:
 
-            with open(jsonl_file, 'r', encoding='UTF-8') as fp:
+            for id_, ex in iter_entries(data_file):
 
-                for id_, line in enumerate(fp):
+                if self.config.inf is not None and entry_id(ex) < self.config.inf:
+                    continue
+                if self.config.sup is not None and entry_id(ex) >= self.config.sup:
+                    continue
 
-                    ex = json.loads(line)
-
-                    example = {
-                        "image_id": ex['image_id'],
-                        "id": ex["id"],
-                        "caption": ex["caption"],
-                    }
+                example = {
+                    "image_id": ex['image_id'],
+                    "id": ex["id"],
+                    "caption": ex["caption"],
+                }
 
-                    for lang in self.config.langs:
-                        example[lang] = ex[lang]
+                for lang in self.config.langs:
+                    example[lang] = ex[lang]
 
-                    if 'image_url' in ex:
-                        example['image_url'] = ex['image_url']
-                    else:
-                        example['image_url'] = ''
+                if ex.get('image_url') is not None:
+                    example['image_url'] = ex['image_url']
+                else:
+                    example['image_url'] = ''
 
-                    fn = f'{str(ex["image_id"]).zfill(self.config.zfill)}.jpg'
-                    if self.config.prefix_before_image_fn:
-                        fn = f'{self.config.name}_{split}_' + fn
+                # a duplicate uses the file of its canonical image
+                image_id = ex['image_id'] if not canonical_ids else canonical_ids.get(ex['image_id'], ex['image_id'])
+                fn = f'{str(image_id).zfill(self.config.zfill)}.jpg'
+                if self.config.prefix_before_image_fn:
+                    fn = f'{self.config.name}_{split}_' + fn
 
-                    image_file = os.path.join(image_dir, fn)
-                    example['image_file'] = image_file
+                if fn not in image_fns:
+                    continue
 
-                    if not os.path.isfile(image_file):
-                        continue
+                example['image_file'] = os.path.join(image_dir, fn)
 
-                    yield id_, example
+                yield id_, example
@@ -1,22 +1,20 @@
 import os
-import subprocess
 
 # --------------------------------------------------------------------------------
 # Translate cc3m train dataset on GCP VMs with uploading to a Google Storage bucket
-
-hostname = subprocess.check_output('hostname', shell=True).decode('UTF-8')
-assert hostname.startswith('cc3m-data-')
-idx = int(hostname.replace('cc3m-data-', ''))
-idx = idx - 1
-
-start = idx * 100000
-end = (idx + 1) * 100000
-
+#
+# Each VM leases ranges of 100,000 ids from a work queue until none is left, and takes over the ranges of VMs which
+# stopped renewing their leases. The queue is an object of the bucket (a SQLite `--queue` only works for the processes
+# of a single VM), created once, before starting the VMs, with
+#
+#   python cc3m_work_queue.py init --queue gs://[...]/cc3m_train_queue.json --inf 0 --sup 3318333 --range_size 100000
+
+queue = 'gs://[...]/cc3m_train_queue.json'
 bucket_name = '[...]'
 blob_prefix = '[...]'
 upload_batch_size = 10000
 
-command = f'nohup python -u cc3m_processing.py --input_dir "./" --input_fn "cc3m_train.jsonl" --inf {start} --sup {end} --output_dir "./" --batch_size 100 --buf_size 100 --bucket_name {bucket_name} --blob_prefix {blob_prefix} --upload_batch_size {upload_batch_size}'
+command = f'nohup python -u cc3m_processing.py --input_dir "./" --input_fn "cc3m_train.jsonl" --queue {queue} --output_dir "./" --batch_size 100 --buf_size 100 --bucket_name {bucket_name} --blob_prefix {blob_prefix} --upload_batch_size {upload_batch_size}'
 print(command)
 os.system(command)
 
@@ -0,0 +1,109 @@
+"""An in-memory stand-in for the parts of `google.cloud.storage` used by the scripts, with generation preconditions.
+
+`install(monkeypatch)` makes `from google.cloud import storage` return it, and returns a `FakeClient`, whose
+buckets are shared by all the clients created during the test.
+"""
+import sys
+import types
+import threading
+
+
+class PreconditionFailed(Exception):
+
+    pass
+
+
+class NotFound(Exception):
+
+    pass
+
+
+class FakeBlob:
+
+    def __init__(self, bucket, name):
+
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def generation(self):
+
+        return self.bucket.objects[self.name][1] if self.name in self.bucket.objects else None
+
+    def _check(self, if_generation_match):
+
+        if if_generation_match is not None and if_generation_match != (self.generation or 0):
+            raise PreconditionFailed(f'{self.name}: generation {self.generation}, expected {if_generation_match}')
+
+    def download_as_bytes(self, if_generation_match=None):
+
+        with self.bucket.lock:
+            if self.name not in self.bucket.objects:
+                raise NotFound(self.name)
+            self._check(if_generation_match)
+            return self.bucket.objects[self.name][0]
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+
+        if isinstance(data, str):
+            data = data.encode('UTF-8')
+
+        with self.bucket.lock:
+            if self.bucket.before_upload is not None:
+                self.bucket.before_upload(self.name)
+            self._check(if_generation_match)
+            self.bucket.n_generations += 1
+            self.bucket.objects[self.name] = (data, self.bucket.n_generations)
+
+
+class FakeBucket:
+
+    def __init__(self, name):
+
+        self.name = name
+        self.objects = {}
+        self.n_generations = 0
+        # reentrant: `before_upload` may itself write to the bucket
+        self.lock = threading.RLock()
+        # called with the blob name before each upload, to interleave writes of other clients
+        self.before_upload = None
+
+    def blob(self, name):
+
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+
+        with self.lock:
+            return FakeBlob(self, name) if name in self.objects else None
+
+
+class FakeClient:
+
+    buckets = {}
+
+    def bucket(self, name):
+
+        return self.buckets.setdefault(name, FakeBucket(name))
+
+
+def install(monkeypatch):
+
+    storage = types.ModuleType('google.cloud.storage')
+    storage.Client = type('Client', (FakeClient,), {'buckets': {}})
+    exceptions = types.ModuleType('google.api_core.exceptions')
+    exceptions.PreconditionFailed = PreconditionFailed
+    exceptions.NotFound = NotFound
+
+    google = types.ModuleType('google')
+    cloud = types.ModuleType('google.cloud')
+    api_core = types.ModuleType('google.api_core')
+    google.cloud, google.api_core = cloud, api_core
+    cloud.storage = storage
+    api_core.exceptions = exceptions
+
+    for name, module in [('google', google), ('google.cloud', cloud), ('google.cloud.storage', storage),
+                         ('google.api_core', api_core), ('google.api_core.exceptions', exceptions)]:
+        monkeypatch.setitem(sys.modules, name, module)
+
+    return storage.Client()
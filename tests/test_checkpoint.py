@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import time
+import random
+import signal
+import subprocess
+
+from cc3m_checkpoint import CheckpointedJsonlWriter
+
+
+N_ENTRIES = 3000
+
+# appends batches of entries, resuming after the last id of the file, until `N_ENTRIES` entries are written
+WRITER_SCRIPT = f"""
+import sys, json
+from cc3m_checkpoint import CheckpointedJsonlWriter
+
+path = sys.argv[1]
+with CheckpointedJsonlWriter(path) as writer:
+    with open(path, 'rb') as fp:
+        next_id = sum(1 for _ in fp)
+    while next_id < {N_ENTRIES}:
+        batch = range(next_id, min(next_id + 37, {N_ENTRIES}))
+        writer.append([json.dumps({{'id': x, 'caption': 'x' * (x % 500)}}) for x in batch])
+        next_id = batch[-1] + 1
+"""
+
+
+def _run_writer(path, kill_at=None):
+    """Run a writer to the end, or `SIGKILL` it as soon as the file reaches `kill_at` bytes."""
+
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-c', WRITER_SCRIPT, path], cwd=root_dir)
+    if kill_at is None:
+        assert process.wait() == 0
+        return
+    while process.poll() is None and (not os.path.isfile(path) or os.path.getsize(path) < kill_at):
+        time.sleep(0.0002)
+    process.send_signal(signal.SIGKILL)
+    process.wait()
+
+
+def _ids(path):
+
+    with open(path, 'rb') as fp:
+        return [json.loads(line)['id'] for line in fp]
+
+
+def test_recovery_after_sigkill(tmp_path):
+
+    path = str(tmp_path / 'out.jsonl')
+    rng = random.Random(0)
+
+    n_lines = []
+    for _ in range(20):
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        _run_writer(path, kill_at=size + rng.randint(1, 40000))
+        # every line of the file parses, and no id is written twice
+        with CheckpointedJsonlWriter(path):
+            ids = _ids(path)
+        assert ids == list(range(len(ids)))
+        n_lines.append(len(ids))
+
+    _run_writer(path)
+
+    assert _ids(path) == list(range(N_ENTRIES))
+    # the writers were killed before the end
+    assert n_lines[-1] < N_ENTRIES
+
+
+def test_torn_last_line_is_truncated(tmp_path):
+
+    path = str(tmp_path / 'out.jsonl')
+    with CheckpointedJsonlWriter(path) as writer:
+        writer.append([json.dumps({'id': 0}), json.dumps({'id': 1})])
+    with open(path, 'ab') as fp:
+        fp.write(b'{"id": 2, "capt')
+
+    with CheckpointedJsonlWriter(path) as writer:
+        assert writer.size == os.path.getsize(path)
+        writer.append([json.dumps({'id': 2})])
+
+    assert _ids(path) == [0, 1, 2]
@@ -0,0 +1,98 @@
+import pytest
+
+import cc3m_download_status as download_status
+from cc3m_host_policy import CircuitOpenError, HostPolicy, host_of
+from cc3m_image_downloader import DownloadEngine
+from cc3m_synthetic_data import SyntheticImageServer, closed_port
+
+
+def test_failing_host_trips_the_breaker():
+
+    policy = HostPolicy(failure_threshold=3, cooldown=60)
+
+    for _ in range(2):
+        policy.before_request('a', now=0)
+        assert policy.on_failure('a', download_status.CONNECTION_ERROR, now=0)
+    policy.before_request('a', now=0)
+    assert not policy.on_failure('a', download_status.CONNECTION_ERROR, now=0)
+
+    with pytest.raises(CircuitOpenError):
+        policy.before_request('a', now=30)
+    # other hosts aren't affected
+    policy.before_request('b', now=30)
+
+    # after the cooldown, a single trial request goes through, and closes the circuit if it succeeds
+    policy.before_request('a', now=61)
+    with pytest.raises(CircuitOpenError):
+        policy.before_request('a', now=61)
+    policy.on_success('a', 0.1)
+    policy.before_request('a', now=62)
+
+    assert policy.stats(now=62)['n_circuits_opened'] == 1
+
+
+def test_failed_trial_opens_the_circuit_again():
+
+    policy = HostPolicy(failure_threshold=1, cooldown=60)
+
+    policy.before_request('a', now=0)
+    policy.on_failure('a', download_status.CONNECTION_ERROR, now=0)
+    policy.before_request('a', now=61)
+    assert not policy.on_failure('a', download_status.CONNECTION_ERROR, now=61)
+
+    with pytest.raises(CircuitOpenError):
+        policy.before_request('a', now=100)
+
+
+def test_slow_host_gets_a_longer_timeout():
+
+    policy = HostPolicy(timeout=2, max_timeout=10, failure_threshold=2)
+
+    timeouts = []
+    for _ in range(3):
+        timeout = policy.before_request('slow', now=0)
+        timeouts.append(timeout)
+        assert policy.on_failure('slow', download_status.TIMEOUT, timeout=timeout, now=0)
+
+    # timeouts below `max_timeout` double the timeout, without opening the circuit
+    assert timeouts == [2, 4, 8]
+    assert policy.before_request('slow', now=0) == 10
+
+    # the timeout then follows the latencies of the host
+    for _ in range(20):
+        policy.on_success('slow', 3.0)
+    assert 3.0 <= policy.before_request('slow', now=0) < 8
+
+
+def test_not_found_keeps_the_circuit_closed():
+
+    policy = HostPolicy(failure_threshold=1)
+
+    policy.before_request('a', now=0)
+    assert not policy.on_failure('a', download_status.HTTP_ERROR, http_status=404, seconds=0.1, now=0)
+    policy.before_request('a', now=0)
+
+
+def test_engine_with_slow_and_refused_hosts(tmp_path):
+
+    refused_url = f'http://127.0.0.1:{closed_port()}'
+
+    with SyntheticImageServer(default_delay=0.6) as slow:
+
+        entries = [{'image_id': idx, 'image_url': slow.url(f'{idx:04d}.jpg', w=64, h=48)} for idx in range(8)]
+        entries += [{'image_id': 100 + idx, 'image_url': f'{refused_url}/{idx:04d}.jpg'} for idx in range(20)]
+
+        policy = HostPolicy(timeout=0.2, min_timeout=0.1, max_timeout=2, max_retries=3, backoff=0.01,
+                            failure_threshold=3)
+        with DownloadEngine(str(tmp_path), 'test', n_fetchers=4, n_decoders=1, host_policy=policy) as engine:
+            results = {x['image_id']: x['status'] for x in engine.run(iter(entries))}
+
+    # the slow host is retried with a longer timeout instead of failing
+    assert all(results[idx] == download_status.OK for idx in range(8))
+    assert policy.host_stats()[host_of(slow.base_url)]['timeout'] > 0.6
+
+    # the refused host trips its breaker, and the rest of its urls fail fast
+    refused = [results[100 + idx] for idx in range(20)]
+    assert set(refused) <= {download_status.CONNECTION_ERROR, download_status.CIRCUIT_OPEN}
+    assert refused.count(download_status.CIRCUIT_OPEN) > 0
+    assert policy.stats()['n_circuits_opened'] >= 1
@@ -0,0 +1,49 @@
+import os
+import sys
+import json
+import types
+import importlib
+
+import pytest
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def builder_module(monkeypatch):
+
+    # the builder is a dataset script, importing the other scripts relatively
+    package = types.ModuleType('cc3m_data')
+    package.__path__ = [REPO_DIR]
+    monkeypatch.setitem(sys.modules, 'cc3m_data', package)
+
+    return importlib.import_module('cc3m_data.image_caption_dataset')
+
+
+def test_duplicates_use_the_canonical_image(tmp_path, builder_module):
+
+    data_dir = tmp_path / 'data'
+    jsonl_dir = data_dir / 'cc3m_jsonls' / 'train'
+    image_dir = data_dir / 'cc3m_images' / 'train'
+    os.makedirs(jsonl_dir)
+    os.makedirs(image_dir)
+
+    entries = [{'image_id': x, 'id': x, 'caption': f'c{x}', 'en': f'e{x}', 'fr': f'f{x}'} for x in range(4)]
+    with open(jsonl_dir / 'cc3m_train.jsonl', 'w', encoding='UTF-8') as fp:
+        fp.writelines(json.dumps(x) + '\n' for x in entries)
+    # image 1 is a skipped copy of image 2, image 3 failed to download
+    for image_id in [0, 2]:
+        (image_dir / f'cc3m_train_{image_id:08d}.jpg').write_bytes(b'x')
+    with open(data_dir / 'cc3m_images' / 'cc3m_train_duplicates.json', 'w', encoding='UTF-8') as fp:
+        json.dump({1: 2}, fp)
+
+    builder = builder_module.ImageCaptionDataset(
+        config_name='cc3m', data_dir=str(data_dir), cache_dir=str(tmp_path / 'cache'), splits=['train']
+    )
+    (split,) = builder._split_generators(None)
+    examples = [x for _, x in builder._generate_examples(**split.gen_kwargs)]
+
+    assert [(x['image_id'], os.path.basename(x['image_file'])) for x in examples] == [
+        (0, 'cc3m_train_00000000.jpg'), (1, 'cc3m_train_00000002.jpg'), (2, 'cc3m_train_00000002.jpg')
+    ]
@@ -0,0 +1,70 @@
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+import cc3m_download_status as download_status
+from cc3m_image_downloader import HTTPStatusError, classify_fetch_error, fetch
+from cc3m_synthetic_data import closed_port
+
+
+class _StallingHandler(BaseHTTPRequestHandler):
+    """Sends the headers and the start of the body, then stalls."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        self.send_response(200)
+        if 'chunked' in self.path:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'5\r\nhello\r\n')
+        else:
+            self.send_header('Content-Length', '100000')
+            self.end_headers()
+            self.wfile.write(b'x' * 1000)
+        self.wfile.flush()
+        time.sleep(2)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stalling_server():
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StallingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('path', ['/image.jpg', '/chunked.jpg'])
+def test_stalled_body_is_a_timeout(stalling_server, path):
+
+    with pytest.raises(Exception) as excinfo:
+        fetch(requests.Session(), stalling_server + path, timeout=0.3)
+
+    assert classify_fetch_error(excinfo.value) == (download_status.TIMEOUT, None)
+
+
+def test_classify_fetch_error():
+
+    read_timeout = ReadTimeoutError(None, None, 'Read timed out.')
+    chunked = requests.exceptions.ChunkedEncodingError(ProtocolError('Connection broken', read_timeout))
+
+    assert classify_fetch_error(chunked) == (download_status.TIMEOUT, None)
+    assert classify_fetch_error(requests.exceptions.ReadTimeout()) == (download_status.TIMEOUT, None)
+    assert classify_fetch_error(HTTPStatusError(404)) == (download_status.HTTP_ERROR, 404)
+
+    with pytest.raises(Exception) as excinfo:
+        fetch(requests.Session(), f'http://127.0.0.1:{closed_port()}/image.jpg', timeout=1)
+    assert classify_fetch_error(excinfo.value) == (download_status.CONNECTION_ERROR, None)
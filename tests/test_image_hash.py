@@ -0,0 +1,81 @@
+import time
+
+import numpy as np
+import pytest
+
+from cc3m_image_hash import ImageHashIndex, hamming_distances
+
+
+def _brute_force_clusters(image_ids, hashes, max_distance):
+
+    parents = list(range(len(hashes)))
+
+    def find(idx):
+        while parents[idx] != idx:
+            idx = parents[idx]
+        return idx
+
+    for idx in range(len(hashes)):
+        close = np.flatnonzero(hamming_distances(hashes[idx], hashes[idx + 1:]) <= max_distance) + idx + 1
+        for other in close:
+            parents[find(int(other))] = find(idx)
+
+    groups = {}
+    for idx, image_id in enumerate(image_ids):
+        groups.setdefault(find(idx), []).append(int(image_id))
+
+    return sorted(sorted(x) for x in groups.values() if len(x) > 1)
+
+
+@pytest.fixture
+def index(tmp_path):
+
+    with ImageHashIndex(str(tmp_path / 'hashes.sqlite')) as index:
+        yield index
+
+
+@pytest.mark.parametrize('max_distance', [0, 1, 2, 3, 5])
+def test_clusters_match_brute_force(index, max_distance):
+
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(-2 ** 63, 2 ** 63 - 1, size=500, dtype=np.int64)
+    # near duplicates: a few flipped bits
+    for idx in range(0, 500, 5):
+        bits = rng.choice(64, size=rng.integers(0, max_distance + 2), replace=False)
+        mask = np.array([sum(1 << int(b) for b in bits)], dtype=np.uint64).view(np.int64)[0]
+        hashes[idx] = hashes[idx + 1] ^ mask
+    for image_id, h in enumerate(hashes):
+        index.add(image_id, int(h))
+
+    clusters = index.clusters(max_distance=max_distance)
+
+    assert sorted(sorted(x) for x in clusters) == _brute_force_clusters(range(500), hashes, max_distance)
+    # the canonical image of a cluster comes first
+    assert all(x[0] == min(x) for x in clusters)
+
+
+def test_many_identical_hashes(index):
+
+    # blank / placeholder images
+    for image_id in range(20000):
+        index.add(image_id, 12345 if image_id % 2 else image_id * 7919)
+
+    s = time.perf_counter()
+    clusters = index.clusters(max_distance=2)
+
+    assert time.perf_counter() - s < 10
+    assert sorted(clusters[0]) == list(range(1, 20000, 2))
+
+
+def test_canonical_image_is_the_first_added(index):
+
+    # downloads finish out of order: with `skip_duplicates`, only image 5 is stored
+    assert index.add(5, 42) == 5
+    assert index.add(3, 42) == 5
+    # a near duplicate of both, added first
+    assert index.add(7, 43) == 7
+    assert index.add(1, 1 << 40) == 1
+
+    assert index.duplicates() == {3: 5}
+    assert index.clusters() == [[5, 3]]
+    assert index.clusters(max_distance=1) == [[5, 3, 7]]
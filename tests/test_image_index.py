@@ -0,0 +1,37 @@
+import os
+
+from cc3m_image_index import MANIFEST_FN, image_files, write_image_manifest
+
+
+def _touch(path):
+
+    with open(path, 'wb') as fp:
+        fp.write(b'x')
+
+
+def test_manifest_is_used_when_up_to_date(tmp_path):
+
+    _touch(tmp_path / 'cc3m_00000000.jpg')
+    write_image_manifest(str(tmp_path))
+    # a name only the manifest knows: the directory isn't listed
+    with open(tmp_path / MANIFEST_FN, 'a', encoding='UTF-8') as fp:
+        fp.write('cc3m_00000001.jpg\n')
+    os.utime(tmp_path / MANIFEST_FN, ns=(os.stat(tmp_path).st_mtime_ns,) * 2)
+
+    assert image_files(str(tmp_path), MANIFEST_FN) == {'cc3m_00000000.jpg', 'cc3m_00000001.jpg'}
+
+
+def test_stale_manifest_is_ignored(tmp_path):
+
+    _touch(tmp_path / 'cc3m_00000000.jpg')
+    write_image_manifest(str(tmp_path))
+    mtime_ns = os.stat(tmp_path / MANIFEST_FN).st_mtime_ns
+
+    # an image added by a later (or resumed) download
+    _touch(tmp_path / 'cc3m_00000002.jpg')
+    os.utime(tmp_path, ns=(mtime_ns + 10 ** 9,) * 2)
+
+    assert image_files(str(tmp_path), MANIFEST_FN) == {'cc3m_00000000.jpg', 'cc3m_00000002.jpg'}
+
+    write_image_manifest(str(tmp_path))
+    assert image_files(str(tmp_path), MANIFEST_FN) == {'cc3m_00000000.jpg', 'cc3m_00000002.jpg'}
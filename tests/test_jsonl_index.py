@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+import cc3m_jsonl_index
+from cc3m_jsonl_index import JsonlIndex
+
+
+def _write(path, ids):
+
+    with open(path, 'w', encoding='UTF-8') as fp:
+        fp.writelines(json.dumps({'id': x, 'caption': f'c{x}'}) + '\n' for x in ids)
+
+
+@pytest.mark.parametrize('ids, ids_sorted, ids_consecutive', [
+    (range(10, 60), True, True),
+    (range(0, 100, 3), True, False),
+    ([5, 3, 9, 1], False, False),
+    ([], True, True),
+])
+def test_saved_index(tmp_path, monkeypatch, ids, ids_sorted, ids_consecutive):
+
+    path = str(tmp_path / 'cc3m_train.jsonl')
+    _write(path, ids)
+
+    index = JsonlIndex.load_or_build(path)
+    assert (index.ids_sorted, index.ids_consecutive) == (ids_sorted, ids_consecutive)
+
+    # loading takes the order of the ids from the header, without going through them
+    monkeypatch.setattr(cc3m_jsonl_index, '_is_consecutive', lambda _: pytest.fail('ids checked on load'))
+    monkeypatch.setattr(cc3m_jsonl_index, 'all', lambda _: pytest.fail('ids checked on load'), raising=False)
+    loaded = JsonlIndex.load(path)
+    assert (loaded.ids_sorted, loaded.ids_consecutive) == (ids_sorted, ids_consecutive)
+    assert list(loaded.offsets) == list(index.offsets) and list(loaded.ids) == list(ids)
+
+    with open(path, 'rb') as fp:
+        for _id in ids:
+            assert loaded.get(fp, _id)['id'] == _id
+        assert loaded.get(fp, 1000) is None
+
+
+def test_index_of_an_older_format_is_rebuilt(tmp_path):
+
+    path = str(tmp_path / 'cc3m_train.jsonl')
+    _write(path, range(5))
+    JsonlIndex.load_or_build(path)
+
+    with open(JsonlIndex.index_path(path), 'r+b') as fp:
+        fp.write(b'CC3MJSONLIDX\x01')
+
+    assert JsonlIndex.load(path) is None
+    assert JsonlIndex.load_or_build(path).ids_consecutive
+    assert JsonlIndex.load(path) is not None
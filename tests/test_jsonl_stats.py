@@ -0,0 +1,48 @@
+import json
+
+from cc3m_jsonl_stats import CorpusStats, compute_stats
+
+
+ENTRIES = [
+    {'id': 0, 'caption': 'a dog', 'en': 'a dog', 'fr': 'un chien'},
+    # no caption at all
+    {'id': 1, 'en': 'a cat', 'fr': ''},
+    {'id': 2, 'caption': None, 'en': 'a bird'},
+    {'id': 4, 'caption': float('nan'), 'en': '', 'fr': None},
+    {'id': 5, 'caption': '', 'en': '<PERSON> walks', 'fr': 'marche'},
+]
+
+
+def _check_totals(report):
+
+    for key, column in report['columns'].items():
+        assert column['present'] + column['missing'] + column['none'] + column['empty'] == report['n_entries'], key
+
+
+def test_each_entry_is_counted_once_per_column():
+
+    stats = CorpusStats()
+    for entry in ENTRIES:
+        stats.add(entry)
+    report = stats.report()
+
+    _check_totals(report)
+    caption = report['columns']['caption']
+    assert (caption['present'], caption['missing'], caption['none'], caption['empty']) == (1, 1, 2, 1)
+    assert report['columns']['fr']['person_mismatches'] == 1
+    assert report['n_gaps'] == 1
+
+
+def test_merged_stats_match(tmp_path):
+
+    path = tmp_path / 'translated.jsonl'
+    with open(path, 'w', encoding='UTF-8') as fp:
+        for _ in range(40):
+            fp.writelines(json.dumps(x) + '\n' for x in ENTRIES)
+
+    report = compute_stats(str(path), n_workers=2, range_size=300).report()
+
+    _check_totals(report)
+    assert report['n_entries'] == 40 * len(ENTRIES)
+    assert report['columns']['caption']['missing'] == 40
+    assert report['columns']['caption']['none'] == 80
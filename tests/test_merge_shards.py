@@ -0,0 +1,84 @@
+import os
+import json
+import random
+
+import pytest
+
+import cc3m_merge_shards
+from cc3m_merge_shards import merge_shards
+
+
+def _write(path, entries):
+
+    with open(path, 'w', encoding='UTF-8') as fp:
+        fp.writelines(json.dumps(x, ensure_ascii=False) + '\n' for x in entries)
+
+
+def _read_shards(output_dir, prefix):
+
+    entries = []
+    for fn in sorted(os.listdir(output_dir)):
+        if fn.startswith(prefix):
+            with open(os.path.join(output_dir, fn), encoding='UTF-8') as fp:
+                entries.extend(json.loads(line) for line in fp)
+
+    return entries
+
+
+@pytest.fixture
+def inputs(tmp_path):
+
+    rng = random.Random(0)
+    ids = list(range(3000))
+    paths = []
+    for idx in range(3):
+        entries = [{'id': x, 'caption': f'c{x}', 'en': f'e{x}', 'fr': f'f{x}' if rng.random() < 0.5 else ''} for x in
+                   rng.sample(ids, 1500)]
+        if idx == 0:
+            entries.sort(key=lambda x: x['id'])
+        paths.append(str(tmp_path / f'translated_{idx}.jsonl'))
+        _write(paths[-1], entries)
+
+    return paths
+
+
+def test_merge_with_many_runs(tmp_path, inputs):
+
+    output_dir = str(tmp_path / 'merged')
+    report = merge_shards(inputs, output_dir, 'cc3m_train', shard_size=700, run_size=100)
+
+    expected = {}
+    for path in inputs:
+        with open(path, encoding='UTF-8') as fp:
+            for entry in map(json.loads, fp):
+                if entry['id'] not in expected or (entry['fr'] and not expected[entry['id']]['fr']):
+                    expected[entry['id']] = entry
+
+    assert _read_shards(output_dir, 'cc3m_train') == [expected[x] for x in sorted(expected)]
+    assert report['n_unsorted_inputs'] == 2
+    assert report['n_entries'] == len(expected)
+    assert sorted(os.listdir(output_dir)) == [f'cc3m_train_{idx:05d}.jsonl' for idx in range(len(report['shards']))]
+
+
+def test_interrupted_merge_keeps_the_previous_shards(tmp_path, inputs, monkeypatch):
+
+    output_dir = str(tmp_path / 'merged')
+    merge_shards(inputs[:1], output_dir, 'cc3m_train', shard_size=500)
+    previous = _read_shards(output_dir, 'cc3m_train')
+    previous_fns = sorted(os.listdir(output_dir))
+
+    n_writes = []
+    write_data = cc3m_merge_shards.JsonlWriter.write_data
+
+    def failing_write_data(self, data):
+        n_writes.append(len(data))
+        if len(n_writes) == 3:
+            raise KeyboardInterrupt
+        write_data(self, data)
+
+    monkeypatch.setattr(cc3m_merge_shards.JsonlWriter, 'write_data', failing_write_data)
+    with pytest.raises(KeyboardInterrupt):
+        merge_shards(inputs, output_dir, 'cc3m_train', shard_size=400)
+
+    assert sorted(x for x in os.listdir(output_dir) if not x.startswith('.')) == previous_fns
+    assert _read_shards(output_dir, 'cc3m_train') == previous
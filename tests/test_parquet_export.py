@@ -0,0 +1,26 @@
+import pyarrow.parquet as pq
+
+from cc3m_parquet_export import export_to_parquet
+
+
+def test_export_with_missing_values(tmp_path):
+
+    input_path = tmp_path / 'translated.jsonl'
+    # `json.dumps` writes `NaN` for the missing captions / urls of the TSV files
+    input_path.write_text(
+        '{"image_id": 0, "id": 0, "caption": "a dog", "en": "a dog", "fr": "un chien", "image_url": "http://a"}\n'
+        '{"image_id": 1, "id": 1, "caption": NaN, "en": "", "fr": null, "image_url": NaN}\n'
+        '{"image_id": 2, "id": 2, "caption": 3.5, "en": "a cat", "image_url": "http://c"}\n',
+        encoding='UTF-8'
+    )
+    output_path = str(tmp_path / 'translated.parquet')
+
+    n_entries = export_to_parquet([str(input_path)], output_path, langs=['en', 'fr'], row_group_size=2)
+
+    assert n_entries == 3
+    rows = pq.read_table(output_path).to_pylist()
+    assert rows[0] == {
+        'image_id': 0, 'id': 0, 'caption': 'a dog', 'en': 'a dog', 'fr': 'un chien', 'image_url': 'http://a'
+    }
+    assert rows[1] == {'image_id': 1, 'id': 1, 'caption': None, 'en': '', 'fr': None, 'image_url': None}
+    assert rows[2] == {'image_id': 2, 'id': 2, 'caption': None, 'en': 'a cat', 'fr': None, 'image_url': 'http://c'}
@@ -0,0 +1,80 @@
+import os
+
+from cc3m_image_downloader import ImageOutput, output_key
+from cc3m_tar_shards import TarShardWriter, iter_shard, read_index, read_member, shard_paths
+
+
+def test_multi_output_sample_round_trip(tmp_path):
+
+    outputs = [ImageOutput.parse('384:jpg'), ImageOutput.parse('384:jpg'), ImageOutput.parse('256:webp')]
+    samples = []
+    for image_id in range(3):
+        files = {output_key(idx, output): f'{image_id}-{idx}'.encode() for idx, output in enumerate(outputs)}
+        files['json'] = b'{}'
+        samples.append((f'cc3m_train_{image_id:08d}', files))
+
+    with TarShardWriter(str(tmp_path), 'cc3m_train') as writer:
+        for image_id, (key, files) in enumerate(samples):
+            writer.write(key, files, image_id)
+
+    paths = shard_paths(str(tmp_path), 'cc3m_train')
+    assert list(iter_shard(paths[0])) == samples
+    assert sorted(samples[0][1]) == ['256.webp', '384.jpg', 'jpg', 'json']
+
+
+def _samples(image_ids):
+
+    return [(f'cc3m_train_{x:08d}', {'jpg': bytes([x % 256]) * (100 + x), 'json': f'{{"id": {x}}}'.encode()}, x)
+            for x in image_ids]
+
+
+def test_interrupted_shard_is_discarded(tmp_path):
+
+    output_dir = str(tmp_path)
+    writer = TarShardWriter(output_dir, 'cc3m_train', max_count=4)
+    committed = []
+    for key, files, image_id in _samples(range(10)):
+        committed += writer.write(key, files, image_id)
+    # interrupted: the third shard is never committed
+    writer._fp.close()
+
+    assert committed == list(range(8))
+    assert [os.path.basename(x) for x in shard_paths(output_dir, 'cc3m_train')] == [
+        'cc3m_train-000000.tar', 'cc3m_train-000001.tar'
+    ]
+    assert not os.path.exists(tmp_path / 'cc3m_train-000002.index.jsonl')
+
+    # an index committed without its tar (interrupted between the two renames)
+    with open(tmp_path / 'cc3m_train-000002.index.jsonl', 'w', encoding='UTF-8') as fp:
+        fp.write('{"key": "cc3m_train_00000008", "image_id": 8}\n')
+
+    with TarShardWriter(output_dir, 'cc3m_train', max_count=4) as writer:
+        assert writer.done_ids() == set(range(8))
+        assert sorted(os.listdir(output_dir)) == [
+            'cc3m_train-000000.index.jsonl', 'cc3m_train-000000.tar', 'cc3m_train-000001.index.jsonl',
+            'cc3m_train-000001.tar'
+        ]
+        for key, files, image_id in _samples(range(8, 10)):
+            writer.write(key, files, image_id)
+
+    assert writer.done_ids() == set(range(10))
+    assert len(shard_paths(output_dir, 'cc3m_train')) == 3
+
+
+def test_members_read_through_the_index(tmp_path):
+
+    samples = _samples([3, 1, 200, 7])
+    with TarShardWriter(str(tmp_path), 'cc3m_train', max_count=3) as writer:
+        for key, files, image_id in samples:
+            writer.write(key, files, image_id)
+
+    records = {}
+    for path in shard_paths(str(tmp_path), 'cc3m_train'):
+        for record in read_index(path):
+            records[record['image_id']] = (path, record)
+
+    for key, files, image_id in samples:
+        path, record = records[image_id]
+        assert record['key'] == key
+        for ext, data in files.items():
+            assert read_member(path, record, ext) == data
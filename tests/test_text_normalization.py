@@ -0,0 +1,46 @@
+import pytest
+
+from cc3m_synthetic_data import make_synthetic_captions, normalize_or_error
+from cc3m_text_normalization import CaptionNormalizer, process_1_annotation
+
+
+EDGE_CASES = [
+    'actor attends the premiere of the film .',
+    'person , the actor , arrives at the event !!',
+    "it 's a photo of <PERSON> and <PERSON> .",
+    "the cat doesn \\ 't like water ...",
+    'a view of the city -- at night',
+    'Illustration of a cute dog',
+    '  a house  in  the woods  ',
+    'the <PERSON> ?',
+    'stock image of a beach',
+]
+
+
+@pytest.mark.parametrize('caption', EDGE_CASES)
+def test_normalize_edge_cases(caption):
+
+    normalizer = CaptionNormalizer()
+
+    assert normalize_or_error(normalizer.normalize, caption) == normalize_or_error(process_1_annotation, caption)
+
+
+def test_normalizer_matches_process_1_annotation():
+
+    captions = make_synthetic_captions(5000, seed=0)
+    normalizer = CaptionNormalizer()
+
+    mismatches = [
+        caption for caption in captions
+        if normalize_or_error(normalizer.normalize, caption) != normalize_or_error(process_1_annotation, caption)
+    ]
+
+    assert mismatches == []
+
+
+def test_batch_normalization():
+
+    captions = [x for x in make_synthetic_captions(1000, seed=1) if normalize_or_error(process_1_annotation, x)
+                is not IndexError]
+
+    assert CaptionNormalizer()(captions) == [process_1_annotation(x) for x in captions]
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+import cc3m_processing
+from cc3m_translation import StubBackend, TranslationEngine
+
+
+class PunctuationBackend(StubBackend):
+    """`StubBackend` translating the lines of `bad_lines` to "."."""
+
+    def __init__(self, bad_lines):
+
+        super().__init__()
+        self.bad_lines = set(bad_lines)
+
+    def translate(self, text, src, dest):
+
+        translated = super().translate(text, src, dest).split('\n')
+
+        return '\n'.join('.' if line in self.bad_lines else x for line, x in zip(text.split('\n'), translated))
+
+
+@pytest.fixture
+def translation(monkeypatch):
+
+    engine = TranslationEngine(n_workers=2, backoff=0.01)
+    monkeypatch.setattr(cc3m_processing, 'translation_engine', engine)
+    monkeypatch.setattr(cc3m_processing, 'translation_cache', None)
+    monkeypatch.setattr(cc3m_processing, 'translation_pack_size', 10)
+
+    def set_backend(backend):
+        monkeypatch.setattr(cc3m_processing, 'translation_backend', backend)
+        return backend
+
+    yield engine, set_backend
+
+    engine.close()
+
+
+def test_pack_with_a_punctuation_only_translation(translation):
+
+    engine, set_backend = translation
+    backend = set_backend(PunctuationBackend(['a bad caption']))
+
+    en_texts = ('a dog on the beach', 'a bad caption', '<PERSON> walks in the park')
+    results = cc3m_processing.translate_jobs([(x, 'fr') for x in en_texts])
+
+    assert results == ['[fr] a dog on the beach', None, '[fr] <PERSON> walks in the park']
+    # the pack isn't retried, and the other captions don't fall back to a request each
+    assert backend.n_requests == 1
+    assert engine.stats()['n_errors'] == 0
+
+
+def test_pack_falls_back_when_the_split_fails(translation):
+
+    _, set_backend = translation
+    backend = set_backend(StubBackend(merge_rate=1.0))
+
+    en_texts = ['a dog on the beach', 'a cat on a sofa', '<PERSON> walks in the park']
+    results = cc3m_processing.translate_jobs([(x, 'fr') for x in en_texts])
+
+    assert results == [f'[fr] {x}' for x in en_texts]
+    # the pack, then one request per caption
+    assert backend.n_requests == 1 + len(en_texts)
+
+
+def test_normalized_batch_with_an_unnormalizable_caption(translation):
+
+    _, set_backend = translation
+    set_backend(StubBackend())
+
+    # as written by `cc3m_normalize_captions.py`: the caption "." couldn't be normalized, so it has no `en`
+    batch = [
+        {'image_id': 1, 'id': 1, 'caption': '.'},
+        {'image_id': 2, 'id': 2, 'caption': 'a dog on the beach .', 'en': 'a dog on the beach'},
+    ]
+    buf = []
+    cc3m_processing.translate_batch(batch, ['fr'], buf, normalized=True)
+
+    assert [json.loads(x) for x in buf] == [
+        {'image_id': 1, 'id': 1, 'caption': '.', 'fr': None},
+        {'image_id': 2, 'id': 2, 'caption': 'a dog on the beach .', 'en': 'a dog on the beach',
+         'fr': '[fr] a dog on the beach'},
+    ]
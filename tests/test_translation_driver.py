@@ -0,0 +1,137 @@
+import os
+import json
+import argparse
+
+import pytest
+
+import cc3m_processing
+import cc3m_translation_driver
+from cc3m_jsonl_io import iter_entries
+from cc3m_translation_driver import TranslationDriver, chunk_fn
+
+
+N_ENTRIES = 300
+# the chunk whose first worker is killed
+KILLED_CHUNK = 150
+
+
+def _args(input_dir):
+
+    parser = argparse.ArgumentParser()
+    cc3m_processing.add_translation_arguments(parser)
+    args = parser.parse_args(['--translation_backend', 'stub', '--translation_rate', '100000'])
+    args.input_dir = input_dir
+    args.input_fn = 'cc3m_train.jsonl'
+    args.batch_size = 10
+    args.buf_size = 10
+
+    return args
+
+
+@pytest.fixture
+def args(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(cc3m_processing, 'langs', ['fr', 'es'])
+
+    with open(tmp_path / 'cc3m_train.jsonl', 'w', encoding='UTF-8') as fp:
+        for idx in range(N_ENTRIES):
+            entry = {'image_id': idx, 'id': idx, 'caption': f'a dog number {idx} on the beach .'}
+            fp.write(json.dumps(entry) + '\n')
+
+    return _args(str(tmp_path))
+
+
+def _killed_after(n_batches, attempts_path):
+    """A `_translate_chunk` whose first worker for `KILLED_CHUNK` dies after `n_batches` batches (`None`: every
+    worker for it fails right away)."""
+
+    translate_chunk = cc3m_translation_driver._translate_chunk
+
+    def _translate_chunk(args, chunk_dir, shared_range):
+        if shared_range.start == KILLED_CHUNK:
+            with open(attempts_path, 'a', encoding='UTF-8') as fp:
+                fp.write(f'{shared_range.end}\n')
+            if n_batches is None:
+                os._exit(3)
+            if os.path.getsize(attempts_path) == len(f'{shared_range.end}\n'):
+                # in the worker process only
+                translate_batch = cc3m_processing.translate_batch
+                n_calls = []
+
+                def _translate_batch(*a, **kw):
+                    if len(n_calls) == n_batches:
+                        os._exit(1)
+                    n_calls.append(None)
+                    translate_batch(*a, **kw)
+
+                cc3m_processing.translate_batch = _translate_batch
+        translate_chunk(args, chunk_dir, shared_range)
+
+    return _translate_chunk
+
+
+def _single_process(args, output_dir):
+
+    os.makedirs(output_dir)
+    cc3m_processing.setup_translation(args)
+    try:
+        cc3m_processing.translate_annotations(
+            args.input_dir, args.input_fn, output_dir, 'single.jsonl', cc3m_processing.langs,
+            batch_size=args.batch_size, buf_size=args.buf_size, inf=0, sup=N_ENTRIES
+        )
+    finally:
+        cc3m_processing.close_translation()
+
+    return sorted(iter_entries(os.path.join(output_dir, 'single.jsonl')), key=lambda x: x['id'])
+
+
+def test_driver_matches_a_single_process(tmp_path, args, monkeypatch):
+
+    attempts_path = str(tmp_path / 'attempts.txt')
+    monkeypatch.setattr(cc3m_translation_driver, '_translate_chunk', _killed_after(3, attempts_path))
+
+    output_dir = str(tmp_path / 'driver')
+    output_fn = f'cc3m_train_translated_0_to_{N_ENTRIES}.jsonl'
+    # 2 chunks for 3 workers: one of them is split for the third worker (and more as workers finish)
+    driver = TranslationDriver(args, output_dir, output_fn, n_workers=3, chunk_size=150, report_every=1000)
+    output_path = driver.run(0, N_ENTRIES)
+
+    assert output_path == os.path.join(output_dir, output_fn)
+    entries = list(iter_entries(output_path))
+    assert entries == _single_process(args, str(tmp_path / 'single'))
+    assert entries[0]['fr'] == '[fr] a dog number 0 on the beach'
+
+    with open(driver.plan_path, encoding='UTF-8') as fp:
+        plan = json.load(fp)
+    # split at least once, the chunks still cover the range exactly
+    chunks = sorted(plan['chunks'])
+    assert len(chunks) >= 3
+    assert chunks[0][0] == 0 and chunks[-1][1] == N_ENTRIES
+    assert all(a[1] == b[0] for a, b in zip(chunks[:-1], chunks[1:]))
+    assert sorted(plan['done']) == chunks
+
+    # the killed chunk was restarted once, and resumed from what its first worker had committed
+    with open(attempts_path, encoding='UTF-8') as fp:
+        assert len(fp.readlines()) == 2
+    chunk_ids = [x['id'] for x in iter_entries(os.path.join(driver.chunk_dir, chunk_fn(KILLED_CHUNK)))]
+    assert len(chunk_ids) == len(set(chunk_ids))
+
+    # a finished run only merges again
+    monkeypatch.setattr(TranslationDriver, '_start', lambda *_: pytest.fail('a chunk was started again'))
+    driver = TranslationDriver(args, output_dir, output_fn, n_workers=3, chunk_size=150)
+    assert list(iter_entries(driver.run(0, N_ENTRIES))) == entries
+
+
+def test_driver_aborts_after_max_attempts(tmp_path, args, monkeypatch):
+
+    attempts_path = str(tmp_path / 'attempts.txt')
+    monkeypatch.setattr(cc3m_translation_driver, '_translate_chunk', _killed_after(None, attempts_path))
+
+    output_dir = str(tmp_path / 'driver')
+    driver = TranslationDriver(args, output_dir, 'out.jsonl', n_workers=2, chunk_size=150, max_attempts=2)
+    with pytest.raises(RuntimeError, match=f'chunk {KILLED_CHUNK} to [0-9]+ failed 2 times'):
+        driver.run(0, N_ENTRIES)
+
+    with open(attempts_path, encoding='UTF-8') as fp:
+        assert len(fp.readlines()) == 2
+    assert not os.path.exists(os.path.join(output_dir, 'out.jsonl'))
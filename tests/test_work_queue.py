@@ -0,0 +1,189 @@
+import threading
+
+import pytest
+
+import fake_gcs
+from cc3m_work_queue import DONE, LEASED, PENDING, GCSLeaseStore, SQLiteLeaseStore, WorkQueue, open_lease_store
+
+
+RANGES = [(0, 100), (100, 200), (200, 250)]
+
+
+@pytest.fixture(params=['sqlite', 'gcs'])
+def store(request, tmp_path, monkeypatch):
+
+    if request.param == 'sqlite':
+        store = SQLiteLeaseStore(str(tmp_path / 'queue.sqlite'))
+    else:
+        fake_gcs.install(monkeypatch)
+        store = open_lease_store('gs://bucket/queues/cc3m_train_queue.json')
+        assert isinstance(store, GCSLeaseStore)
+    store.add_ranges(RANGES)
+
+    yield store
+
+    store.close()
+
+
+def test_acquire_renew_complete(store):
+
+    a = store.acquire('a', 60, now=0)
+    b = store.acquire('b', 60, now=0)
+    assert (a.inf, a.sup, a.owner) == (0, 100, 'a')
+    assert (b.inf, b.sup, b.owner) == (100, 200, 'b')
+
+    a = store.renew(a, 60, now=50)
+    assert a.expires_at == 110
+    assert store.acquire('c', 60, now=55).inf == 200
+    # still held by `a` after its first expiry time, while the lease of `b` expired
+    assert store.acquire('d', 60, now=80).inf == 100
+    assert store.acquire('d', 60, now=80) is None
+
+    assert store.complete(a)
+    assert store.counts(now=80) == {DONE: 1, LEASED: 2}
+
+    # adding the ranges again doesn't reset them
+    store.add_ranges(RANGES)
+    assert store.counts(now=80) == {DONE: 1, LEASED: 2}
+
+
+def test_expired_lease_is_reclaimed(store):
+
+    a = store.acquire('a', 60, now=0)
+    assert store.counts(now=61) == {'expired': 1, PENDING: 2}
+
+    b = store.acquire('b', 60, now=61)
+    assert (b.inf, b.owner) == (a.inf, 'b')
+    assert b.token > a.token
+
+    # `a` can't renew, complete or release the range it lost
+    assert store.renew(a, 60, now=62) is None
+    assert not store.complete(a)
+    assert not store.release(a)
+
+    assert store.complete(b)
+    assert store.counts(now=62) == {DONE: 1, PENDING: 2}
+
+
+def test_released_range_is_leased_again(store):
+
+    a = store.acquire('a', 60, now=0)
+    assert store.release(a)
+
+    b = store.acquire('b', 60, now=1)
+    assert b.inf == a.inf and b.token > a.token
+
+
+def test_concurrent_acquires_get_distinct_ranges(store):
+
+    leases = []
+    lock = threading.Lock()
+
+    def _acquire(owner):
+        lease = store.acquire(owner, 60)
+        with lock:
+            leases.append(lease)
+
+    threads = [threading.Thread(target=_acquire, args=(f'node-{idx}',)) for idx in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    acquired = [x for x in leases if x is not None]
+    assert sorted(x.inf for x in acquired) == [inf for inf, _ in RANGES]
+    assert leases.count(None) == 2
+
+
+def test_gcs_conflicting_write_is_retried(monkeypatch):
+
+    client = fake_gcs.install(monkeypatch)
+    store = GCSLeaseStore('bucket', 'queue.json', backoff=0)
+    other = GCSLeaseStore('bucket', 'queue.json', backoff=0)
+    store.add_ranges(RANGES)
+
+    bucket = client.bucket('bucket')
+    interleaved = []
+
+    def _before_upload(name):
+        # another node acquires a range between the read and the write of `store`, once
+        if not interleaved:
+            interleaved.append(None)
+            interleaved.append(other.acquire('b', 60, now=0))
+
+    bucket.before_upload = _before_upload
+    a = store.acquire('a', 60, now=0)
+    bucket.before_upload = None
+
+    b = interleaved[1]
+    # `store` read the queue before `b` was written, so it tried to lease the same range, then started again
+    assert b.inf == 0
+    assert a.inf == 100
+    assert store.counts(now=0) == {LEASED: 2, PENDING: 1}
+
+
+def test_gcs_gives_up_if_the_object_keeps_changing(monkeypatch):
+
+    client = fake_gcs.install(monkeypatch)
+    store = GCSLeaseStore('bucket', 'queue.json', max_attempts=3, backoff=0)
+    store.add_ranges(RANGES)
+
+    bucket = client.bucket('bucket')
+
+    def _before_upload(name):
+        data, generation = bucket.objects[name]
+        bucket.n_generations += 1
+        bucket.objects[name] = (data, bucket.n_generations)
+
+    bucket.before_upload = _before_upload
+
+    with pytest.raises(RuntimeError, match='3 attempts'):
+        store.acquire('a', 60)
+
+
+def test_work_queue(tmp_path):
+
+    store = SQLiteLeaseStore(str(tmp_path / 'queue.sqlite'))
+    store.add_ranges(RANGES)
+    queue = WorkQueue(store, owner='a', lease_duration=60)
+
+    processed = []
+    with pytest.raises(KeyError):
+        for held in queue:
+            assert held.claim(held.lease.inf) and not held.claim(held.lease.sup)
+            if held.lease.inf == 100:
+                # a failure gives the range back
+                raise KeyError(held.lease.inf)
+            processed.append(held.lease.inf)
+    assert store.counts() == {DONE: 1, PENDING: 2}
+
+    for held in queue:
+        processed.append(held.lease.inf)
+        if held.lease.inf == 200:
+            # completed by the loop body: the queue doesn't complete it again
+            assert held.complete()
+    assert processed == [0, 100, 200]
+    assert store.counts() == {DONE: 3}
+
+    store.close()
+
+
+def test_lost_lease_stops_claims(tmp_path):
+
+    store = SQLiteLeaseStore(str(tmp_path / 'queue.sqlite'))
+    store.add_ranges(RANGES)
+
+    # leases expire right away, and are taken over by another node while `a` holds them
+    queue = WorkQueue(store, owner='a', lease_duration=0.3)
+    for held in queue:
+        assert held.claim(held.lease.inf)
+        other = store.acquire('b', 60, now=held.lease.expires_at + 1)
+        assert other.inf == held.lease.inf
+        held._thread.join(1)
+        assert held.lost
+        assert not held.claim(held.lease.inf)
+        break
+
+    # the range stays with `b`
+    assert store.counts() == {LEASED: 1, PENDING: 2}
+    store.close()